@@ -23,9 +23,10 @@ from jsonschema import ValidationError
 import armory
 from armory import paths
 from armory.configuration import load_global_config, save_config
-from armory.eval import Evaluator
+from armory.eval import Evaluator, ShardedEvaluator
 from armory.docker import images
 from armory.utils import docker_api
+from armory.scenarios.common import parse_shard
 from armory.utils.configuration import load_config, load_config_stdin
 
 logger = logging.getLogger(__name__)
@@ -278,6 +279,30 @@ def run(command_args, prog, description):
         action="store_true",
         help="Validate model configuration against several checks",
     )
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="<index>/<num_shards>",
+        help="Evaluate only shard <index> of <num_shards> disjoint slices of the evaluation data",
+    )
+    sharding.add_argument(
+        "--num-shards",
+        type=int,
+        metavar="<num_shards>",
+        help="Evaluate <num_shards> shards in parallel and merge their results",
+    )
+    sharding.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="<eval_id>",
+        help="Merge the results of sharded evaluations in the output directory",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="<eval_id>",
+        help="Resume the evaluation <eval_id> from its last checkpoint in the output directory",
+    )
 
     args = parser.parse_args(command_args)
     coloredlogs.install(level=args.log_level)
@@ -309,7 +334,31 @@ def run(command_args, prog, description):
     _set_gpus(config, args.use_gpu, args.no_gpu, args.gpus)
     _set_outputs(config, args.output_dir, args.output_filename)
 
-    rig = Evaluator(config, no_docker=args.no_docker, root=args.root)
+    if args.resume and (args.num_shards or args.merge_shards):
+        logger.error("--resume is incompatible with --num-shards and --merge-shards")
+        sys.exit(1)
+
+    if args.num_shards:
+        if args.interactive or args.jupyter or args.validate_config:
+            logger.error(
+                "--num-shards is incompatible with --interactive, --jupyter, "
+                "and --validate-config"
+            )
+            sys.exit(1)
+        rig = ShardedEvaluator(
+            config, args.num_shards, no_docker=args.no_docker, root=args.root
+        )
+        exit_code = rig.run(
+            check_run=args.check,
+            num_eval_batches=args.num_eval_batches,
+            skip_benign=args.skip_benign,
+            skip_attack=args.skip_attack,
+        )
+        sys.exit(exit_code)
+
+    rig = Evaluator(
+        config, no_docker=args.no_docker, root=args.root, eval_id=args.resume
+    )
     exit_code = rig.run(
         interactive=args.interactive,
         jupyter=args.jupyter,
@@ -319,6 +368,9 @@ def run(command_args, prog, description):
         skip_benign=args.skip_benign,
         skip_attack=args.skip_attack,
         validate_config=args.validate_config,
+        shard=args.shard,
+        merge_shards=args.merge_shards,
+        resume=bool(args.resume),
     )
     sys.exit(exit_code)
 
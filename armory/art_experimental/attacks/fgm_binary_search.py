@@ -44,31 +44,33 @@ class FGMBinarySearch(FastGradientMethod):
         mask = None
         perturbation = self._compute_perturbation(batch, batch_labels, mask)
 
-        def check_epsilon(i, epsilon):
-            adv_batch = self._apply_perturbation(batch[[i]], perturbation[[i]], epsilon)
-            adv_pred = self.estimator.predict(adv_batch)
-            adv_class = np.argmax(adv_pred, axis=1)
+        # Bisect all samples at once, with an [min_eps, max_eps] interval per sample
+        # Assume endpoints are correct
+        tolerance = self.eps_step
+        min_eps = np.zeros(len(batch))
+        max_eps = np.full(len(batch), float(self.eps))
+        eps_shape = (-1,) + (1,) * (batch.ndim - 1)
+        active = np.flatnonzero(max_eps - min_eps > tolerance)
+        while active.size > 0:
+            mid_eps = (max_eps[active] + min_eps[active]) / 2
+
+            # Adversarial crafting for the active samples only
+            adv_active = self._apply_perturbation(
+                batch[active],
+                perturbation[active],
+                mid_eps.reshape(eps_shape).astype(perturbation.dtype),
+            )
+
+            # Check for success
+            adv_classes = np.argmax(self.estimator.predict(adv_active), axis=1)
             if self.targeted:
-                success = batch_classes[[i]] == adv_class
+                success = batch_classes[active] == adv_classes
             else:
-                success = batch_classes[[i]] != adv_class
-            return success, adv_batch
-
-        tolerance = self.eps_step
-        for i in range(len(batch)):
-            # Assume endpoints are correct
-            min_eps = 0
-            max_eps = self.eps
-            while max_eps - min_eps > tolerance:
-                mid_eps = (max_eps + min_eps) / 2
-                # print(min_eps, mid_eps, max_eps, tolerance)
-
-                success, adv_i = check_epsilon(i, mid_eps)
-                if success:
-                    adv_batch[[i]] = adv_i
-                    max_eps = mid_eps
-                else:
-                    min_eps = mid_eps
+                success = batch_classes[active] != adv_classes
+            adv_batch[active[success]] = adv_active[success]
+            max_eps[active[success]] = mid_eps[success]
+            min_eps[active[~success]] = mid_eps[~success]
+            active = active[max_eps[active] - min_eps[active] > tolerance]
 
         return adv_batch
 
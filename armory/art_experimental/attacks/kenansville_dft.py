@@ -42,70 +42,132 @@ class KenansvilleDFT:
             raise ValueError("Negative SNR is not allowed")
 
     def _attack(self, x):
-        x_len = len(x)
-        x_fft = np.fft.fft(x)
-        x_psd = np.abs(x_fft) ** 2
-        # sort by frequencies with increasing power
-        x_psd_ind = np.argsort(x_psd)
-        dc_ind = np.where(x_psd_ind == 0)[0][0]
-        signal_db = 10 * np.log10(np.sum(x_psd))
-
-        """
-        The goal of the following search is to find all the
-        low power frequencies that can be discarded while
-        maintaining a minimum SNR.
+        x_adv, unchanged = self._attack_batch(x[np.newaxis])
+        if unchanged[0]:
+            return x
+        return x_adv[0]
 
-        If desired, the following coarse and fine search could
-        be replaced with binary search for faster convergence.
+    def _attack_batch(self, x):
         """
-        # coarse search
-        id = 2
-        noise = np.sum(x_psd[x_psd_ind[:id]])
-        noise_db = 10 * np.log10(noise)
-        while signal_db - noise_db > self.snr_db:
-            id *= 2
-            noise = np.sum(x_psd[x_psd_ind[: min(id, x_len)]])
-            noise_db = 10 * np.log10(noise)
-
-        if id == 2:
-            return x
+        Attack each row of 2D array x independently
 
-        # fine search
-        id = int(id / 2)
-        noise = np.sum(x_psd[x_psd_ind[:id]])
-        noise_db = 10 * np.log10(noise)
-        while signal_db - noise_db > self.snr_db:
-            id += 2
-            noise = np.sum(x_psd[x_psd_ind[: min(id, x_len)]])
-            noise_db = 10 * np.log10(noise)
+        The goal is to discard as many of the lowest power frequencies as possible
+            while maintaining a minimum SNR. Frequencies are counted as in the full
+            DFT, where each frequency of the real DFT other than DC and, if x_len is
+            even, x_len/2 is a pair of conjugate frequencies. Rows where not even
+            the 2 lowest power frequencies can be discarded are returned unchanged.
 
-        id -= 2
+        Returns the attacked rows and a boolean array of the unchanged rows
+        """
+        num_rows, x_len = x.shape
+        x_rfft = np.fft.rfft(x, axis=1)
+        x_psd = np.abs(x_rfft) ** 2
+        num_freqs = x_psd.shape[1]
+        pair_counts = np.full(num_freqs, 2)
+        pair_counts[0] = 1
+        if x_len % 2 == 0:
+            pair_counts[-1] = 1
+
+        # full DFT frequencies sorted by increasing power, as indices into the rfft
+        x_psd_ind = np.argsort(x_psd, axis=1)
+        sorted_counts = pair_counts[x_psd_ind]
+        full_ind = np.repeat(x_psd_ind, sorted_counts.ravel()).reshape(num_rows, x_len)
+        full_psd = np.take_along_axis(x_psd, full_ind, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            signal_db = 10 * np.log10(np.sum(full_psd, axis=1, keepdims=True))
+            noise_db = 10 * np.log10(np.cumsum(full_psd[:, :-1], axis=1))
+            # number of frequencies that can be discarded, up to an even number
+            num_discarded = np.sum(signal_db - noise_db > self.snr_db, axis=1)
+        num_discarded -= num_discarded % 2
+        unchanged = num_discarded < 2
+
+        # zero out low power frequencies; discarding one of a pair of conjugate
+        # frequencies and taking the real part of the inverse DFT halves the pair
+        rows = np.arange(num_rows)
+        discarded = np.arange(x_len) < num_discarded[:, np.newaxis]
+        num_zeroed = np.bincount(
+            (rows[:, np.newaxis] * num_freqs + full_ind)[discarded],
+            minlength=num_rows * num_freqs,
+        ).reshape(num_rows, num_freqs)
 
         # make sure the only non-paired frequencies are DC and, if x is even, x_len/2
-        if (dc_ind in x_psd_ind[:id]) ^ (
-            x_len % 2 == 0 and x_len / 2 in x_psd_ind[:id]
-        ):
-            id -= 1
-
-        # zero out low power frequencies
-        x_fft[x_psd_ind[:id]] = 0
-
-        x_ifft = np.fft.ifft(x_fft)
+        # As in the original search, DC is checked by the full DFT frequency that
+        # has the same rank as DC in the sorted order
+        dc_ind = np.argmax(full_ind == 0, axis=1)
+        dc_ind_rfft = np.minimum(dc_ind, x_len - dc_ind)
+        unpaired = num_zeroed[rows, dc_ind_rfft] > 0
+        # If only one of that pair is discarded, which one depends on how the full
+        # DFT sorts them
+        full_sort = (num_zeroed[rows, dc_ind_rfft] == 1) & (
+            pair_counts[dc_ind_rfft] == 2
+        )
+        if x_len % 2 == 0:
+            unpaired ^= num_zeroed[:, -1] > 0
+        unpaired &= ~unchanged
+        last = full_ind[rows[unpaired], num_discarded[unpaired] - 1]
+        num_zeroed[rows[unpaired], last] -= 1
+
+        # So do which of a run of equal power frequencies are discarded, and the
+        # rank of DC, so rows where a run is cut or DC is in a run are also sorted
+        # with the full DFT as before
+        sorted_psd = np.take_along_axis(x_psd, x_psd_ind, axis=1)
+        tied = np.isclose(sorted_psd[:, 1:], sorted_psd[:, :-1], rtol=1e-12, atol=0)
+        ends = np.cumsum(sorted_counts, axis=1)
+        starts = ends - sorted_counts
+        for cut in num_discarded, num_discarded - 1:
+            cut = cut[:, np.newaxis]
+            full_sort |= np.any(
+                tied & (starts[:, :-1] < cut) & (cut < ends[:, 1:]), axis=1
+            )
+        dc_rank = np.argmax(x_psd_ind == 0, axis=1)
+        tied_padded = np.pad(tied, ((0, 0), (1, 1)))
+        full_sort |= tied_padded[rows, dc_rank] | tied_padded[rows, dc_rank + 1]
+        for i in np.flatnonzero(full_sort & ~unchanged):
+            num_zeroed[i] = self._full_dft_zeroed(x[i], num_discarded[i], num_freqs)
+        x_rfft *= 1 - num_zeroed / pair_counts
+
+        x_adv = np.fft.irfft(x_rfft, n=x_len, axis=1).astype(np.float32)
+        x_adv[unchanged] = x[unchanged]
+        return x_adv, unchanged
+
+    @staticmethod
+    def _full_dft_zeroed(x, num_discarded, num_freqs):
+        """
+        Discard the num_discarded lowest power frequencies of 1D array x as sorted
+            by the full DFT, less one if needed to keep the frequencies paired
 
-        return np.real(x_ifft).astype(np.float32)
+        Returns the number of discarded frequencies of each real DFT frequency
+        """
+        x_len = len(x)
+        x_psd_ind = np.argsort(np.abs(np.fft.fft(x)) ** 2)
+        discarded = x_psd_ind[:num_discarded]
+        dc_ind = np.flatnonzero(x_psd_ind == 0)[0]
+        if (dc_ind in discarded) ^ (x_len % 2 == 0 and x_len // 2 in discarded):
+            discarded = discarded[:-1]
+        return np.bincount(
+            np.minimum(discarded, x_len - discarded), minlength=num_freqs
+        )
 
     def generate(self, x):
         x_out = np.empty((len(x),), dtype=object)
         for i, x_example in enumerate(x):
             if self.partial_attack:
                 # split input into multiple segments and attack each with some probability
-                x_adv = np.zeros_like(x_example)
+                x_adv = x_example.copy()
                 seg_len = self.attack_len
-                for j in range(int(np.ceil(len(x_example) / seg_len))):
-                    xs = x_example[seg_len * j : min((j + 1) * seg_len, len(x_example))]
-                    if np.random.rand(1) < self.attack_prob:
-                        xs = self._attack(xs)
-                    x_adv[seg_len * j : min((j + 1) * seg_len, len(x_example))] = xs
+                num_segs = int(np.ceil(len(x_example) / seg_len))
+                attacked = np.random.rand(num_segs) < self.attack_prob
+                # attack all full length segments at once, and any shorter last one
+                num_full = len(x_example) // seg_len
+                segs = x_adv[: num_full * seg_len].reshape(num_full, seg_len)
+                if attacked[:num_full].any():
+                    segs[attacked[:num_full]] = self._attack_batch(
+                        segs[attacked[:num_full]]
+                    )[0]
+                if num_segs > num_full and attacked[-1]:
+                    x_adv[num_full * seg_len :] = self._attack(
+                        x_adv[num_full * seg_len :]
+                    )
             else:
                 x_adv = self._attack(x_example)
             x_out[i] = x_adv
@@ -2,6 +2,7 @@
 This module enables loading of different perturbation functions in poisoning
 """
 
+import numpy as np
 from art.attacks.poisoning import PoisoningAttackBackdoor
 from art.attacks.poisoning import perturbations
 
@@ -35,4 +36,30 @@ def poison_loader_GTSRB(**kwargs):
     else:
         raise ValueError(f"Unknown poison_type {poison_type}")
 
-    return PoisoningAttackBackdoor(mod)
+    attack = PoisoningAttackBackdoor(mod)
+    # pattern and pixel perturbations modify each 2D slice of a 3D input independently
+    attack.slicewise = poison_type in ("pattern", "pixel")
+    return attack
+
+
+def poison_images(attack, images, target, axes=None):
+    """
+    Return the result of attack.poison(image, [target]) for each image in images
+
+    axes - if not None, each image is transposed by axes before poisoning and back after
+    If attack.slicewise is True, the leading-axis slices of all images are stacked and
+        poisoned in a single call, which gives identical results to poisoning
+        each image separately. Otherwise, images are poisoned one at a time.
+    """
+    if axes is not None:
+        images = np.transpose(images, (0,) + tuple(a + 1 for a in axes))
+    if not len(images):
+        poisoned = np.array(images)
+    elif getattr(attack, "slicewise", False):
+        stacked, _ = attack.poison(images.reshape((-1,) + images.shape[2:]), [target])
+        poisoned = stacked.reshape(images.shape)
+    else:
+        poisoned = np.stack([attack.poison(image, [target])[0] for image in images])
+    if axes is not None:
+        poisoned = np.transpose(poisoned, (0,) + tuple(np.argsort(axes) + 1))
+    return poisoned
@@ -2,6 +2,9 @@ from art.attacks.evasion import (
     ProjectedGradientDescentPyTorch,
     ProjectedGradientDescentNumpy,
 )
+from art.config import ART_NUMPY_DTYPE
+from art.estimators.classification import ClassifierMixin
+from art.utils import random_sphere
 import numpy as np
 
 import logging
@@ -11,7 +14,11 @@ logger = logging.getLogger(__name__)
 
 class SNR_PGDRange:
     """
-    Finds the maximum SNR for each sample (if possible), via binary search.
+    Finds the maximum SNR for each sample (if possible), via k-ary search.
+
+    Each round attacks the sample at num_candidates values of eps_range at once,
+        as a single batch, and narrows the search to the values between the highest
+        success and the lowest failure above it. num_candidates 1 is bisection.
 
     Example attack config:
         "attack": {
@@ -24,6 +31,7 @@ class SNR_PGDRange:
                 "eps_step": 0.5,
                 "max_iter": 10,
                 "norm": "snr_db",
+                "num_candidates": 1,
                 "num_random_init": 2,
                 "targeted": false,
                 "verbose": false
@@ -34,16 +42,21 @@ class SNR_PGDRange:
         }
     """
 
-    def __init__(self, estimator, eps_range=(0, 10, 20, 30, 40, 50), **kwargs):
+    def __init__(
+        self, estimator, eps_range=(0, 10, 20, 30, 40, 50), num_candidates=1, **kwargs,
+    ):
         if "eps" in kwargs:
             raise ValueError("Use 'eps_range' instead of 'eps'")
         self.estimator = estimator
         self.eps_range = sorted(eps_range)
         if len(eps_range) < 2:
             raise ValueError("Please select multiple values for eps_range")
-        self.attacks = []
-        for eps in eps_range:
-            self.attacks.append(SNR_PGD(estimator, eps=eps, **kwargs))
+        self.num_candidates = _check_num_candidates(num_candidates)
+        norm = kwargs.get("norm", "snr")
+        self.snr_sqrt_reciprocals = np.array(
+            [snr_sqrt_reciprocal(eps, norm) for eps in self.eps_range]
+        )
+        self.attack = SNR_PGD(estimator, eps=self.eps_range[0], **kwargs)
 
     def generate(self, x, y=None, **kwargs):
         if y is None:
@@ -52,25 +65,36 @@ class SNR_PGDRange:
             logger.info("Original prediction failed. Returning original x.")
             return x
 
-        # find best eps via bisection
+        # find best eps via k-ary search
         i_min = 0
         i_max = len(self.eps_range)
         x_best = None
         eps_best = None
         while i_min < i_max:
-            i_mid = (i_min + i_max) // 2
-            x_adv = self.attacks[i_mid].generate(x, y, **kwargs)
-            eps = self.eps_range[i_mid]
-            if self.estimator.predict(x_adv).argmax() != y:
-                # attack success (will also succeed for lower SNR)
-                logger.info(f"Success with eps {eps}")
-                x_best = x_adv
-                eps_best = eps
-                i_min = i_mid + 1
+            n = i_max - i_min
+            if n <= self.num_candidates:
+                indices = np.arange(i_min, i_max)
             else:
-                # attack failure (will also fail for higher SNR)
-                logger.info(f"Failure with eps {eps}")
-                i_max = i_mid
+                k = self.num_candidates
+                indices = i_min + np.arange(1, k + 1) * n // (k + 1)
+            x_adv, predictions = self.attack.generate_candidates(
+                x, y, self.snr_sqrt_reciprocals[indices], **kwargs
+            )
+            success = predictions.argmax(axis=1) != y
+            for i, success_i in zip(indices, success):
+                # success will also succeed for lower SNR
+                # failure will also fail for higher SNR
+                result = "Success" if success_i else "Failure"
+                logger.info(f"{result} with eps {self.eps_range[i]}")
+
+            if success.any():
+                j = np.flatnonzero(success)[-1]
+                x_best = _single_sample(x_adv[j], x)
+                eps_best = self.eps_range[indices[j]]
+                i_min = indices[j] + 1
+            failures = indices[~success & (indices >= i_min)]
+            if len(failures):
+                i_max = failures[0]
 
         if x_best is None:
             logger.info("Attack failed. Returning original x.")
@@ -84,6 +108,11 @@ class SNR_PGDRange2:
     """
     Finds the maximum SNR for each sample, with a given tolerance
 
+    Each round attacks the sample at num_candidates values of eps at once, as a
+        single batch, evenly spaced between the highest success and the lowest
+        failure so far. The first round also includes eps_min and eps_max.
+        num_candidates 1 is bisection.
+
     Example attack config:
         "attack": {
             "knowledge": "white",
@@ -94,6 +123,7 @@ class SNR_PGDRange2:
                 "eps_step": 0.5,
                 "max_iter": 10,
                 "norm": "snr_db",
+                "num_candidates": 1,
                 "num_random_init": 2,
                 "targeted": false,
                 "tolerance": 1,
@@ -106,7 +136,14 @@ class SNR_PGDRange2:
     """
 
     def __init__(
-        self, estimator, attack="l2", eps_min=10, eps_max=50, tolerance=1, **kwargs
+        self,
+        estimator,
+        attack="l2",
+        eps_min=10,
+        eps_max=50,
+        tolerance=1,
+        num_candidates=1,
+        **kwargs,
     ):
         if eps_min > eps_max:
             raise ValueError(f"eps_min {eps_min} > eps_max {eps_max}")
@@ -122,12 +159,13 @@ class SNR_PGDRange2:
             self.Attack = SNR_PGD_Linf
         else:
             raise ValueError(f'attack {attack} not in ("l2", "linf")')
-        self.min_attack = self.Attack(estimator, eps=eps_min, **kwargs)
-        self.max_attack = self.Attack(estimator, eps=eps_max, **kwargs)
+        self.attack = self.Attack(estimator, eps=eps_min, **kwargs)
+        self.norm = kwargs.get("norm", "snr")
         self.eps_min = eps_min
         self.eps_max = eps_max
         self.estimator = estimator
         self.kwargs = kwargs
+        self.num_candidates = _check_num_candidates(num_candidates)
         tolerance = float(tolerance)
         if not (tolerance >= 0):
             raise ValueError(f"tolerance {tolerance} must be a positive float")
@@ -143,72 +181,371 @@ class SNR_PGDRange2:
             logger.info("Original prediction failed. Returning original x.")
             return x
         if self.eps_min == self.eps_max:
-            return self.min_attack.generate(x, y, **kwargs)
+            return self.attack.generate(x, y, **kwargs)
 
         # test endpoints
-        x_adv = self.max_attack.generate(x, y, **kwargs)
-        if self.estimator.predict(x_adv).argmax() != y:
+        eps_values = np.linspace(
+            self.eps_min, self.eps_max, max(2, self.num_candidates)
+        )
+        x_adv, success = self._probe(x, y, eps_values, **kwargs)
+        if success[-1]:
             logger.info(f"Success at upper boundary eps = {self.eps_max}")
-            return x_adv
+            return _single_sample(x_adv[-1], x)
         else:
             logger.info(f"Failure at upper boundary eps = {self.eps_max}")
-            upper_eps = self.eps_max
-
-        x_adv = self.min_attack.generate(x, y, **kwargs)
-        if self.estimator.predict(x_adv).argmax() != y:
-            logger.info(f"Success at lower boundary eps = {self.eps_min}")
-            lower_eps = self.eps_min
-            x_best = x_adv
-            eps_best = lower_eps
-        else:
+        if not success[0]:
             logger.info(f"Failure at lower boundary eps = {self.eps_min}")
-            return x_adv
+            return _single_sample(x_adv[0], x)
+        else:
+            logger.info(f"Success at lower boundary eps = {self.eps_min}")
+        for eps, success_i in zip(eps_values[1:-1], success[1:-1]):
+            logger.info(f"{'Success' if success_i else 'Failure'} at eps = {eps}")
+
+        lower_eps = upper_eps = None
+        while True:
+            j = np.flatnonzero(success)
+            if len(j):
+                j = j[-1]
+                lower_eps = eps_values[j]
+                x_best = _single_sample(x_adv[j], x)
+                eps_best = lower_eps
+            failures = eps_values[~success & (eps_values > lower_eps)]
+            if len(failures):
+                upper_eps = failures[0]
+            if upper_eps - lower_eps <= self.tolerance:
+                break
 
-        while upper_eps - lower_eps > self.tolerance:
-            mid_eps = (upper_eps + lower_eps) / 2
-            if mid_eps == lower_eps or mid_eps == upper_eps:
+            k = self.num_candidates
+            eps_values = [
+                (lower_eps * (k + 1 - i) + upper_eps * i) / (k + 1)
+                for i in range(1, k + 1)
+            ]
+            eps_values = np.unique(
+                [eps for eps in eps_values if lower_eps < eps < upper_eps]
+            )
+            if not len(eps_values):
                 logger.info("Reached floating point tolerance limit")
                 break
-            attack = self.Attack(self.estimator, eps=mid_eps, **self.kwargs)
-            x_adv = attack.generate(x, y, **kwargs)
-            if self.estimator.predict(x_adv).argmax() != y:
-                logger.info(f"Success at eps = {mid_eps}")
-                lower_eps = mid_eps
-                x_best = x_adv
-                eps_best = lower_eps
-            else:
-                logger.info(f"Failure at eps = {mid_eps}")
-                upper_eps = mid_eps
+            x_adv, success = self._probe(x, y, eps_values, **kwargs)
+            for eps, success_i in zip(eps_values, success):
+                logger.info(f"{'Success' if success_i else 'Failure'} at eps = {eps}")
 
         logger.info(f"Returning best attack with eps {eps_best}")
         return x_best
 
+    def _probe(self, x, y, eps_values, **kwargs):
+        """
+        Attack x at each of eps_values as one batch, and return results and success
+        """
+        x_adv, predictions = self.attack.generate_candidates(
+            x, y, [snr_sqrt_reciprocal(eps, self.norm) for eps in eps_values], **kwargs,
+        )
+        return x_adv, predictions.argmax(axis=1) != y
+
+
+def _check_num_candidates(num_candidates):
+    if int(num_candidates) != num_candidates or num_candidates < 1:
+        raise ValueError(f"num_candidates {num_candidates} must be a positive int")
+    return int(num_candidates)
+
+
+def _single_sample(x_adv, x):
+    """
+    Return one of the samples of generate_candidates in the form of input x
+    """
+    if x.dtype == object:
+        x_single = np.empty(1, dtype=object)
+        x_single[0] = x_adv
+        return x_single
+    return x_adv[np.newaxis]
+
+
+def snr_sqrt_reciprocal(eps, norm="snr"):
+    """
+    Return 1 / sqrt(SNR) for an SNR bound eps with norm 'snr' or 'snr_db'
+    """
+    eps = float(eps)
+    if norm == "snr":
+        snr = eps
+    elif norm == "snr_db":
+        snr = 10 ** (eps / 10)
+    else:
+        raise ValueError(f"norm must be 'snr' (default) or 'snr_db', not {norm}")
+
+    if snr < 0:
+        raise ValueError(f"snr must be nonnegative, not {snr}")
+    elif snr == 0:
+        return np.inf
+    elif snr == np.inf:
+        return 0
+    else:
+        return 1 / np.sqrt(snr)
+
+
+def pad_signals(x):
+    """
+    Return x as a single array of samples and the number of values in each
+
+    x is either an array of samples, or an object array of 1D signals of varying
+        lengths, which are zero-padded at the end to the longest.
+    """
+    if x.dtype != object:
+        return x, np.full(len(x), np.prod(x.shape[1:], dtype=np.int64))
+    signals = [np.asarray(signal) for signal in x]
+    if any(signal.ndim != 1 for signal in signals):
+        raise ValueError("object arrays must hold 1D signals")
+    lengths = np.array([len(signal) for signal in signals], dtype=np.int64)
+    dtype = np.result_type(*[signal.dtype for signal in signals])
+    x_padded = np.zeros((len(x), lengths.max(initial=0)), dtype=dtype)
+    for x_i, signal in zip(x_padded, signals):
+        x_i[: len(signal)] = signal
+    return x_padded, lengths
+
+
+def _sample_shape(x):
+    """
+    Shape that broadcasts one value per sample against x
+    """
+    return (len(x),) + (1,) * (x.ndim - 1)
+
+
+class _SNR_PGDBatch:
+    """
+    Batched PGD with a separate epsilon for each sample, set by its signal power
+
+    Signals are attacked batch_size at a time. Signals of varying lengths are
+        zero-padded to the longest in their batch, with the padding masked out of the
+        perturbation, and are batched in order of length to limit padding. For
+        estimators whose output on a signal does not change with padding, the
+        result for each sample is that of attacking it alone; with
+        num_random_init > 0, the random draws differ. For estimators whose output
+        depends on input length, such as speech recognizers, set group_by_length
+        to only batch signals with others of the same length, without padding.
+
+    Subclasses set snr_sqrt_reciprocal and step_fraction, and define _pgd
+    """
+
+    def generate(self, x, y=None, **kwargs):
+        lengths = np.array([np.size(x_i) for x_i in x], dtype=np.int64)
+        scale = self._signal_scale(x, lengths)
+        if (lengths == 0).any():
+            logger.warning("Length 0 signal. Returning original.")
+        if ((scale == 0) & (lengths > 0)).any():
+            logger.warning("Input all 0. Not making any change.")
+        active = np.flatnonzero(scale > 0)
+        if self.snr_sqrt_reciprocal == 0 or not len(active):
+            return x
+
+        eps = scale * self.snr_sqrt_reciprocal
+        mask = kwargs.get("mask")
+        # A mask of the same rank as x holds a separate mask for each sample
+        per_sample_mask = mask is not None and mask.ndim == x.ndim
+
+        if x.dtype == object:
+            x_adv = x.copy()
+        else:
+            x_adv = x.astype(ART_NUMPY_DTYPE)
+        if x.dtype != object:
+            groups = [active]
+        elif self.group_by_length:
+            groups = [active[lengths[active] == n] for n in np.unique(lengths[active])]
+        else:
+            groups = [active[np.argsort(lengths[active], kind="stable")]]
+        for group in groups:
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start : start + self.batch_size]
+                x_batch, batch_lengths, targets, batch_mask = self._prepare_batch(
+                    x[batch],
+                    None if y is None else y[batch],
+                    mask[batch] if per_sample_mask else mask,
+                )
+                x_adv_batch, _ = self._generate_batch_eps(
+                    x_batch, targets, batch_mask, eps[batch], batch_lengths
+                )
+                if x.dtype == object:
+                    for i, x_adv_i, length in zip(batch, x_adv_batch, batch_lengths):
+                        x_adv[i] = x_adv_i[:length]
+                else:
+                    x_adv[batch] = x_adv_batch
+        return x_adv
+
+    def generate_candidates(self, x, y, snr_sqrt_reciprocals, **kwargs):
+        """
+        Attack a single sample once for each of several SNR bounds, as one batch
+
+        x holds a single sample. snr_sqrt_reciprocals holds 1 / sqrt(SNR) for each
+            candidate bound, and replaces snr_sqrt_reciprocal of the attack.
+        Returns the adversarial samples, of shape (len(snr_sqrt_reciprocals), ...)
+            with any object array signal unpacked, and the estimator predictions on
+            them.
+        """
+        if len(x) != 1:
+            raise NotImplementedError("only a single sample x supported")
+        snr_sqrt_reciprocals = np.asarray(snr_sqrt_reciprocals, dtype=float)
+        num_candidates = len(snr_sqrt_reciprocals)
+        x_batch, lengths, targets, mask = self._prepare_batch(x, y, kwargs.get("mask"))
+        scale = self._signal_scale(x, lengths)[0]
+        x_batch = np.repeat(x_batch, num_candidates, axis=0)
+        if scale == 0:
+            logger.warning("Input all 0. Not making any change.")
+            predictions = self.estimator.predict(x_batch[:1], batch_size=1)
+            return x_batch, np.repeat(predictions, num_candidates, axis=0)
+
+        if mask is not None and mask.ndim == x_batch.ndim:
+            mask = np.repeat(mask, num_candidates, axis=0)
+        x_adv, predictions = self._generate_batch_eps(
+            x_batch,
+            np.repeat(targets, num_candidates, axis=0),
+            mask,
+            scale * snr_sqrt_reciprocals,
+            np.repeat(lengths, num_candidates),
+        )
+        if predictions is None:
+            predictions = self.estimator.predict(x_adv, batch_size=num_candidates)
+        return x_adv, predictions
+
+    def _prepare_batch(self, x, y, mask):
+        """
+        Return the padded samples, lengths, targets, and mask of a batch
+        """
+        classifier_mixin = isinstance(self.estimator, ClassifierMixin)
+        if not classifier_mixin and self.num_random_init > 0:
+            raise ValueError(
+                "Random initialisation is only supported for classification."
+            )
+        x_batch, lengths = pad_signals(x)
+        targets = self._set_targets(x_batch, y, classifier_mixin)
+        mask = self._get_mask(x_batch, mask=mask)
+        if (lengths < x_batch.shape[1]).any():
+            padding_mask = np.arange(x_batch.shape[1]) < lengths[:, np.newaxis]
+            mask = padding_mask if mask is None else padding_mask * mask
+        if mask is not None:
+            mask = mask.astype(ART_NUMPY_DTYPE)
+        return x_batch.astype(ART_NUMPY_DTYPE), lengths, targets, mask
+
+    def _signal_scale(self, x, lengths):
+        """
+        Return the L2 norm of each signal
+        """
+        return np.array([np.linalg.norm(np.ravel(x_i)) for x_i in x])
+
+    def _generate_batch_eps(self, x, targets, mask, eps, lengths):
+        """
+        Return the best of num_random_init attacks on each sample of a batch
+
+        As in ART, a later random initialization replaces an earlier one only for
+            samples where it succeeds and the earlier one did not. Also returns
+            the estimator predictions on the result if they were needed to pick
+            it, and None otherwise.
+        """
+        if self.num_random_init <= 1:
+            return self._pgd(x, targets, mask, eps, lengths), None
+
+        labels = np.argmax(targets, axis=1)
+        if not self.targeted:
+            labels = np.argmax(
+                self.estimator.predict(x, batch_size=self.batch_size), axis=1
+            )
+        x_best = None
+        for _ in range(self.num_random_init):
+            x_adv = self._pgd(x, targets, mask, eps, lengths)
+            predictions = self.estimator.predict(x_adv, batch_size=self.batch_size)
+            if self.targeted:
+                success = np.argmax(predictions, axis=1) == labels
+            else:
+                success = np.argmax(predictions, axis=1) != labels
+            if x_best is None:
+                x_best, predictions_best, success_best = x_adv, predictions, success
+            else:
+                improved = success & ~success_best
+                x_best[improved] = x_adv[improved]
+                predictions_best[improved] = predictions[improved]
+                success_best |= success
+        logger.info(f"Success rate of attack: {100 * success_best.mean():.2f}%")
+        return x_best, predictions_best
+
+    def _random_init(self, x, mask, eps, lengths):
+        """
+        Return x plus a random start within the eps ball of each unpadded signal
+        """
+        perturbation = np.zeros_like(x)
+        for perturbation_i, length, radius in zip(perturbation, lengths, eps):
+            perturbation_i.flat[:length] = random_sphere(
+                1, int(length), radius, self.norm
+            )
+        if mask is not None:
+            perturbation = perturbation * mask
+        x_adv = x + perturbation
+        if self.estimator.clip_values is not None:
+            clip_min, clip_max = self.estimator.clip_values
+            x_adv = np.clip(x_adv, clip_min, clip_max)
+        return x_adv.astype(ART_NUMPY_DTYPE)
+
+
+class _SNR_PGDTorch(_SNR_PGDBatch):
+    """
+    _SNR_PGDBatch for ProjectedGradientDescentPyTorch
+
+    eps and eps_step are passed to _compute_torch as tensors of one value per sample
+    """
 
-class SNR_PGD_Numpy(ProjectedGradientDescentNumpy):
+    def _pgd(self, x, targets, mask, eps, lengths):
+        import torch
+
+        if self.num_random_init > 0:
+            x_adv = self._random_init(x, mask, eps, lengths)
+        else:
+            x_adv = x
+        eps_step = (eps * self.step_fraction).reshape(_sample_shape(x))
+
+        device = self.estimator.device
+        x_adv, x_init, targets, eps, eps_step = (
+            torch.from_numpy(array.astype(ART_NUMPY_DTYPE)).to(device)
+            for array in (x_adv, x, targets, eps, eps_step)
+        )
+        if mask is not None:
+            mask = torch.from_numpy(mask).to(device)
+        for _ in range(self.max_iter):
+            x_adv = self._compute_torch(
+                x_adv, x_init, targets, mask, eps, eps_step, False
+            )
+        return x_adv.cpu().detach().numpy()
+
+    def _projection(self, values, eps, norm_p):
+        """
+        Project each sample of values on the L_p norm ball of its own size eps
+        """
+        import torch
+
+        tol = 10e-8
+        values_tmp = values.reshape(values.shape[0], -1)
+        eps = eps.reshape(-1, 1)
+        if norm_p == 2:
+            norm = torch.norm(values_tmp, p=2, dim=1, keepdim=True)
+            values_tmp = values_tmp * torch.clamp(eps / (norm + tol), max=1.0)
+        elif norm_p in [np.inf, "inf"]:
+            values_tmp = values_tmp.sign() * torch.min(values_tmp.abs(), eps)
+        else:
+            raise NotImplementedError(f"norm_p {norm_p} not in (2, np.inf)")
+        return values_tmp.reshape(values.shape)
+
+
+class SNR_PGD_Numpy(_SNR_PGDBatch, ProjectedGradientDescentNumpy):
     def __init__(
-        self, estimator, norm="snr", eps=10, eps_step=0.5, batch_size=1, **kwargs
+        self,
+        estimator,
+        norm="snr",
+        eps=10,
+        eps_step=0.5,
+        batch_size=1,
+        group_by_length=False,
+        **kwargs,
     ):
-        if batch_size != 1:
-            raise NotImplementedError("only batch_size 1 supported")
-        super().__init__(estimator, norm=2, batch_size=1, **kwargs)
+        super().__init__(estimator, norm=2, batch_size=batch_size, **kwargs)
+        self.group_by_length = group_by_length
 
         # Map to SNR domain
-        eps = float(eps)
-        if norm == "snr":
-            snr = eps
-        elif norm == "snr_db":
-            snr = 10 ** (eps / 10)
-        else:
-            raise ValueError(f"norm must be 'snr' (default) or 'snr_db', not {norm}")
-
-        if snr < 0:
-            raise ValueError(f"snr must be nonnegative, not {snr}")
-        elif snr == 0:
-            self.snr_sqrt_reciprocal = np.inf
-        elif snr == np.inf:
-            self.snr_sqrt_reciprocal = 0
-        else:
-            self.snr_sqrt_reciprocal = 1 / np.sqrt(snr)
+        self.snr_sqrt_reciprocal = snr_sqrt_reciprocal(eps, norm)
 
         eps_step = float(eps_step)
 
@@ -216,21 +553,48 @@ class SNR_PGD_Numpy(ProjectedGradientDescentNumpy):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
-        x_l2 = np.linalg.norm(x, ord=2)
-        if x_l2 == 0:
-            logger.warning("Input all 0. Not making any change.")
-            return x
-        elif self.snr_sqrt_reciprocal == 0:
-            return x
+    def _compute_perturbation(self, batch, batch_labels, mask, *args, **kwargs):
+        """
+        Return the loss gradient, masked and then normalized to unit L2 norm
 
-        eps = x_l2 * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
+        ART normalizes before masking. Masking first, as SNR_PGD does, keeps the
+            gradient on padding from shrinking the step of shorter signals.
+        """
+        # Pick a small scalar to avoid division by 0
+        tol = 10e-8
+        grad = self.estimator.loss_gradient(batch, batch_labels) * (
+            1 - 2 * int(self.targeted)
+        )
+        if mask is not None:
+            grad = grad * mask.astype(ART_NUMPY_DTYPE)
+        ind = tuple(range(1, len(batch.shape)))
+        return grad / (np.sqrt(np.sum(np.square(grad), axis=ind, keepdims=True)) + tol)
+
+    def _pgd(self, x, targets, mask, eps, lengths):
+        eps_step = (eps * self.step_fraction).reshape(_sample_shape(x))
+        if self.num_random_init > 0:
+            x_adv = self._random_init(x, mask, eps, lengths)
+        else:
+            x_adv = x.copy()
+        per_sample_mask = mask is not None and mask.ndim == x.ndim
+        # _compute batches by batch_size, but eps is not split into batches
+        for start in range(0, len(x), self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            for _ in range(self.max_iter):
+                x_adv[batch] = self._compute(
+                    x_adv[batch],
+                    x[batch],
+                    targets[batch],
+                    mask[batch] if per_sample_mask else mask,
+                    eps[batch],
+                    eps_step[batch],
+                    self._project,
+                    False,
+                )
+        return x_adv
 
 
-class SNR_PGD(ProjectedGradientDescentPyTorch):
+class SNR_PGD(_SNR_PGDTorch, ProjectedGradientDescentPyTorch):
     """
     Applies L2 PGD to signal based on an SNR bound defined by norm 'snr' or 'snr_db'.
         This is a *lower* bound on allowable SNR (as opposed to L2 upper bound)
@@ -247,32 +611,26 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
 
     If SNR is set to 0 or SNR_DB to -inf, no limit is provided to PGD
         If SNR or SNR_DB is set to inf, no perturbation is performed
+
+    group_by_length - only batch signals with others of the same length, without
+        padding, for estimators whose output depends on input length
     """
 
     def __init__(
-        self, estimator, norm="snr", eps=10, eps_step=0.5, batch_size=1, **kwargs
+        self,
+        estimator,
+        norm="snr",
+        eps=10,
+        eps_step=0.5,
+        batch_size=1,
+        group_by_length=False,
+        **kwargs,
     ):
-        if batch_size != 1:
-            raise NotImplementedError("only batch_size 1 supported")
-        super().__init__(estimator, norm=2, batch_size=1, **kwargs)
+        super().__init__(estimator, norm=2, batch_size=batch_size, **kwargs)
+        self.group_by_length = group_by_length
 
         # Map to SNR domain
-        eps = float(eps)
-        if norm == "snr":
-            snr = eps
-        elif norm == "snr_db":
-            snr = 10 ** (eps / 10)
-        else:
-            raise ValueError(f"norm must be 'snr' (default) or 'snr_db', not {norm}")
-
-        if snr < 0:
-            raise ValueError(f"snr must be nonnegative, not {snr}")
-        elif snr == 0:
-            self.snr_sqrt_reciprocal = np.inf
-        elif snr == np.inf:
-            self.snr_sqrt_reciprocal = 0
-        else:
-            self.snr_sqrt_reciprocal = 1 / np.sqrt(snr)
+        self.snr_sqrt_reciprocal = snr_sqrt_reciprocal(eps, norm)
 
         eps_step = float(eps_step)
 
@@ -280,23 +638,6 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
-        if x.shape[1] == 0:
-            logger.warning("Length 0 signal. Returning original.")
-            return x
-
-        x_l2 = np.linalg.norm(x, ord=2)
-        if x_l2 == 0:
-            logger.warning("Input all 0. Not making any change.")
-            return x
-        elif self.snr_sqrt_reciprocal == 0:
-            return x
-
-        eps = x_l2 * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
-
     def _compute_perturbation(self, x, y, mask):
         """
         Compute perturbations.
@@ -336,7 +677,7 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
         Apply perturbation on examples.
         :param x: Current adversarial examples.
         :param grad: Current gradient.
-        :param eps_step: Attack step size (input variation) at each iteration.
+        :param eps_step: Attack step size of each sample, of shape (n, 1, ..., 1).
         :return: Adversarial examples.
         """
         import torch  # lgtm [py/repeated-import]
@@ -351,14 +692,14 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
             torch.sqrt(torch.sum(grad * grad, axis=ind, keepdims=True)) + tol
         )
         # eps_step > 0, normalization > 0; either could be inf
-        if eps_step == float("inf"):  # ignore normalization
-            perturbation = grad * eps_step
-        else:
-            if not torch.isfinite(normalization).all():
-                logger.warning(
-                    "Some gradient values are infinite. Perturbation will be 0!"
-                )
-            perturbation = grad * eps_step / normalization
+        # eps_step holds the step of each sample, and normalization is ignored
+        # for samples with an infinite step
+        finite_step = torch.isfinite(eps_step)
+        if not torch.isfinite(normalization[finite_step]).all():
+            logger.warning("Some gradient values are infinite. Perturbation will be 0!")
+        perturbation = torch.where(
+            finite_step, grad * eps_step / normalization, grad * eps_step
+        )
         perturbation[torch.isnan(perturbation)] = 0.0
 
         x = x + perturbation
@@ -374,7 +715,7 @@ class SNR_PGD(ProjectedGradientDescentPyTorch):
         return x
 
 
-class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
+class SNR_PGD_Linf(_SNR_PGDTorch, ProjectedGradientDescentPyTorch):
     """
     Applies Linf PGD to signal based on an SNR bound defined by norm 'snr' or 'snr_db'.
 
@@ -386,29 +727,20 @@ class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
     """
 
     def __init__(
-        self, estimator, norm="snr", eps=10, eps_step=0.5, batch_size=1, **kwargs
+        self,
+        estimator,
+        norm="snr",
+        eps=10,
+        eps_step=0.5,
+        batch_size=1,
+        group_by_length=False,
+        **kwargs,
     ):
-        if batch_size != 1:
-            raise NotImplementedError("only batch_size 1 supported")
-        super().__init__(estimator, norm=np.inf, batch_size=1, **kwargs)
+        super().__init__(estimator, norm=np.inf, batch_size=batch_size, **kwargs)
+        self.group_by_length = group_by_length
 
         # Map to SNR domain
-        eps = float(eps)
-        if norm == "snr":
-            snr = eps
-        elif norm == "snr_db":
-            snr = 10 ** (eps / 10)
-        else:
-            raise ValueError(f"norm must be 'snr' (default) or 'snr_db', not {norm}")
-
-        if snr < 0:
-            raise ValueError(f"snr must be nonnegative, not {snr}")
-        elif snr == 0:
-            self.snr_sqrt_reciprocal = np.inf
-        elif snr == np.inf:
-            self.snr_sqrt_reciprocal = 0
-        else:
-            self.snr_sqrt_reciprocal = 1 / np.sqrt(snr)
+        self.snr_sqrt_reciprocal = snr_sqrt_reciprocal(eps, norm)
 
         eps_step = float(eps_step)
 
@@ -416,19 +748,8 @@ class SNR_PGD_Linf(ProjectedGradientDescentPyTorch):
             raise ValueError(f"eps_step must be in (0, 1], not {eps_step}")
         self.step_fraction = eps_step
 
-    def generate(self, x, y=None, **kwargs):
-        if x.shape[1] == 0:
-            logger.warning("Length 0 signal. Returning original.")
-            return x
-
-        x_rms = np.linalg.norm(x, ord=2) / np.sqrt(x.shape[1])
-        if x_rms == 0:
-            logger.warning("Input all 0. Not making any change.")
-            return x
-        elif self.snr_sqrt_reciprocal == 0:
-            return x
-
-        eps = x_rms * self.snr_sqrt_reciprocal
-        eps_step = eps * self.step_fraction
-        self.set_params(eps=eps, eps_step=eps_step)
-        return super().generate(x, y=y, **kwargs)
+    def _signal_scale(self, x, lengths):
+        """
+        Return the RMS of each signal
+        """
+        return super()._signal_scale(x, lengths) / np.sqrt(np.maximum(lengths, 1))
@@ -3,6 +3,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import numpy as np
+from sklearn.utils.extmath import randomized_svd
 
 try:
     from art.defences.detector.poison import (
@@ -29,8 +30,22 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
         "batch_size",
         "eps_multiplier",
         "ub_pct_poison",
+        "svd_solver",
+        "chunk_size",
+        "max_scatter_bytes",
+        "random_state",
     ]
 
+    # Per-class feature matrices with more rows and columns than this use a
+    #     randomized SVD when svd_solver is "auto"
+    RANDOMIZED_SVD_MIN_SIZE = 500
+    # Convergence tolerance and iteration limit of power iteration. The tolerance
+    #     is at least POWER_ITERATION_EPS machine epsilons of the matrix dtype, as
+    #     the change between iterates stalls around one epsilon
+    POWER_ITERATION_TOL = 1e-10
+    POWER_ITERATION_EPS = 100
+    POWER_ITERATION_MAX_ITER = 1000
+
     def __init__(self, classifier, x_train, y_train, **kwargs):
         """
         Create an :class:`.ActivationDefence` object with the provided classifier.
@@ -39,6 +54,10 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
         :param y_train: labels used to train the classifier.
         """
         super(SpectralSignatureDefense, self).__init__(classifier, x_train, y_train)
+        self.svd_solver = "auto"
+        self.chunk_size = 8192
+        self.max_scatter_bytes = 2 ** 30
+        self.random_state = None
         self.set_params(**kwargs)
         self.evaluator = GroundTruthEvaluator()
 
@@ -56,12 +75,13 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
             raise ValueError(
                 "is_clean was not provided while invoking evaluate_defence."
             )
+        labels = SpectralSignatureDefense.sparse_labels(self.y_train)
         is_clean_by_class = SpectralSignatureDefense.split_by_class(
-            is_clean, self.y_train, n_classes
+            is_clean, labels, n_classes
         )
         _, predicted_clean = self.detect_poison()
         predicted_clean_by_class = SpectralSignatureDefense.split_by_class(
-            predicted_clean, self.y_train, n_classes
+            predicted_clean, labels, n_classes
         )
 
         _, conf_matrix_json = self.evaluator.analyze_correctness(
@@ -82,60 +102,196 @@ class SpectralSignatureDefense(PoisonFilteringDefence):
         self.set_params(**kwargs)
 
         n_classes = self.classifier.nb_classes()
-        nb_layers = len(self.classifier.layer_names)
+        labels = SpectralSignatureDefense.sparse_labels(self.y_train)
+        counts = np.bincount(labels, minlength=n_classes)
 
-        features_x_poisoned = self.classifier.get_activations(
-            self.x_train, layer=nb_layers - 1, batch_size=self.batch_size
-        )
+        # The top right singular vector of the centered features of a class is the
+        #     top eigenvector of their scatter matrix about the mean. Scatter
+        #     matrices are accumulated for as many classes at a time as fit in
+        #     max_scatter_bytes, with one pass over the activations per group
+        _, features = next(self._activation_chunks(chunk_size=1))
+        dim = features.shape[1]
+        dtype = self._scatter_dtype(features)
+        group_size = max(1, self.max_scatter_bytes // (dim * dim * dtype.itemsize))
+        rng = np.random.RandomState(self.random_state)
+        means = np.zeros((n_classes, dim))
+        vectors = np.zeros((n_classes, dim))
+        classes = np.flatnonzero(counts)
+        for start in range(0, len(classes), group_size):
+            group = classes[start : start + group_size]
+            shifts, sums, scatter = self._class_scatter(labels, group, dim, dtype)
+            for i, c in enumerate(group):
+                mean = sums[i] / counts[c]
+                scatter[i] -= (counts[c] * np.outer(mean, mean)).astype(dtype)
+                means[c] = shifts[i] + mean
+                vectors[c] = self._top_eigenvector(scatter[i], rng)
+            del scatter
 
-        features_split = SpectralSignatureDefense.split_by_class(
-            features_x_poisoned, self.y_train, n_classes
-        )
-        keep_by_class = []
-        for idx, feature in enumerate(features_split):
-            score = SpectralSignatureDefense.spectral_signature_scores(feature)
-            score_cutoff = np.quantile(
-                score, max(1 - self.eps_multiplier * self.ub_pct_poison, 0.0)
-            )
-            keep_by_class.append(score < score_cutoff)
+        # Last pass: score each sample against the signature of its class
+        scores = np.empty(len(labels))
+        for start, features in self._activation_chunks():
+            end = start + len(features)
+            chunk_labels = labels[start:end]
+            centered = features - means[chunk_labels]
+            scores[start:end] = np.einsum("ij,ij->i", centered, vectors[chunk_labels])
+        scores **= 2
 
-        base_indices_by_class = SpectralSignatureDefense.split_by_class(
-            np.arange(self.y_train.shape[0]), self.y_train, 10
-        )
-        is_clean_lst = np.zeros_like(self.y_train, dtype=np.int)
+        order = np.argsort(labels, kind="stable")
+        keep = np.zeros(len(labels), dtype=bool)
+        quantile = max(1 - self.eps_multiplier * self.ub_pct_poison, 0.0)
+        for indices in np.split(order, np.cumsum(counts)[:-1]):
+            if len(indices):
+                score = scores[indices]
+                keep[indices] = score < np.quantile(score, quantile)
 
-        for keep_booleans, indices in zip(keep_by_class, base_indices_by_class):
-            for keep_boolean, idx in zip(keep_booleans, indices):
-                if keep_boolean:
-                    is_clean_lst[idx] = 1
+        is_clean_lst = keep.astype(int)
 
         return None, is_clean_lst
 
+    def _class_scatter(self, labels, classes, dim, dtype):
+        """
+        :return: (shifts, sums, scatter): for each of classes, the first feature of
+                 the class, and the sum and scatter matrix of its features minus
+                 that shift, which limits cancellation, with scatter in dtype
+        """
+        index = np.full(labels.max(initial=0) + 1, -1)
+        index[classes] = np.arange(len(classes))
+        shifts = np.full((len(classes), dim), np.nan)
+        sums = np.zeros((len(classes), dim))
+        scatter = np.zeros((len(classes), dim, dim), dtype=dtype)
+        for start, features in self._activation_chunks():
+            chunk_index = index[labels[start : start + len(features)]]
+            for i in np.unique(chunk_index[chunk_index >= 0]):
+                class_features = features[chunk_index == i].astype(np.float64)
+                if np.isnan(shifts[i, 0]):
+                    shifts[i] = class_features[0]
+                class_features -= shifts[i]
+                sums[i] += class_features.sum(axis=0)
+                class_features = class_features.astype(dtype, copy=False)
+                scatter[i] += class_features.T @ class_features
+        return shifts, sums, scatter
+
     @staticmethod
-    def spectral_signature_scores(R):
+    def _scatter_dtype(features):
+        """
+        Accumulate scatter matrices of float32 or lower precision features in
+            float32, to halve their memory, and other features in float64
+        """
+        if np.issubdtype(features.dtype, np.floating) and features.itemsize <= 4:
+            return np.dtype(np.float32)
+        return np.dtype(np.float64)
+
+    def _activation_chunks(self, chunk_size=None):
+        """
+        Yield (start index, flattened last layer activations) for chunks of x_train
+        """
+        nb_layers = len(self.classifier.layer_names)
+        chunk_size = chunk_size or self.chunk_size or len(self.x_train)
+        for start in range(0, len(self.x_train), chunk_size):
+            features = self.classifier.get_activations(
+                self.x_train[start : start + chunk_size],
+                layer=nb_layers - 1,
+                batch_size=self.batch_size,
+            )
+            features = np.asarray(features)
+            yield start, features.reshape(len(features), -1)
+
+    def _top_eigenvector(self, matrix, rng=None):
+        """
+        :param matrix: Symmetric positive semi-definite matrix
+        :param rng: np.random.RandomState of the random start of power iteration,
+                    or None for one seeded with random_state
+        :return: Unit eigenvector of its largest eigenvalue, computed with power
+                 iteration from a random start if svd_solver is "randomized", or
+                 "auto" and matrix is large, and otherwise with np.linalg.eigh
+        """
+        svd_solver = self.svd_solver
+        if svd_solver == "auto":
+            if len(matrix) > SpectralSignatureDefense.RANDOMIZED_SVD_MIN_SIZE:
+                svd_solver = "randomized"
+            else:
+                svd_solver = "full"
+        if svd_solver == "full":
+            return np.linalg.eigh(matrix)[1][:, -1]
+        elif svd_solver != "randomized":
+            raise ValueError(f"svd_solver {svd_solver} not in (auto, full, randomized)")
+
+        if rng is None:
+            rng = np.random.RandomState(self.random_state)
+        v = rng.normal(size=len(matrix)).astype(matrix.dtype)
+        v /= np.linalg.norm(v)
+        tol = max(
+            SpectralSignatureDefense.POWER_ITERATION_TOL,
+            SpectralSignatureDefense.POWER_ITERATION_EPS * np.finfo(matrix.dtype).eps,
+        )
+        for _ in range(SpectralSignatureDefense.POWER_ITERATION_MAX_ITER):
+            w = matrix @ v
+            norm = np.linalg.norm(w)
+            if norm == 0:
+                break
+            w /= norm
+            converged = np.linalg.norm(w - v) < tol
+            v = w
+            if converged:
+                break
+        else:
+            logger.warning("Power iteration did not converge")
+        return v
+
+    @staticmethod
+    def spectral_signature_scores(R, svd_solver="full", random_state=None):
         """
         :param R: Matrix of feature representations
+        :param svd_solver: "full" for an exact SVD, "randomized" for a randomized
+                           truncated SVD computing only the top singular vector, or
+                           "auto" for randomized only on large matrices
+        :param random_state: Seed or np.random.RandomState for the randomized SVD
         :return: Outlier scores for each observation based on spectral signature
         """
         M = R - np.mean(R, axis=0)
+        if svd_solver == "auto":
+            if min(M.shape) > SpectralSignatureDefense.RANDOMIZED_SVD_MIN_SIZE:
+                svd_solver = "randomized"
+            else:
+                svd_solver = "full"
         # Following Algorithm #1, use SVD of centered features, not of covariance
-        _, _, v = np.linalg.svd(M, full_matrices=False)
+        if svd_solver == "full":
+            _, _, v = np.linalg.svd(M, full_matrices=False)
+        elif svd_solver == "randomized":
+            _, _, v = randomized_svd(M, n_components=1, random_state=random_state)
+        else:
+            raise ValueError(f"svd_solver {svd_solver} not in (auto, full, randomized)")
         eigs = v[:1]
         score = np.matmul(M, np.transpose(eigs)) ** 2
         return score
 
     @staticmethod
-    def split_by_class(data, labels, num_classes):
+    def sparse_labels(labels):
+        """
+        :param labels: Labels, either sparse or in one-hot representations
+        :return: Sparse integer labels
+        """
+        labels = np.asarray(labels)
+        if labels.ndim == 2:
+            return np.argmax(labels, axis=1)
+        return labels.astype(int, copy=False)
+
+    @staticmethod
+    def split_by_class(data, labels, num_classes, order=None):
         """
-        :param data: Iterable of features
+        :param data: Array of features
         :param labels: Labels, not in one-hot representations
         :param num_classes: Number of classes of labels
+        :param order: Optional precomputed stable argsort of labels
         :return: List of numpy arrays of features split by labels
         """
-        split = [[] for _ in range(num_classes)]
-        for idx, label in enumerate(labels):
-            split[int(label)].append(data[idx])
-        return [np.asarray(dat) for dat in split]
+        labels = np.asarray(labels)
+        if order is None:
+            order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=num_classes)
+        if len(counts) > num_classes:
+            raise ValueError(f"labels must be less than num_classes {num_classes}")
+        return np.split(np.asarray(data)[order], np.cumsum(counts)[:-1])
 
     def set_params(self, **kwargs):
         """
@@ -8,10 +8,13 @@ data is found at '<dataset_dir>/cifar10'
 The 'downloads' subdirectory under <dataset_dir> is reserved for caching.
 """
 
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import json
 import os
+import queue
 import re
+import threading
 from typing import Callable, Union
 
 import numpy as np
@@ -28,11 +31,13 @@ import apache_beam as beam
 from art.data_generators import DataGenerator
 
 from armory.data.utils import (
+    dataset_extracted,
     download_verify_dataset_cache,
     _read_validate_scenario_config,
     add_checksums_dir,
 )
 from armory import paths
+from armory.utils import instrumentation
 from armory.data.librispeech import librispeech_dev_clean_split  # noqa: F401
 from armory.data.librispeech import librispeech_full as lf  # noqa: F401
 from armory.data.resisc45 import resisc45_split  # noqa: F401
@@ -70,6 +75,7 @@ class ArmoryDataGenerator(DataGenerator):
         variable_length=False,
         variable_y=False,
         context=None,
+        skip_source=None,
     ):
         super().__init__(size, batch_size)
         self.preprocessing_fn = preprocessing_fn
@@ -92,6 +98,11 @@ class ArmoryDataGenerator(DataGenerator):
             raise NotImplementedError("variable_y=True requires variable_length=True")
 
         self.context = context
+        self._skip_source = skip_source
+        self.prefetch_batches = 0
+        self.prefetch_workers = 1
+        self._prefetcher = None
+        self._cache_writer = None
 
     @staticmethod
     def np_1D_object_array(x_list):
@@ -105,7 +116,114 @@ class ArmoryDataGenerator(DataGenerator):
             x[i] = x_list[i][0]
         return x
 
+    def set_prefetch(self, num_batches, num_workers=1):
+        """
+        Assemble and preprocess up to num_batches batches ahead of get_batch calls
+
+        Batches are assembled from the underlying generator in a background thread,
+            in order, and preprocessed by a pool of num_workers threads.
+        num_batches of 0 disables prefetching.
+        """
+        if not isinstance(num_batches, int) or num_batches < 0:
+            raise ValueError(f"num_batches {num_batches} must be a nonnegative int")
+        if not isinstance(num_workers, int) or num_workers < 1:
+            raise ValueError(f"num_workers {num_workers} must be a positive int")
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        self.prefetch_batches = num_batches
+        self.prefetch_workers = num_workers
+
+    def set_cache_writer(self, cache_writer):
+        """
+        Pass each batch returned by get_batch to cache_writer.write(x, y)
+
+        cache_writer.finalize() is called once the generator is exhausted, and
+            cache_writer.abort() if iteration is stopped early by close.
+        """
+        self._cache_writer = cache_writer
+
+    def skip(self, num_batches):
+        """
+        Skip the next num_batches batches without preprocessing them
+
+        If no batches have been read and the generator was given a skip_source, the
+            underlying generator is replaced with skip_source(num_examples), which
+            starts after the skipped examples, so they are not read at all.
+            Otherwise, the skipped batches are read and discarded.
+        """
+        if self._cache_writer is not None:
+            # The cache would be missing the skipped batches
+            self._cache_writer.abort()
+            self._cache_writer = None
+        if self._skip_source is not None:
+            num_examples = num_batches * self.batch_size
+            try:
+                self.generator = self._skip_source(num_examples)
+            except ValueError as e:
+                logger.info(f"Reading and discarding skipped batches: {e}")
+            else:
+                self._skip_source = None
+                if self.variable_length:
+                    self.current = num_examples
+                return
+        try:
+            for _ in range(num_batches):
+                if self._prefetcher is not None:
+                    self._prefetcher.get()
+                else:
+                    self._assemble_batch()
+        except StopIteration:
+            pass
+
+    def close(self):
+        """
+        Stop any background prefetching and discard any partially written cache
+
+        Batches already assembled but not yet returned by get_batch are discarded.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        if self._cache_writer is not None:
+            self._cache_writer.abort()
+            self._cache_writer = None
+
     def get_batch(self) -> (np.ndarray, np.ndarray):
+        with instrumentation.span("data load"):
+            return self._get_batch()
+
+    def _get_batch(self):
+        try:
+            if self.prefetch_batches:
+                if self._prefetcher is None:
+                    self._prefetcher = BatchPrefetcher(
+                        self._assemble_batch,
+                        self._preprocess_batch,
+                        self.prefetch_batches,
+                        num_workers=self.prefetch_workers,
+                    )
+                x, y = self._prefetcher.get()
+            else:
+                x, y = self._preprocess_batch(*self._assemble_batch())
+        except StopIteration:
+            if self._cache_writer is not None:
+                self._cache_writer.finalize()
+                self._cache_writer = None
+            raise
+
+        if self._cache_writer is not None:
+            try:
+                self._cache_writer.write(x, y)
+            except TypeError as e:
+                logger.warning(f"Not caching dataset: {e}")
+                self._cache_writer.abort()
+                self._cache_writer = None
+        return x, y
+
+    def _assemble_batch(self):
+        # Once batches are read, skip_source no longer starts after them
+        self._skip_source = None
         if self.variable_length:
             # build the batch
             x_list, y_list = [], []
@@ -150,18 +268,21 @@ class ArmoryDataGenerator(DataGenerator):
                     y = np.hstack(y_list)
         else:
             x, y = next(self.generator)
+        return x, y
 
-        if self.label_preprocessing_fn:
-            y = self.label_preprocessing_fn(x, y)
-
-        if self.preprocessing_fn:
-            # Apply preprocessing to multiple inputs as needed
-            if isinstance(x, dict):
-                x = {k: self.preprocessing_fn(v) for (k, v) in x.items()}
-            elif isinstance(x, tuple):
-                x = tuple(self.preprocessing_fn(i) for i in x)
-            else:
-                x = self.preprocessing_fn(x)
+    def _preprocess_batch(self, x, y):
+        with instrumentation.span("preprocessing"):
+            if self.label_preprocessing_fn:
+                y = self.label_preprocessing_fn(x, y)
+
+            if self.preprocessing_fn:
+                # Apply preprocessing to multiple inputs as needed
+                if isinstance(x, dict):
+                    x = {k: self.preprocessing_fn(v) for (k, v) in x.items()}
+                elif isinstance(x, tuple):
+                    x = tuple(self.preprocessing_fn(i) for i in x)
+                else:
+                    x = self.preprocessing_fn(x)
         return x, y
 
     def __iter__(self):
@@ -174,6 +295,78 @@ class ArmoryDataGenerator(DataGenerator):
         return self.batches_per_epoch * self.epochs
 
 
+class BatchPrefetcher:
+    """
+    Runs assemble_fn and preprocess_fn ahead of the consumer, preserving order
+
+    assemble_fn() is called sequentially from a single background thread, as the
+        underlying generators are not thread safe. Its output is passed to
+        preprocess_fn(x, y) on a pool of num_workers threads. At most num_batches
+        batches are held in the queue at a time.
+    Exceptions raised by either function (including StopIteration at the end of
+        the generator) are re-raised by get in the order they occurred.
+    """
+
+    def __init__(self, assemble_fn, preprocess_fn, num_batches, num_workers=1):
+        if num_batches < 1:
+            raise ValueError(f"num_batches {num_batches} must be a positive int")
+        self.assemble_fn = assemble_fn
+        self.preprocess_fn = preprocess_fn
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stop = threading.Event()
+        self.exhausted = None
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, future):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(future, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        future.cancel()
+        return False
+
+    def _produce(self):
+        while not self.stop.is_set():
+            try:
+                x, y = self.assemble_fn()
+            except BaseException as e:
+                # Includes StopIteration, which ends production
+                future = Future()
+                future.set_exception(e)
+                future.final = True
+                self._put(future)
+                return
+            if not self._put(self.executor.submit(self.preprocess_fn, x, y)):
+                return
+
+    def get(self):
+        if self.exhausted is not None:
+            raise self.exhausted
+        future = self.queue.get()
+        try:
+            return future.result()
+        except BaseException as e:
+            # The producer stops after the first assembly error
+            if getattr(future, "final", False):
+                self.exhausted = e
+                self.close()
+            raise
+
+    def close(self):
+        self.stop.set()
+        while True:
+            try:
+                self.queue.get_nowait().cancel()
+            except queue.Empty:
+                break
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+
 class EvalGenerator(DataGenerator):
     """
     Wraps a specified number of batches in a DataGenerator to allow for evaluating on
@@ -194,11 +387,20 @@ class EvalGenerator(DataGenerator):
 
     def get_batch(self) -> (np.ndarray, np.ndarray):
         if self.batches_processed == self.num_eval_batches:
+            self.armory_generator.close()
             raise StopIteration()
         batch = self.armory_generator.get_batch()
         self.batches_processed += 1
         return batch
 
+    def skip(self, num_batches):
+        """
+        Skip the next num_batches evaluation batches without preprocessing them
+        """
+        num_batches = min(num_batches, self.num_eval_batches - self.batches_processed)
+        self.armory_generator.skip(num_batches)
+        self.batches_processed += num_batches
+
     def __iter__(self):
         return self
 
@@ -269,6 +471,132 @@ def parse_split_index(split: str):
     return "+".join(output_tokens)
 
 
+def shard_split(split: str, num_examples: int, index: int, num_shards: int) -> str:
+    """
+    Return a TFDS split of the index-th of num_shards contiguous, disjoint slices of
+        split, which has num_examples examples. Only plain splits and absolute slices
+        with nonnegative bounds can be sharded:
+        shard_split("test", 10, 1, 3) --> "test[3:6]"
+        shard_split("test[10:20]", 10, 2, 3) --> "test[16:20]"
+    """
+    if not isinstance(index, int) or not isinstance(num_shards, int):
+        raise ValueError(f"index {index} and num_shards {num_shards} must be ints")
+    if not 0 <= index < num_shards:
+        raise ValueError(f"index {index} not in [0, {num_shards})")
+    name, start = _parse_slice_start(split, "sharded")
+    shard_start = start + num_examples * index // num_shards
+    shard_stop = start + num_examples * (index + 1) // num_shards
+    if shard_start == shard_stop:
+        raise ValueError(
+            f"shard {index} of {num_shards} of split {split} with {num_examples} "
+            "examples is empty"
+        )
+    return f"{name}[{shard_start}:{shard_stop}]"
+
+
+def offset_split(split: str, num_examples: int, offset: int) -> str:
+    """
+    Return a TFDS split of split, which has num_examples examples, without its first
+        offset examples. Only plain splits and absolute slices with nonnegative
+        bounds can be offset:
+        offset_split("test", 10, 4) --> "test[4:10]"
+        offset_split("test[10:20]", 10, 4) --> "test[14:20]"
+    """
+    if not isinstance(offset, int) or not 0 <= offset < num_examples:
+        raise ValueError(f"offset {offset} not in [0, {num_examples})")
+    name, start = _parse_slice_start(split, "offset")
+    return f"{name}[{start + offset}:{start + num_examples}]"
+
+
+def _parse_slice_start(split, operation):
+    """
+    Return the name and start index of a plain split or an absolute slice
+    """
+    match = re.fullmatch(r"\s*(\w+)\s*(?:\[(\d*):(\d*)\])?\s*", split)
+    if match is None:
+        raise ValueError(
+            f"split {split} cannot be {operation}. Use a split name or an absolute "
+            "slice"
+        )
+    return match.group(1), int(match.group(2) or 0)
+
+
+class TFDSBatches:
+    """
+    Picklable factory of the batched tf.data.Dataset of a TFDS split
+
+    Calling it loads the split, or the given split, with tfds.load and applies the
+        batching pipeline of _generator_from_tfds. With a tf.distribute.InputContext,
+        only the subset of files of that input pipeline is read.
+    It only holds the arguments of tfds.load and of the pipeline, so it can be
+        pickled to DataLoader worker processes that load the dataset themselves,
+        provided that lambda_map is a module-level function.
+    """
+
+    def __init__(
+        self,
+        dataset_name,
+        split,
+        dataset_dir,
+        epochs,
+        batch_size,
+        as_supervised=True,
+        supervised_xy_keys=None,
+        download_and_prepare_kwargs=None,
+        variable_length=False,
+        shuffle_files=True,
+        lambda_map=None,
+    ):
+        self.dataset_name = dataset_name
+        self.split = split
+        self.dataset_dir = dataset_dir
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.as_supervised = as_supervised
+        self.supervised_xy_keys = supervised_xy_keys
+        self.download_and_prepare_kwargs = download_and_prepare_kwargs
+        self.variable_length = variable_length
+        self.shuffle_files = shuffle_files
+        self.lambda_map = lambda_map
+
+    def __call__(self, input_context=None, split=None):
+        read_config = None
+        if input_context is not None:
+            read_config = tfds.ReadConfig(input_context=input_context)
+        ds = tfds.load(
+            self.dataset_name,
+            split=self.split if split is None else split,
+            as_supervised=self.as_supervised,
+            data_dir=self.dataset_dir,
+            download_and_prepare_kwargs=self.download_and_prepare_kwargs,
+            shuffle_files=self.shuffle_files,
+            read_config=read_config,
+        )
+        return self.pipeline(ds)
+
+    def pipeline(self, ds):
+        """
+        Return ds, as loaded by tfds.load, mapped, repeated, shuffled, and batched
+        """
+        if not self.as_supervised:
+            x_key, y_key = self.supervised_xy_keys
+            if isinstance(x_key, tuple):
+                ds = ds.map(lambda x: (tuple(x[k] for k in x_key), x[y_key]))
+            else:
+                ds = ds.map(lambda x: (x[x_key], x[y_key]))
+        if self.lambda_map is not None:
+            ds = ds.map(self.lambda_map)
+
+        ds = ds.repeat(self.epochs)
+        if self.shuffle_files:
+            ds = ds.shuffle(self.batch_size * 10, reshuffle_each_iteration=True)
+        if self.variable_length and self.batch_size > 1:
+            ds = ds.batch(1, drop_remainder=False)
+        else:
+            ds = ds.batch(self.batch_size, drop_remainder=False)
+        return ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def _generator_from_tfds(
     dataset_name: str,
     split: str,
@@ -357,20 +685,21 @@ def _generator_from_tfds(
                     raise ValueError(
                         "supervised_xy_keys must be a tuple of strings, or for x_key only, a tuple of tuple of strings"
                     )
-            ds = ds.map(lambda x: (tuple(x[k] for k in x_key), x[y_key]))
-        else:
-            ds = ds.map(lambda x: (x[x_key], x[y_key]))
-    if lambda_map is not None:
-        ds = ds.map(lambda_map)
-
-    ds = ds.repeat(epochs)
-    if shuffle_files:
-        ds = ds.shuffle(batch_size * 10, reshuffle_each_iteration=True)
-    if variable_length and batch_size > 1:
-        ds = ds.batch(1, drop_remainder=False)
-    else:
-        ds = ds.batch(batch_size, drop_remainder=False)
-    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    batches = TFDSBatches(
+        dataset_name,
+        split,
+        dataset_dir,
+        epochs,
+        batch_size,
+        as_supervised=as_supervised,
+        supervised_xy_keys=supervised_xy_keys,
+        download_and_prepare_kwargs=download_and_prepare_kwargs,
+        variable_length=variable_length,
+        shuffle_files=shuffle_files,
+        lambda_map=lambda_map,
+    )
+    ds = batches.pipeline(ds)
 
     if framework != "numpy" and (
         preprocessing_fn is not None or label_preprocessing_fn is not None
@@ -380,6 +709,19 @@ def _generator_from_tfds(
         )
 
     if framework == "numpy":
+
+        def skip_source(num_examples):
+            """
+            Return the batches after the first num_examples examples, read from a
+                later slice of the split, so that skipped examples are not decoded
+            """
+            if epochs != 1 or shuffle_files:
+                raise ValueError("only one unshuffled epoch can be sliced")
+            skipped_split = offset_split(
+                split, ds_info.splits[split].num_examples, num_examples
+            )
+            return tfds.as_numpy(batches(split=skipped_split), graph=default_graph)
+
         ds = tfds.as_numpy(ds, graph=default_graph)
         generator = ArmoryDataGenerator(
             ds,
@@ -391,16 +733,14 @@ def _generator_from_tfds(
             variable_length=bool(variable_length and batch_size > 1),
             variable_y=bool(variable_y and batch_size > 1),
             context=context,
+            skip_source=skip_source,
         )
 
     elif framework == "tf":
         generator = ds
 
     elif framework == "pytorch":
-        torch_ds = _get_pytorch_dataset(ds)
-        generator = torch.utils.data.DataLoader(
-            torch_ds, batch_size=None, collate_fn=lambda x: x, num_workers=0
-        )
+        generator = _get_pytorch_dataloader(batches)
 
     else:
         raise ValueError(
@@ -1197,7 +1537,9 @@ def so2sat_concat_map(x, y):
 def _cache_dataset(dataset_dir: str, dataset_name: str):
     name, subpath = _parse_dataset_name(dataset_name)
 
-    if not os.path.isdir(os.path.join(dataset_dir, name, subpath)):
+    # dataset_extracted is None for datasets extracted by older versions of armory
+    interrupted = dataset_extracted(dataset_dir, name) is False
+    if interrupted or not os.path.isdir(os.path.join(dataset_dir, name, subpath)):
         download_verify_dataset_cache(
             dataset_dir=dataset_dir, checksum_file=name + ".txt", name=name,
         )
@@ -1286,9 +1628,9 @@ def _download_data(dataset_name):
         logger.exception(f"Loading dataset {dataset_name} failed.")
 
 
-def _get_pytorch_dataset(ds):
+def _get_pytorch_dataloader(make_dataset):
     import armory.data.pytorch_loader as ptl
 
-    ds = ptl.TFToTorchGenerator(ds)
+    ds = ptl.TFToTorchGenerator(make_dataset=make_dataset)
 
-    return ds
+    return ptl.make_dataloader(ds)
@@ -0,0 +1,200 @@
+"""
+Batched NumPy image operations
+
+These reproduce the PIL operations previously applied one image at a time
+    (ImageOps.equalize, Image.crop, and Image.resize with the default bicubic
+    filter), including PIL's 8-bit fixed-point arithmetic, so that results match
+    the PIL path while running over whole batches.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+
+import numpy as np
+
+# PIL ImagingResample fixed-point precision for 8-bit images
+PRECISION_BITS = 32 - 8 - 2
+
+# Minimum number of images per thread when splitting a batch across workers
+MIN_IMAGES_PER_WORKER = 64
+
+
+def equalize_luts(images) -> np.ndarray:
+    """
+    Return (len(images), channels, 256) uint8 lookup tables equalizing each channel
+
+    images is a sequence of uint8 arrays of shape (height, width, channels), which
+        may differ in height and width. The histograms of all images are computed
+        with a single bincount. Matches PIL.ImageOps.equalize.
+    """
+    channels = images[0].shape[-1]
+    pixels = np.concatenate([im.reshape(-1, channels) for im in images])
+    counts = [im.size // channels for im in images]
+    # Offset values so each (image, channel) pair has its own 256 bins
+    offsets = np.repeat(np.arange(len(images), dtype=np.int32) * channels, counts)
+    values = (offsets[:, None] + np.arange(channels, dtype=np.int32)) * 256
+    values += pixels
+    hist = np.bincount(values.ravel(), minlength=len(images) * channels * 256)
+    hist = hist.reshape(len(images), channels, 256)
+
+    # PIL uses the count excluding the last nonzero bin, divided into 255 steps
+    last = 255 - np.argmax(hist[..., ::-1] > 0, axis=-1)
+    last_count = np.take_along_axis(hist, last[..., None], axis=-1)[..., 0]
+    step = (hist.sum(axis=-1) - last_count) // 255
+
+    cumulative = np.cumsum(hist, axis=-1) - hist
+    safe_step = np.maximum(step, 1)[..., None]
+    luts = (safe_step // 2 + cumulative) // safe_step
+    identity = np.broadcast_to(np.arange(256), luts.shape)
+    # A step of zero also covers images with at most one distinct value
+    luts = np.where((step == 0)[..., None], identity, luts)
+    return np.clip(luts, 0, 255).astype(np.uint8)
+
+
+def _bicubic_filter(x):
+    a = -0.5
+    x = np.abs(x)
+    return np.where(
+        x < 1.0,
+        ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+        np.where(x < 2.0, (((x - 5) * x + 8) * x - 4) * a, 0.0),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def resize_taps(in_size: int, out_size: int):
+    """
+    Return (out_size, taps) input indices and fixed-point bicubic weights
+
+    Follows PIL's precompute_coeffs, including antialiasing when downsampling.
+        Each output pixel is a weighted sum of a window of input pixels. Windows
+        are padded to a common number of taps with zero weights.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 2.0 * filterscale
+    taps = int(np.ceil(support)) * 2 + 1
+
+    indices = np.zeros((out_size, taps), dtype=np.intp)
+    weights = np.zeros((out_size, taps))
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        x = np.arange(xmin, xmax)
+        k = _bicubic_filter((x - center + 0.5) / filterscale)
+        total = k.sum()
+        if total != 0:
+            k = k / total
+        indices[xx, : len(x)] = x
+        weights[xx, : len(x)] = k
+
+    weights *= 1 << PRECISION_BITS
+    weights = np.where(weights < 0, np.ceil(weights - 0.5), np.floor(weights + 0.5))
+    weights = weights.astype(np.int32)
+    indices.flags.writeable = False
+    weights.flags.writeable = False
+    return indices, weights
+
+
+def _resample(x, out_size):
+    """
+    Resample the first axis of integer array x, rounding and clipping like PIL
+
+    Resampling the first axis gathers whole contiguous slices for each tap.
+    """
+    indices, weights = resize_taps(len(x), out_size)
+    shape = (out_size,) + x.shape[1:]
+    total = np.full(shape, 1 << (PRECISION_BITS - 1), np.int32)
+    product = np.empty(shape, np.int32)
+    weights = weights.reshape(weights.shape + (1,) * (x.ndim - 1))
+    for k in range(indices.shape[1]):
+        np.multiply(x.take(indices[:, k], axis=0), weights[:, k], out=product)
+        total += product
+    total >>= PRECISION_BITS
+    return np.clip(total, 0, 255, out=total)
+
+
+def resize(images: np.ndarray, size) -> np.ndarray:
+    """
+    Bicubic resize of uint8 images of shape (batch, height, width, channels)
+
+    size is (height, width). As in PIL, the horizontal pass runs first, the result
+        of each pass is rounded to uint8, and a pass is skipped when that dimension
+        is unchanged.
+    """
+    height, width = size
+    # (width, height, batch, channels)
+    x = np.ascontiguousarray(images.transpose(2, 1, 0, 3), dtype=np.int32)
+    if len(x) != width:
+        x = _resample(x, width)
+    x = x.swapaxes(0, 1)
+    if len(x) != height:
+        x = _resample(np.ascontiguousarray(x), height)
+    return x.astype(np.uint8).transpose(2, 0, 1, 3)
+
+
+def center_crop_box(height: int, width: int):
+    """
+    Return (top, bottom, left, right) of the centered square crop of an image
+
+    As in the previous PIL code, odd sides lose their last row or column.
+    """
+    min_side = min(height, width)
+    top = height // 2 - min_side // 2
+    left = width // 2 - min_side // 2
+    return top, height // 2 + min_side // 2, left, width // 2 + min_side // 2
+
+
+def _equalize_crop_resize(images, size):
+    luts = equalize_luts(images)
+    groups = {}
+    for i, im in enumerate(images):
+        top, bottom, left, right = center_crop_box(*im.shape[:2])
+        groups.setdefault((bottom - top, right - left), []).append(i)
+
+    channels = images[0].shape[-1]
+    out = np.empty((len(images),) + tuple(size) + (channels,), np.uint8)
+    for indices in groups.values():
+        crops = []
+        for i in indices:
+            top, bottom, left, right = center_crop_box(*images[i].shape[:2])
+            crops.append(images[i][top:bottom, left:right])
+        # Equalize the cropped pixels through the flattened tables of the group
+        offsets = np.arange(len(indices) * channels, dtype=np.int32) * 256
+        offsets = offsets.reshape(len(indices), 1, 1, channels)
+        crops = luts[indices].ravel().take(np.stack(crops) + offsets)
+        out[indices] = resize(crops, size)
+    return out
+
+
+def equalize_crop_resize(batch, size=(48, 48), num_workers=1) -> np.ndarray:
+    """
+    Histogram equalize, center crop, and resize a batch of uint8 RGB images
+
+    batch is an array or sequence of (height, width, channels) images, which may
+        differ in height and width. Returns a uint8 array of shape
+        (len(batch), size[0], size[1], channels).
+
+    Images with the same crop size are resized together. When num_workers > 1,
+        large batches are split into chunks processed on a thread pool. If
+        num_workers is None, one thread per CPU is used.
+    """
+    images = [np.asarray(im, dtype=np.uint8) for im in batch]
+    if not images:
+        return np.empty((0,) + tuple(size) + (3,), np.uint8)
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(images) // MIN_IMAGES_PER_WORKER)
+    if num_workers <= 1:
+        return _equalize_crop_resize(images, size)
+
+    chunks = np.array_split(np.arange(len(images)), num_workers)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        results = pool.map(
+            lambda chunk: _equalize_crop_resize([images[i] for i in chunk], size),
+            chunks,
+        )
+        return np.concatenate(list(results))
@@ -0,0 +1,359 @@
+"""
+On-disk cache of preprocessed ArmoryDataGenerator batches
+
+Batches are stored after preprocessing, so repeated evaluations of the same dataset
+    configuration skip TFRecord decoding and preprocessing entirely.
+
+Each cache entry is a directory named by a content hash of the dataset function,
+    its arguments, and the preprocessing functions (including their code and the
+    code and state they reach outside of installed libraries). It holds
+    one flat binary file per dtype and an index.json that records, for each batch,
+    the structure of (x, y) and the offset and shape of every array. Cached arrays
+    are loaded as copy-on-write memory-mapped views, without copying.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import sysconfig
+import types
+
+import numpy as np
+
+from armory.data.datasets import ArmoryDataGenerator
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+CACHE_VERSION = 3
+
+# Code under these paths is only described by name, so upgrading the standard library
+#     or an installed package, other than armory, does not change cache keys
+_LIBRARY_PATHS = tuple(
+    sorted(
+        {
+            os.path.abspath(sysconfig.get_paths()[name])
+            for name in ("stdlib", "platstdlib", "purelib", "platlib")
+        }
+    )
+)
+
+
+def _is_library(module_name):
+    """
+    Return whether module_name is part of the standard library or an installed
+        package other than armory
+    """
+    if module_name == "__main__" or module_name.split(".")[0] == "armory":
+        return False
+    filepath = getattr(sys.modules.get(module_name), "__file__", None)
+    return filepath is None or os.path.abspath(filepath).startswith(_LIBRARY_PATHS)
+
+
+class _ModuleAttributes:
+    """
+    The attributes named in names of a module referenced by a function
+
+    Only the attributes a function can reach by name are described, e.g.,
+        equalize_crop_resize of image_ops for image_ops.equalize_crop_resize(x)
+    """
+
+    def __init__(self, module, names):
+        self.module = module
+        self.names = names
+
+
+def _update_hash(h, obj, seen):
+    """
+    Recursively feed a description of obj into hash h that is stable across processes
+
+    Functions are described by their code, defaults, closures, and the globals
+        they reference, including the attributes they reference of modules outside
+        of installed libraries, so that editing a preprocessing function or a
+        helper it calls changes the hash. Other objects are described by their
+        type and, for classes outside of installed libraries, by their __call__
+        method and the attributes in their __dict__. Modules and objects of
+        installed libraries are only described by name and type, as their
+        attributes may hold process-specific state, such as locks and addresses.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, np.ndarray):
+        h.update(f"ndarray:{obj.dtype.str}:{obj.shape};".encode())
+        if obj.dtype == object:
+            for item in obj.flat:
+                _update_hash(h, item, seen)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        h.update(f"{obj.dtype.str}:{obj!r};".encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}:{len(obj)};".encode())
+        for item in obj:
+            _update_hash(h, item, seen)
+    elif isinstance(obj, dict):
+        h.update(f"dict:{len(obj)};".encode())
+        for key in sorted(obj, key=_digest):
+            _update_hash(h, key, seen)
+            _update_hash(h, obj[key], seen)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(f"set:{len(obj)};".encode())
+        for digest in sorted(_digest(item) for item in obj):
+            h.update(digest.encode())
+    elif isinstance(obj, types.ModuleType):
+        h.update(f"module:{obj.__name__};".encode())
+    elif isinstance(obj, (type, types.BuiltinFunctionType)):
+        name = f"{obj.__module__}.{obj.__qualname__}"
+        h.update(f"{type(obj).__name__}:{name};".encode())
+    elif isinstance(obj, _ModuleAttributes):
+        h.update(f"module:{obj.module.__name__};".encode())
+        key = (id(obj.module), obj.names)
+        if key in seen or _is_library(obj.module.__name__):
+            return
+        seen.add(key)
+        attributes = {}
+        for name in sorted(obj.names):
+            if name in vars(obj.module):
+                attributes[name] = _reference(vars(obj.module)[name], obj.names)
+        _update_hash(h, attributes, seen)
+    elif id(obj) in seen:
+        h.update(b"recursive;")
+    elif isinstance(obj, types.CodeType):
+        seen.add(id(obj))
+        h.update(obj.co_code)
+        _update_hash(h, obj.co_consts, seen)
+        _update_hash(h, obj.co_names, seen)
+    elif isinstance(obj, types.FunctionType):
+        seen.add(id(obj))
+        h.update(f"function:{obj.__module__}.{obj.__qualname__};".encode())
+        _update_hash(h, obj.__code__, seen)
+        _update_hash(h, obj.__defaults__, seen)
+        _update_hash(h, obj.__kwdefaults__, seen)
+        names = frozenset(_code_names(obj.__code__))
+        cells = obj.__closure__ or ()
+        _update_hash(h, [_reference(cell.cell_contents, names) for cell in cells], seen)
+        referenced = {
+            name: _reference(obj.__globals__[name], names)
+            for name in names
+            if name in obj.__globals__
+        }
+        _update_hash(h, referenced, seen)
+    elif isinstance(obj, types.MethodType):
+        seen.add(id(obj))
+        _update_hash(h, obj.__func__, seen)
+        _update_hash(h, obj.__self__, seen)
+    elif isinstance(obj, functools.partial):
+        seen.add(id(obj))
+        _update_hash(h, obj.func, seen)
+        _update_hash(h, obj.args, seen)
+        _update_hash(h, obj.keywords, seen)
+    else:
+        seen.add(id(obj))
+        cls = type(obj)
+        h.update(f"object:{cls.__module__}.{cls.__qualname__};".encode())
+        if not _is_library(cls.__module__):
+            call = getattr(cls, "__call__", None)
+            if isinstance(call, types.FunctionType):
+                _update_hash(h, call, seen)
+            _update_hash(h, getattr(obj, "__dict__", None), seen)
+
+
+def _reference(obj, names):
+    """
+    Return what a function that references obj with global names can reach of it
+    """
+    if isinstance(obj, types.ModuleType):
+        return _ModuleAttributes(obj, names)
+    return obj
+
+
+def _digest(obj):
+    h = hashlib.sha256()
+    _update_hash(h, obj, set())
+    return h.hexdigest()
+
+
+def _code_names(code):
+    """
+    Return the global names referenced by code, including nested code objects
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def cache_key(*objects) -> str:
+    """
+    Return a hex digest that identifies the given objects, including function code
+
+    The digest is the same in every process. Objects of installed libraries are
+        only described by type, so their relevant attributes should be passed as
+        dicts, and code of installed libraries is not tracked.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, [CACHE_VERSION, objects], set())
+    return h.hexdigest()
+
+
+class PreprocessedCacheWriter:
+    """
+    Writes the batches returned by an ArmoryDataGenerator to a cache entry
+
+    Data is written to a temporary directory, which is moved into place by
+        finalize once the generator is exhausted. abort discards a partial entry.
+    """
+
+    def __init__(self, path, size, epochs, batch_size):
+        self.path = path
+        self.tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.index = {
+            "version": CACHE_VERSION,
+            "size": size,
+            "epochs": epochs,
+            "batch_size": batch_size,
+            "dtypes": [],
+            "batches": [],
+        }
+        self.files = {}
+        self.lengths = []
+
+    def _write_array(self, array):
+        dtype = array.dtype.str
+        if dtype not in self.files:
+            self.index["dtypes"].append(dtype)
+            filename = os.path.join(self.tmp_path, f"data_{len(self.files)}.bin")
+            self.files[dtype] = open(filename, "wb")
+            self.lengths.append(0)
+        file_id = self.index["dtypes"].index(dtype)
+        offset = self.lengths[file_id]
+        np.ascontiguousarray(array).tofile(self.files[dtype])
+        self.lengths[file_id] += array.size
+        return {"array": [file_id, offset, list(array.shape)]}
+
+    def _encode(self, obj):
+        if isinstance(obj, np.ndarray):
+            if obj.dtype == object:
+                return {
+                    "objects": [self._encode(item) for item in obj.flat],
+                    "shape": list(obj.shape),
+                }
+            return self._write_array(obj)
+        elif isinstance(obj, dict):
+            if not all(isinstance(k, str) for k in obj):
+                raise TypeError(f"dict keys must be str, not {list(obj)}")
+            return {"dict": {k: self._encode(v) for k, v in obj.items()}}
+        elif isinstance(obj, tuple):
+            return {"tuple": [self._encode(item) for item in obj]}
+        elif isinstance(obj, list):
+            return {"list": [self._encode(item) for item in obj]}
+        elif isinstance(obj, bytes):
+            # tfds returns string features as object arrays of bytes
+            return {"bytes": obj.decode("latin-1")}
+        elif isinstance(obj, str):
+            return {"str": obj}
+        raise TypeError(f"Cannot cache object of type {type(obj)}")
+
+    def write(self, x, y):
+        self.index["batches"].append([self._encode(x), self._encode(y)])
+
+    def finalize(self):
+        for f in self.files.values():
+            f.close()
+        self.index["lengths"] = self.lengths
+        with open(os.path.join(self.tmp_path, INDEX_FILE), "w") as f:
+            json.dump(self.index, f)
+        try:
+            os.replace(self.tmp_path, self.path)
+        except OSError:
+            # Another process completed the same entry first
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        else:
+            logger.info(f"Saved preprocessed dataset cache to {self.path}")
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def _decode(spec, memmaps):
+    if "array" in spec:
+        file_id, offset, shape = spec["array"]
+        size = int(np.prod(shape, dtype=np.int64))
+        return memmaps[file_id][offset : offset + size].reshape(shape)
+    elif "objects" in spec:
+        items = spec["objects"]
+        obj = np.empty((len(items),), dtype=object)
+        for i, item in enumerate(items):
+            obj[i] = _decode(item, memmaps)
+        return obj.reshape(spec["shape"])
+    elif "dict" in spec:
+        return {k: _decode(v, memmaps) for k, v in spec["dict"].items()}
+    elif "tuple" in spec:
+        return tuple(_decode(item, memmaps) for item in spec["tuple"])
+    elif "list" in spec:
+        return [_decode(item, memmaps) for item in spec["list"]]
+    elif "bytes" in spec:
+        return spec["bytes"].encode("latin-1")
+    elif "str" in spec:
+        return spec["str"]
+    raise ValueError(f"Unrecognized cache spec {spec}")
+
+
+def load(path, context=None) -> ArmoryDataGenerator:
+    """
+    Return an ArmoryDataGenerator over the batches in cache entry path
+    """
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    if index["version"] != CACHE_VERSION:
+        raise ValueError(f"cache version {index['version']} != {CACHE_VERSION}")
+
+    memmaps = []
+    for i, (dtype, length) in enumerate(zip(index["dtypes"], index["lengths"])):
+        if length:
+            filename = os.path.join(path, f"data_{i}.bin")
+            memmaps.append(np.memmap(filename, dtype=dtype, mode="c", shape=(length,)))
+        else:
+            memmaps.append(np.empty((0,), dtype=dtype))
+
+    def generator():
+        for x_spec, y_spec in index["batches"]:
+            yield _decode(x_spec, memmaps), _decode(y_spec, memmaps)
+
+    return ArmoryDataGenerator(
+        generator(),
+        size=index["size"],
+        epochs=index["epochs"],
+        batch_size=index["batch_size"],
+        context=context,
+    )
+
+
+def cached_dataset(dataset, key, cache_dir) -> ArmoryDataGenerator:
+    """
+    Return a generator over the cache entry for key if present
+
+    Otherwise, return dataset with a writer attached that populates the entry
+        once dataset has been fully iterated.
+    """
+    path = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(path, INDEX_FILE)):
+        logger.info(f"Loading preprocessed dataset from cache {path}")
+        return load(path, context=dataset.context)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dataset.set_cache_writer(
+        PreprocessedCacheWriter(
+            path, dataset.samples_per_epoch, dataset.epochs, dataset.batch_size
+        )
+    )
+    return dataset
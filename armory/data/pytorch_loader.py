@@ -1,35 +1,124 @@
+import logging
+import pickle
+
 import torch
+import torch.utils.dlpack
 import tensorflow as tf
 
+logger = logging.getLogger(__name__)
+
+
+def tf_to_torch(tensor):
+    """
+    Convert a tf.Tensor to a torch.Tensor, sharing memory where possible
+
+    DLPack is used to avoid a copy, falling back to numpy for dtypes it does not support
+    """
+    try:
+        return torch.utils.dlpack.from_dlpack(tf.experimental.dlpack.to_dlpack(tensor))
+    except Exception:
+        return torch.from_numpy(tensor.numpy())
+
 
 class TFToTorchGenerator(torch.utils.data.IterableDataset):
-    def __init__(self, tf_dataset):
+    """
+    Iterable torch dataset over the batches of a tf.data.Dataset
+
+    Either tf_dataset or make_dataset must be given. make_dataset(input_context)
+        returns the dataset restricted to the files of a tf.distribute.InputContext,
+        or the full dataset if input_context is None. When iterated by a DataLoader
+        with num_workers > 1, each worker then reads its own subset of files.
+        With only tf_dataset, or with fewer files than workers, each worker instead
+        takes every num_workers-th batch.
+    """
+
+    def __init__(self, tf_dataset=None, make_dataset=None):
         super().__init__()
+        if (tf_dataset is None) == (make_dataset is None):
+            raise ValueError("Exactly one of tf_dataset and make_dataset must be set")
         self.tf_dataset = tf_dataset
+        self.make_dataset = make_dataset
+
+    def _worker_dataset(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None or worker_info.num_workers == 1:
+            if self.make_dataset is not None:
+                return self.make_dataset(None)
+            return self.tf_dataset
+
+        if self.make_dataset is None:
+            tf_dataset = self.tf_dataset
+        else:
+            input_context = tf.distribute.InputContext(
+                num_input_pipelines=worker_info.num_workers,
+                input_pipeline_id=worker_info.id,
+            )
+            try:
+                return self.make_dataset(input_context)
+            except ValueError as e:
+                # tfds cannot shard splits with fewer files than workers
+                logger.warning(f"Sharding batches instead of files: {e}")
+                tf_dataset = self.make_dataset(None)
+        return tf_dataset.shard(worker_info.num_workers, worker_info.id)
 
     def __iter__(self):
-        for ex in self.tf_dataset.take(-1):
+        for ex in self._worker_dataset().take(-1):
             x, y = ex
             # separately handle benign/adversarial data formats
             if isinstance(x, tuple):
                 x_torch = (
-                    torch.from_numpy(x[0].numpy()),
-                    torch.from_numpy(x[1].numpy()),
+                    tf_to_torch(x[0]),
+                    tf_to_torch(x[1]),
                 )
             else:
-                x_torch = torch.from_numpy(x.numpy())
+                x_torch = tf_to_torch(x)
 
             # separately handle tensor/object detection label formats
             if isinstance(y, dict):
                 y_torch = {}
                 for k, v in y.items():
                     if isinstance(v, tf.Tensor):
-                        y_torch[k] = torch.from_numpy(v.numpy())
+                        y_torch[k] = tf_to_torch(v)
                     else:
                         raise ValueError(
                             f"Expected all values to be of type tf.Tensor, but value at key {k} is of type {type(v)}"
                         )
             else:
-                y_torch = torch.from_numpy(y.numpy())
+                y_torch = tf_to_torch(y)
 
             yield x_torch, y_torch
+
+
+def _identity(x):
+    return x
+
+
+def make_dataloader(dataset, num_workers=0, pin_memory=False):
+    """
+    Return a DataLoader over a TFToTorchGenerator, which yields full batches
+
+    Worker processes are started with "spawn", as TensorFlow is not fork-safe once
+        it has run any op. The dataset is pickled to each worker, so it must be
+        given a picklable make_dataset factory, such as datasets.TFDSBatches, with
+        which each worker loads its own dataset. Batches from different workers are
+        interleaved, so the order differs from num_workers=0. pin_memory places
+        batches in page-locked memory for faster transfer to GPU.
+    """
+    kwargs = {}
+    if num_workers > 0:
+        try:
+            pickle.dumps(dataset)
+        except Exception as e:
+            raise ValueError(
+                "DataLoader workers require a picklable dataset, such as a "
+                f"TFToTorchGenerator with a make_dataset factory: {e}"
+            )
+        kwargs["multiprocessing_context"] = "spawn"
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        collate_fn=_identity,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **kwargs,
+    )
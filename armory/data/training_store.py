@@ -0,0 +1,124 @@
+"""
+Memory-mapped training set for poisoning scenarios
+
+Poisoning scenarios hold the full training set in memory for poison detection and
+    training. TrainingStore instead writes batches once into a preallocated array
+    backed by an unlinked temporary file, so that pages can be evicted under memory
+    pressure and building the set never needs a concatenated copy. Labels, which
+    are small, are kept in memory as sparse class indices.
+"""
+
+import logging
+import tempfile
+
+import numpy as np
+
+from armory import paths
+
+logger = logging.getLogger(__name__)
+
+# Number of samples moved at a time by compact
+COMPACT_CHUNK_SIZE = 1024
+
+
+def compact(x: np.ndarray, keep: np.ndarray, chunk_size=COMPACT_CHUNK_SIZE):
+    """
+    Move the samples of x selected by boolean mask keep to its front, in place
+
+    Returns a view of the first keep.sum() samples, so filtering a memory-mapped
+        array needs at most chunk_size samples of additional memory rather than a
+        full copy. The other samples of x are overwritten.
+    """
+    indices = np.flatnonzero(keep)
+    for start in range(0, len(indices), chunk_size):
+        chunk = indices[start : start + chunk_size]
+        # Sources are never before their destinations, so none are overwritten
+        # before being read
+        if chunk[0] != start or chunk[-1] != start + len(chunk) - 1:
+            x[start : start + len(chunk)] = x[chunk]
+    return x[: len(indices)]
+
+
+class TrainingStore:
+    """
+    Append-only training set with memory-mapped samples and in-memory labels
+
+    capacity is the expected number of samples, such as the size of the dataset
+        plus any preloaded poisons. The store grows if more samples are appended.
+        directory defaults to the armory tmp directory.
+    """
+
+    def __init__(self, capacity: int, directory=None):
+        if directory is None:
+            directory = paths.runtime_paths().tmp_dir
+        self.capacity = max(int(capacity), 1)
+        self.length = 0
+        # The file has no name, so it is removed once the store is garbage collected
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._x = None
+        self._y = None
+
+    def _allocate(self, x_shape, x_dtype, y_dtype):
+        x_shape = (self.capacity,) + tuple(x_shape)
+        nbytes = int(np.prod(x_shape, dtype=np.int64)) * np.dtype(x_dtype).itemsize
+        self._file.truncate(nbytes)
+        x = np.memmap(self._file, dtype=x_dtype, mode="r+", shape=x_shape)
+        if self._x is not None:
+            logger.info(f"Growing training store to {self.capacity} samples")
+            y = np.empty(self.capacity, dtype=self._y.dtype)
+            y[: self.length] = self._y[: self.length]
+        else:
+            y = np.empty(self.capacity, dtype=y_dtype)
+        self._x, self._y = x, y
+
+    def append(self, x: np.ndarray, y: np.ndarray):
+        """
+        Copy a batch of samples x and sparse labels y into the store
+        """
+        if len(x) != len(y):
+            raise ValueError(f"len(x) {len(x)} != len(y) {len(y)}")
+        if self._x is None:
+            self._allocate(x.shape[1:], x.dtype, np.asarray(y).dtype)
+        elif x.shape[1:] != self._x.shape[1:]:
+            raise ValueError(
+                f"sample shape {x.shape[1:]} != store shape {self._x.shape[1:]}"
+            )
+        end = self.length + len(x)
+        if end > self.capacity:
+            self.capacity = max(end, 2 * self.capacity)
+            self._allocate(self._x.shape[1:], self._x.dtype, self._y.dtype)
+        self._x[self.length : end] = x
+        self._y[self.length : end] = y
+        self.length = end
+
+    @property
+    def x(self) -> np.ndarray:
+        """
+        Writable memory-mapped view of the samples
+        """
+        if self._x is None:
+            raise ValueError("No samples have been appended")
+        return self._x[: self.length]
+
+    @property
+    def y(self) -> np.ndarray:
+        """
+        Writable view of the sparse labels
+        """
+        if self._y is None:
+            raise ValueError("No samples have been appended")
+        return self._y[: self.length]
+
+    def filter(self, keep: np.ndarray):
+        """
+        Keep only the samples selected by boolean mask keep, in place
+
+        Returns the new (x, y) views. Previously returned views are invalidated.
+        """
+        keep = np.asarray(keep, dtype=bool)
+        if keep.shape != (self.length,):
+            raise ValueError(f"keep shape {keep.shape} != ({self.length},)")
+        compact(self.x, keep)
+        compact(self.y, keep)
+        self.length = int(keep.sum())
+        return self.x, self.y
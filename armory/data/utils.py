@@ -2,15 +2,16 @@
 Utils for data processing
 
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import hashlib
+import io
 import tarfile
 import os
+import queue
 import shutil
-import random
-import string
 import json
-import subprocess
+import threading
 
 import boto3
 from botocore import UNSIGNED
@@ -166,12 +167,53 @@ def download_private_file_from_s3(bucket_name: str, key: str, local_path: str):
         logger.info("Reusing cached S3 data file...")
 
 
-def download_requests(url: str, dirpath: str, filename: str):
-    verify_ssl = get_verify_ssl()
+DOWNLOAD_PART_SIZE = 2 ** 23  # 8 MiB
+DOWNLOAD_WORKERS = 8
 
-    filepath = os.path.join(dirpath, filename)
-    chunk_size = 4096
+
+def _load_download_progress(progress_filepath, filepath, url, size, part_size):
+    """
+    Return the completed parts recorded in progress_filepath, or None if not resumable
+    """
+    if not (os.path.isfile(progress_filepath) and os.path.isfile(filepath)):
+        return None
+    try:
+        with open(progress_filepath) as f:
+            progress = json.load(f)
+    except ValueError:
+        return None
+    if (
+        progress.get("url") != url
+        or progress.get("size") != size
+        or progress.get("part_size") != part_size
+        or os.path.getsize(filepath) != size
+    ):
+        return None
+    return set(progress["completed"])
+
+
+def _save_download_progress(progress_filepath, url, size, part_size, completed):
+    tmp_filepath = progress_filepath + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(
+            {
+                "url": url,
+                "size": size,
+                "part_size": part_size,
+                "completed": sorted(completed),
+            },
+            f,
+        )
+    os.replace(tmp_filepath, progress_filepath)
+
+
+def _download_stream(url, filepath, verify_ssl, callback=None, chunk_size=2 ** 16):
+    """
+    Download url over a single connection, returning the sha256 hex digest
+    """
+    sha256_hash = hashlib.sha256()
     r = requests.get(url, stream=True, verify=verify_ssl)
+    r.raise_for_status()
     with open(filepath, "wb") as f:
         progress_bar = tqdm(
             unit="B", total=int(r.headers["Content-Length"]), unit_scale=True
@@ -180,6 +222,173 @@ def download_requests(url: str, dirpath: str, filename: str):
             if chunk:  # filter keep-alive chunks
                 progress_bar.update(len(chunk))
                 f.write(chunk)
+                sha256_hash.update(chunk)
+                if callback is not None:
+                    callback(chunk)
+        progress_bar.close()
+    return sha256_hash.hexdigest()
+
+
+def _download_ranges(
+    url,
+    filepath,
+    size,
+    verify_ssl,
+    num_workers,
+    part_size,
+    callback=None,
+    chunk_size=2 ** 16,
+    max_pending_parts=None,
+):
+    """
+    Download url with concurrent range requests, returning the sha256 hex digest
+
+    Parts are written in place into a preallocated file. Completed parts are
+        recorded in a sidecar <filepath>.progress file, so an interrupted download
+        resumes with only the missing parts. The chunks of each part are also kept
+        in memory until the contiguous prefix of completed parts reaches it, when
+        they are hashed and passed to callback, so callback receives the file in
+        order. Parts completed by an interrupted download are read back instead.
+        Workers do not start parts more than max_pending_parts past the prefix,
+        which bounds the memory held to about max_pending_parts * part_size.
+    """
+    progress_filepath = filepath + ".progress"
+    completed = _load_download_progress(
+        progress_filepath, filepath, url, size, part_size
+    )
+    if completed is None:
+        completed = set()
+        with open(filepath, "wb") as f:
+            f.truncate(size)
+        _save_download_progress(progress_filepath, url, size, part_size, completed)
+    else:
+        logger.info(f"Resuming download of {filepath}")
+
+    num_parts = (size + part_size - 1) // part_size
+
+    def part_range(part):
+        start = part * part_size
+        return start, min(size, start + part_size)
+
+    progress_bar = tqdm(
+        unit="B",
+        total=size,
+        unit_scale=True,
+        initial=sum(part_range(p)[1] - part_range(p)[0] for p in completed),
+    )
+    progress_lock = threading.Lock()
+    local = threading.local()
+    if max_pending_parts is None:
+        max_pending_parts = 2 * num_workers
+    sha256_hash = hashlib.sha256()
+    hashed_parts = 0
+    stopped = False
+    window = threading.Condition()
+
+    def fetch(part):
+        with window:
+            window.wait_for(lambda: stopped or part < hashed_parts + max_pending_parts)
+            if stopped:
+                return part, None
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start, end = part_range(part)
+        r = local.session.get(
+            url,
+            headers={"Range": f"bytes={start}-{end - 1}"},
+            stream=True,
+            verify=verify_ssl,
+        )
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ValueError(f"Server did not return a partial response for {url}")
+        chunks = []
+        with open(filepath, "r+b") as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                chunks.append(chunk)
+                with progress_lock:
+                    progress_bar.update(len(chunk))
+            if f.tell() != end:
+                raise ValueError(f"Part {part} of {url} ended at {f.tell()} != {end}")
+        return part, chunks
+
+    pending = {}
+
+    def hash_completed_prefix():
+        nonlocal hashed_parts
+        while hashed_parts < num_parts and hashed_parts in completed:
+            chunks = pending.pop(hashed_parts, None)
+            if chunks is None:
+                # Completed by an interrupted download
+                start, end = part_range(hashed_parts)
+                with open(filepath, "rb") as f:
+                    f.seek(start)
+                    chunks = [f.read(end - start)]
+            for chunk in chunks:
+                sha256_hash.update(chunk)
+                if callback is not None:
+                    callback(chunk)
+            with window:
+                hashed_parts += 1
+                window.notify_all()
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    futures = [
+        executor.submit(fetch, part)
+        for part in range(num_parts)
+        if part not in completed
+    ]
+    try:
+        hash_completed_prefix()
+        for future in as_completed(futures):
+            part, pending[part] = future.result()
+            completed.add(part)
+            _save_download_progress(progress_filepath, url, size, part_size, completed)
+            hash_completed_prefix()
+    finally:
+        for future in futures:
+            future.cancel()
+        with window:
+            stopped = True
+            window.notify_all()
+        executor.shutdown(wait=True)
+        progress_bar.close()
+
+    os.remove(progress_filepath)
+    return sha256_hash.hexdigest()
+
+
+def download_requests(
+    url: str,
+    dirpath: str,
+    filename: str,
+    num_workers: int = DOWNLOAD_WORKERS,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    callback=None,
+) -> str:
+    """
+    Download url to dirpath/filename and return the sha256 hex digest of the file
+
+    If the server supports range requests, the file is fetched in parts of
+        part_size bytes by num_workers concurrent connections, and an interrupted
+        download can be resumed by calling this function again.
+        Otherwise, it is streamed over a single connection.
+    If callback is not None, it is called with consecutive chunks of the file,
+        in order, while the download is in progress.
+    """
+    verify_ssl = get_verify_ssl()
+
+    filepath = os.path.join(dirpath, filename)
+    r = requests.head(url, allow_redirects=True, verify=verify_ssl)
+    r.raise_for_status()
+    size = int(r.headers["Content-Length"])
+    if r.headers.get("Accept-Ranges") == "bytes" and size > 0:
+        return _download_ranges(
+            url, filepath, size, verify_ssl, num_workers, part_size, callback=callback
+        )
+    return _download_stream(url, filepath, verify_ssl, callback=callback)
 
 
 def sha256(filepath: str, block_size=4096):
@@ -217,20 +426,126 @@ def verify_size(filepath: str, file_size: int):
         raise ValueError(f"file size of {filepath}: {size} != {file_size}")
 
 
-def move_merge(source, dest):
-    dest_location = os.path.join(dest, os.path.basename(source))
-    if not os.path.exists(dest_location):
-        shutil.move(source, dest)
-        return
+class _ChunkStream(io.RawIOBase):
+    """
+    Readable stream of chunks passed to put from another thread
 
-        # Move up a directory, as shutil.move will error
-    filepaths = [
-        os.path.join(source, x) for x in os.listdir(source) if not x.startswith(".")
-    ]
-    if len(filepaths) != 1 or not os.path.isdir(filepaths[0]):
-        raise ValueError(f"{source} not a single branch directory. Cannot recurse.")
-    move_merge(filepaths[0], dest_location)
-    os.rmdir(source)
+    close_input marks the end of the stream. Once abort is called, e.g. because
+        the reader failed, put discards its chunks instead of blocking.
+    """
+
+    def __init__(self, max_chunks=4):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.buffer = b""
+        self.aborted = threading.Event()
+        self.input_closed = False
+
+    def readable(self):
+        return True
+
+    def put(self, chunk):
+        while not self.aborted.is_set():
+            try:
+                self.queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close_input(self):
+        self.put(None)
+
+    def abort(self):
+        self.aborted.set()
+        try:
+            # Unblock a reader waiting for input
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def readinto(self, b):
+        while not self.buffer and not self.input_closed:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.input_closed = True
+            else:
+                self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def extract_tar_stream(fileobj, dest_dir, filepaths=None):
+    """
+    Extract a gzipped tar archive read sequentially from fileobj into dest_dir
+
+    Member paths are verified before writing: they must be relative, must not
+        contain "..", and must all be under a single top-level directory.
+        Directories are merged with any existing ones in dest_dir.
+    Each file path is appended to filepaths before the file is written, so that
+        partially extracted files can be removed if extraction fails.
+    Return the list of extracted file paths
+    """
+    dest_dir = os.path.abspath(dest_dir)
+    top_level = None
+    if filepaths is None:
+        filepaths = []
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            parts = member.name.replace("\\", "/").split("/")
+            parts = [x for x in parts if x not in ("", ".")]
+            if os.path.isabs(member.name) or ".." in parts or not parts:
+                raise ValueError(f"Unsafe path {member.name} in archive")
+            if top_level is None:
+                top_level = parts[0]
+            elif parts[0] != top_level:
+                raise ValueError(
+                    f"{member.name} not under {top_level}. tfrecord archive corrupted."
+                )
+            path = os.path.join(dest_dir, *parts)
+
+            if member.isdir():
+                os.makedirs(path, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                filepaths.append(path)
+                with tar.extractfile(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, length=2 ** 20)
+            else:
+                logger.warning(
+                    f"Skipping archive member {member.name} of unsupported type"
+                )
+    if top_level is None:
+        raise ValueError("Empty archive. tfrecord archive corrupted.")
+    return filepaths
+
+
+def _extraction_marker(dataset_dir, name, complete=True):
+    suffix = ".extracted" if complete else ".extracting"
+    return os.path.join(dataset_dir, "cache", name + suffix)
+
+
+def dataset_extracted(dataset_dir, name):
+    """
+    Return True if dataset name was fully extracted into dataset_dir, False if its
+        extraction was interrupted, and None if neither is recorded
+    """
+    if os.path.isfile(_extraction_marker(dataset_dir, name, complete=True)):
+        return True
+    if os.path.isfile(_extraction_marker(dataset_dir, name, complete=False)):
+        return False
+    return None
+
+
+def _move_files(filepaths, src_dir, dest_dir):
+    """
+    Move filepaths from under src_dir to the same relative paths under dest_dir
+    """
+    for filepath in filepaths:
+        dest_path = os.path.join(dest_dir, os.path.relpath(filepath, src_dir))
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(filepath, dest_path)
 
 
 def download_verify_dataset_cache(dataset_dir, checksum_file, name):
@@ -250,85 +565,115 @@ def download_verify_dataset_cache(dataset_dir, checksum_file, name):
     cache_dir = os.path.join(dataset_dir, "cache")
     os.makedirs(cache_dir, exist_ok=True)
     tar_filepath = os.path.join(cache_dir, os.path.basename(s3_key))
+    complete_marker = _extraction_marker(dataset_dir, name, complete=True)
+    in_progress_marker = _extraction_marker(dataset_dir, name, complete=False)
+    resumable = os.path.exists(tar_filepath + ".progress")
     already_verified = False
-    if os.path.exists(tar_filepath):
+    download_hash = None
+    if os.path.exists(tar_filepath) and not resumable:
         # Check existing download to avoid falling back to processing data
         logger.info(f"{tar_filepath} exists. Verifying...")
         try:
             verify_size(tar_filepath, int(file_length))
-            verify_sha256(tar_filepath, hash)
+            if os.path.isfile(complete_marker):
+                # Hash was verified when the archive was previously extracted
+                with open(complete_marker) as f:
+                    download_hash = f.read().strip()
+            if download_hash != hash.lower():
+                verify_sha256(tar_filepath, hash)
             already_verified = True
         except ValueError as e:
             logger.warning(f"Verification failed: {str(e)}")
             os.remove(tar_filepath)
 
-    if not os.path.exists(tar_filepath):
-        if s3_bucket_name == "local":
-            raise FileNotFoundError(f"Expected to find {s3_key} locally in cache!")
-        logger.info(f"Downloading dataset: {name}...")
-        try:
-            s3_url_region = "us-east-2"
-            url = f"https://{s3_bucket_name}.s3.{s3_url_region}.amazonaws.com/{s3_key}"
-            download_requests(url, dataset_dir, tar_filepath)
-        except KeyboardInterrupt:
-            logger.exception("Keyboard interrupt caught")
-            if os.path.exists(tar_filepath):
-                os.remove(tar_filepath)
-            raise
-    else:
-        logger.info("Dataset already downloaded.")
+    download = not os.path.exists(tar_filepath) or resumable
+    if download and s3_bucket_name == "local":
+        raise FileNotFoundError(f"Expected to find {s3_key} locally in cache!")
+
+    if os.path.exists(complete_marker):
+        os.remove(complete_marker)
+    with open(in_progress_marker, "w") as f:
+        f.write(hash)
+
+    # Files are only moved into dataset_dir once the archive is verified, so that
+    #     a corrupted archive does not overwrite files of a good dataset
+    staging_dir = os.path.join(dataset_dir, f".{name}.staging")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    extraction = {"filepaths": []}
 
-    # verification
-    if not already_verified:
+    def extract(fileobj):
         try:
-            verify_size(tar_filepath, int(file_length))
-            logger.info("Verifying sha256 hash of download...")
-            verify_sha256(tar_filepath, hash)
-        except ValueError:
-            if os.path.exists(tar_filepath):
-                os.remove(tar_filepath)
-            logger.warning(
-                "Cached file download failed. Falling back to processing data..."
+            extract_tar_stream(fileobj, staging_dir, extraction["filepaths"])
+        except Exception as e:
+            extraction["error"] = e
+            if isinstance(fileobj, _ChunkStream):
+                fileobj.abort()
+
+    try:
+        logger.info("Extracting .tfrecord files from download...")
+        if download:
+            logger.info(f"Downloading dataset: {name}...")
+            # Extract concurrently, as the downloaded prefix of the archive grows
+            stream = _ChunkStream()
+            extract_thread = threading.Thread(
+                target=extract, args=(stream,), daemon=True
             )
+            extract_thread.start()
+            try:
+                s3_url_region = "us-east-2"
+                url = f"https://{s3_bucket_name}.s3.{s3_url_region}.amazonaws.com/{s3_key}"
+                download_hash = download_requests(
+                    url, dataset_dir, tar_filepath, callback=stream.put
+                )
+            except KeyboardInterrupt:
+                logger.exception("Keyboard interrupt caught")
+                if os.path.exists(tar_filepath + ".progress"):
+                    logger.info("Partial download kept. Rerun to resume")
+                elif os.path.exists(tar_filepath):
+                    os.remove(tar_filepath)
+                raise
+            finally:
+                stream.close_input()
+                extract_thread.join()
+        else:
+            logger.info("Dataset already downloaded.")
+            with open(tar_filepath, "rb") as f:
+                extract(f)
+
+        # verification
+        if not already_verified:
+            try:
+                verify_size(tar_filepath, int(file_length))
+                logger.info("Verifying sha256 hash of download...")
+                if download_hash is None:
+                    verify_sha256(tar_filepath, hash)
+                elif download_hash != hash.lower():
+                    raise ValueError(
+                        f"sha256 hash of {tar_filepath}: {download_hash} != {hash}"
+                    )
+            except ValueError:
+                if os.path.exists(tar_filepath):
+                    os.remove(tar_filepath)
+                logger.warning(
+                    "Cached file download failed. Falling back to processing data..."
+                )
+                return
+
+        if "error" in extraction:
+            e = extraction["error"]
+            if not isinstance(e, tarfile.TarError):
+                raise e
+            logger.warning(f"Could not extract tarfile {tar_filepath}: {e}")
+            logger.warning("Falling back to processing data...")
             return
 
-    tmp_dir = os.path.join(
-        cache_dir,
-        "tmp_" + "".join(random.choice(string.ascii_lowercase) for _ in range(16)),
-    )
-    os.makedirs(tmp_dir)
+        _move_files(extraction["filepaths"], staging_dir, dataset_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
-    logger.info("Extracting .tfrecord files from download...")
-    try:
-        completedprocess = subprocess.run(
-            ["tar", "zxvf", tar_filepath, "--directory", tmp_dir],
-        )
-        if completedprocess.returncode:
-            logger.warning("bash tar failed. Reverting to python tar unpacking")
-            with tarfile.open(tar_filepath, "r:gz") as tar_ref:
-                tar_ref.extractall(tmp_dir)
-    except tarfile.ReadError:
-        logger.warning(f"Could not read tarfile: {tar_filepath}")
-        logger.warning("Falling back to processing data...")
-        return
-    except tarfile.ExtractError:
-        logger.warning(f"Could not extract tarfile: {tar_filepath}")
-        logger.warning("Falling back to processing data...")
-        return
-
-    filepaths = [
-        os.path.join(tmp_dir, x) for x in os.listdir(tmp_dir) if not x.startswith(".")
-    ]
-    if len(filepaths) != 1 or not os.path.isdir(filepaths[0]):
-        raise ValueError(
-            f"{tmp_dir} not a single branch directory. tfrecord archive corrupted."
-        )
-    move_merge(filepaths[0], dataset_dir)
-    try:
-        shutil.rmtree(tmp_dir)
-    except OSError as e:
-        if not isinstance(e, FileNotFoundError):
-            logger.exception(f"Error removing temporary directory {tmp_dir}")
+    with open(complete_marker, "w") as f:
+        f.write(hash.lower())
+    os.remove(in_progress_marker)
 
 
 def _read_validate_scenario_config(config_filepath):
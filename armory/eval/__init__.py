@@ -3,3 +3,4 @@ Evaluation within ARMORY
 """
 
 from armory.eval.evaluator import Evaluator
+from armory.eval.sharded_evaluator import ShardedEvaluator
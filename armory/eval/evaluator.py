@@ -28,7 +28,11 @@ logger = logging.getLogger(__name__)
 
 class Evaluator(object):
     def __init__(
-        self, config: dict, no_docker: bool = False, root: bool = False,
+        self,
+        config: dict,
+        no_docker: bool = False,
+        root: bool = False,
+        eval_id: str = None,
     ):
         if not isinstance(config, dict):
             raise ValueError(f"config {config} must be a dict")
@@ -42,9 +46,10 @@ class Evaluator(object):
         else:
             self.armory_global_config = {"verify_ssl": True}
 
-        date_time = datetime.datetime.utcnow().isoformat().replace(":", "")
-        output_dir = self.config["sysconfig"].get("output_dir", None)
-        eval_id = f"{output_dir}_{date_time}" if output_dir else date_time
+        if eval_id is None:
+            date_time = datetime.datetime.utcnow().isoformat().replace(":", "")
+            output_dir = self.config["sysconfig"].get("output_dir", None)
+            eval_id = f"{output_dir}_{date_time}" if output_dir else date_time
 
         self.config["eval_id"] = eval_id
         self.output_dir = os.path.join(self.host_paths.output_dir, eval_id)
@@ -161,6 +166,9 @@ class Evaluator(object):
         skip_benign=None,
         skip_attack=None,
         validate_config=None,
+        shard=None,
+        merge_shards=None,
+        resume=False,
     ) -> int:
         exit_code = 0
         if self.no_docker:
@@ -177,6 +185,9 @@ class Evaluator(object):
                     skip_benign=skip_benign,
                     skip_attack=skip_attack,
                     validate_config=validate_config,
+                    shard=shard,
+                    merge_shards=merge_shards,
+                    resume=resume,
                 )
             except KeyboardInterrupt:
                 logger.warning("Keyboard interrupt caught")
@@ -214,6 +225,9 @@ class Evaluator(object):
                         skip_benign=skip_benign,
                         skip_attack=skip_attack,
                         validate_config=validate_config,
+                        shard=shard,
+                        merge_shards=merge_shards,
+                        resume=resume,
                     )
                 elif command:
                     exit_code = self._run_command(runner, command)
@@ -225,6 +239,9 @@ class Evaluator(object):
                         skip_benign=skip_benign,
                         skip_attack=skip_attack,
                         validate_config=validate_config,
+                        shard=shard,
+                        merge_shards=merge_shards,
+                        resume=resume,
                     )
             except KeyboardInterrupt:
                 logger.warning("Keyboard interrupt caught")
@@ -264,6 +281,9 @@ class Evaluator(object):
         skip_benign=None,
         skip_attack=None,
         validate_config=None,
+        shard=None,
+        merge_shards=None,
+        resume=False,
     ) -> int:
         logger.info(bold(red("Running evaluation script")))
 
@@ -274,6 +294,9 @@ class Evaluator(object):
             skip_benign=skip_benign,
             skip_attack=skip_attack,
             validate_config=validate_config,
+            shard=shard,
+            merge_shards=merge_shards,
+            resume=resume,
         )
         if self.no_docker:
             kwargs = {}
@@ -311,6 +334,9 @@ class Evaluator(object):
         skip_benign=None,
         skip_attack=None,
         validate_config=None,
+        shard=None,
+        merge_shards=None,
+        resume=False,
     ) -> None:
         user_group_id = self.get_id()
         lines = [
@@ -331,6 +357,9 @@ class Evaluator(object):
                 skip_benign=skip_benign,
                 skip_attack=skip_attack,
                 validate_config=validate_config,
+                shard=shard,
+                merge_shards=merge_shards,
+                resume=resume,
             )
             tmp_dir = os.path.join(self.host_paths.tmp_dir, self.config["eval_id"])
             os.makedirs(tmp_dir)
@@ -385,7 +414,15 @@ class Evaluator(object):
         )
 
     def _build_options(
-        self, check_run, num_eval_batches, skip_benign, skip_attack, validate_config
+        self,
+        check_run,
+        num_eval_batches,
+        skip_benign,
+        skip_attack,
+        validate_config,
+        shard=None,
+        merge_shards=None,
+        resume=False,
     ):
         options = ""
         if self.no_docker:
@@ -402,4 +439,11 @@ class Evaluator(object):
             options += " --skip-attack"
         if validate_config:
             options += " --validate-config"
+        if shard is not None:
+            index, num_shards = shard
+            options += f" --shard {index}/{num_shards}"
+        if merge_shards:
+            options += " --merge-shards " + " ".join(merge_shards)
+        if resume:
+            options += " --resume"
         return options
@@ -0,0 +1,90 @@
+"""
+Sharded evaluators run an ARMORY evaluation as parallel shards of its evaluation data.
+"""
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from armory.eval.evaluator import Evaluator
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedEvaluator(object):
+    """
+    Evaluates each of num_shards disjoint slices of the evaluation data with its own
+        Evaluator, in parallel, then merges their metrics into a single results file.
+
+    Shard outputs are written to "shard_<index>_of_<num_shards>" subdirectories of the
+        output directory of the merged results. If sysconfig "gpus" lists several
+        GPUs, they are assigned to the shards round robin.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        num_shards: int,
+        no_docker: bool = False,
+        root: bool = False,
+    ):
+        if not isinstance(num_shards, int) or num_shards < 1:
+            raise ValueError(f"num_shards {num_shards} must be a positive int")
+        self.num_shards = num_shards
+        self.evaluator = Evaluator(config, no_docker=no_docker, root=root)
+        eval_id = self.evaluator.config["eval_id"]
+
+        gpus = config["sysconfig"].get("gpus")
+        if config["sysconfig"].get("use_gpu") and gpus and gpus != "all":
+            gpus = gpus.split(",")
+        else:
+            gpus = None
+
+        self.shard_evaluators = []
+        for index in range(num_shards):
+            shard_config = copy.deepcopy(config)
+            if gpus:
+                shard_config["sysconfig"]["gpus"] = gpus[index % len(gpus)]
+            self.shard_evaluators.append(
+                Evaluator(
+                    shard_config,
+                    no_docker=no_docker,
+                    root=root,
+                    eval_id=f"{eval_id}/shard_{index}_of_{num_shards}",
+                )
+            )
+
+    def run(
+        self,
+        check_run=False,
+        num_eval_batches=None,
+        skip_benign=None,
+        skip_attack=None,
+    ) -> int:
+        """
+        Run all shards, then merge their results if every shard succeeded
+
+        num_eval_batches, if given, applies to each shard
+        """
+        with ThreadPoolExecutor(max_workers=self.num_shards) as executor:
+            futures = [
+                executor.submit(
+                    evaluator.run,
+                    check_run=check_run,
+                    num_eval_batches=num_eval_batches,
+                    skip_benign=skip_benign,
+                    skip_attack=skip_attack,
+                    shard=(index, self.num_shards),
+                )
+                for index, evaluator in enumerate(self.shard_evaluators)
+            ]
+            exit_codes = [future.result() for future in futures]
+
+        failed = [index for index, code in enumerate(exit_codes) if code]
+        if failed:
+            logger.error(f"Shards {failed} of {self.num_shards} failed. Not merging")
+            return exit_codes[failed[0]]
+
+        logger.info(f"Merging results of {self.num_shards} shards")
+        return self.evaluator.run(
+            merge_shards=[e.config["eval_id"] for e in self.shard_evaluators]
+        )
@@ -16,6 +16,7 @@ from armory.utils.config_loading import (
     load_defense_internal,
     load_label_targeter,
 )
+from armory.utils import instrumentation
 from armory.utils import metrics
 from armory.scenarios.base import Scenario
 from armory.utils.export import SampleExporter
@@ -24,6 +25,9 @@ logger = logging.getLogger(__name__)
 
 
 class AutomaticSpeechRecognition(Scenario):
+    supports_sharding = True
+    supports_checkpoints = True
+
     def _evaluate(
         self,
         config: dict,
@@ -100,6 +104,7 @@ class AutomaticSpeechRecognition(Scenario):
             skip_attack=skip_attack,
             targeted=targeted,
         )
+        self.metrics_logger = metrics_logger
 
         if config["dataset"]["batch_size"] != 1:
             logger.warning("Evaluation batch_size != 1 may not be supported.")
@@ -119,16 +124,16 @@ class AutomaticSpeechRecognition(Scenario):
                 shuffle_files=False,
             )
             logger.info("Running inference on benign examples...")
-            for x, y in tqdm(test_data, desc="Benign"):
-                # Ensure that input sample isn't overwritten by estimator
-                x.flags.writeable = False
-                with metrics.resource_context(
-                    name="Inference",
-                    profiler=config["metric"].get("profiler_type"),
-                    computational_resource_dict=metrics_logger.computational_resource_dict,
+            with instrumentation.span("benign"):
+                for x, y in self._checkpointed(
+                    tqdm(test_data, desc="Benign"), "benign"
                 ):
-                    y_pred = estimator.predict(x, **predict_kwargs)
-                metrics_logger.update_task(y, y_pred)
+                    # Ensure that input sample isn't overwritten by estimator
+                    x.flags.writeable = False
+                    with instrumentation.span("predict"):
+                        y_pred = estimator.predict(x, **predict_kwargs)
+                    with instrumentation.span("metrics"):
+                        metrics_logger.update_task(y, y_pred)
             metrics_logger.log_task()
 
         if skip_attack:
@@ -143,6 +148,7 @@ class AutomaticSpeechRecognition(Scenario):
         # Evaluate the ART estimator on adversarial test examples
         logger.info("Generating or loading / testing adversarial examples...")
 
+        label_targeter = None
         if attack_type == "preloaded":
             test_data = load_adversarial_dataset(
                 attack_config,
@@ -175,35 +181,40 @@ class AutomaticSpeechRecognition(Scenario):
         else:
             sample_exporter = None
 
-        for x, y in tqdm(test_data, desc="Attack"):
-            with metrics.resource_context(
-                name="Attack",
-                profiler=config["metric"].get("profiler_type"),
-                computational_resource_dict=metrics_logger.computational_resource_dict,
+        with instrumentation.span("attack"):
+            for x, y in self._checkpointed(
+                tqdm(test_data, desc="Attack"),
+                "attack",
+                sample_exporter,
+                label_targeter,
             ):
-                if attack_type == "preloaded":
-                    x, x_adv = x
+                with instrumentation.span("generate"):
+                    if attack_type == "preloaded":
+                        x, x_adv = x
+                        if targeted:
+                            y, y_target = y
+                    elif attack_config.get("use_label"):
+                        x_adv = attack.generate(x=x, y=y)
+                    elif targeted:
+                        y_target = label_targeter.generate(y)
+                        x_adv = attack.generate(x=x, y=y_target)
+                    else:
+                        x_adv = attack.generate(x=x)
+
+                # Ensure that input sample isn't overwritten by estimator
+                x_adv.flags.writeable = False
+                with instrumentation.span("predict"):
+                    y_pred_adv = estimator.predict(x_adv, **predict_kwargs)
+                with instrumentation.span("metrics"):
+                    metrics_logger.update_task(y, y_pred_adv, adversarial=True)
                     if targeted:
-                        y, y_target = y
-                elif attack_config.get("use_label"):
-                    x_adv = attack.generate(x=x, y=y)
-                elif targeted:
-                    y_target = label_targeter.generate(y)
-                    x_adv = attack.generate(x=x, y=y_target)
-                else:
-                    x_adv = attack.generate(x=x)
-
-            # Ensure that input sample isn't overwritten by estimator
-            x_adv.flags.writeable = False
-            y_pred_adv = estimator.predict(x_adv, **predict_kwargs)
-            metrics_logger.update_task(y, y_pred_adv, adversarial=True)
-            if targeted:
-                metrics_logger.update_task(
-                    y_target, y_pred_adv, adversarial=True, targeted=True,
-                )
-            metrics_logger.update_perturbation(x, x_adv)
-            if sample_exporter is not None:
-                sample_exporter.export(x, x_adv, y, y_pred_adv)
+                        metrics_logger.update_task(
+                            y_target, y_pred_adv, adversarial=True, targeted=True,
+                        )
+                    metrics_logger.update_perturbation(x, x_adv)
+                if sample_exporter is not None:
+                    with instrumentation.span("export"):
+                        sample_exporter.export(x, x_adv, y, y_pred_adv)
         metrics_logger.log_task(adversarial=True)
         if targeted:
             metrics_logger.log_task(adversarial=True, targeted=True)
@@ -15,15 +15,19 @@ The particular scenario and configs will be picked up in the "scenario" field:
 import abc
 import base64
 import argparse
+import copy
 import json
 import logging
 import os
+import pickle
+import random
 import time
 from typing import Optional
 import sys
 import pytest
 
 import coloredlogs
+import numpy as np
 import pymongo
 import pymongo.errors
 import re
@@ -33,8 +37,11 @@ from armory import paths
 from armory import environment
 from armory.utils import config_loading
 from armory.utils import external_repo
+from armory.utils import instrumentation
+from armory.utils import metrics
 from armory.utils.configuration import load_config
 from armory.scenarios import END_SENTINEL
+from armory.scenarios.common import parse_shard
 
 
 logger = logging.getLogger(__name__)
@@ -44,11 +51,33 @@ MONGO_PORT = 27017
 MONGO_DATABASE = "armory"
 MONGO_COLLECTION = "scenario_results"
 
+METRICS_STATE_FILENAME = "metrics_state.npz"
+PROFILE_FILENAME = "profile.pstats"
+CHECKPOINT_FILENAME = "checkpoint.pkl"
+CHECKPOINT_VERSION = 1
+# Config fields that must not change between a checkpoint and its resumption
+CHECKPOINT_CONFIG_KEYS = ("adhoc", "attack", "dataset", "defense", "metric", "model")
+
 
 class Scenario(abc.ABC):
+    # Whether _evaluate sets self.metrics_logger and only reads evaluation data
+    #     with shuffle_files=False, so that it can be evaluated in shards
+    supports_sharding = False
+    # Whether _evaluate iterates over evaluation data with _checkpointed, so that it
+    #     can save checkpoints and resume from them
+    supports_checkpoints = False
+
     def __init__(self):
         self.check_run = False
+        self.shard = None
+        self.resume = False
+        self.checkpoint_interval = None
+        self.metrics_logger = None
+        self.instrumentation = None
         self.scenario_output_dir = None
+        self._checkpoint = None
+        self._checkpoint_key = None
+        self._completed_phases = []
 
     def evaluate(
         self,
@@ -72,9 +101,51 @@ class Scenario(abc.ABC):
             # For poisoning scenario
             if config.get("adhoc") and config.get("adhoc").get("train_epochs"):
                 config["adhoc"]["train_epochs"] = 1
-
+        if self.shard is not None:
+            config["dataset"]["shard"] = list(self.shard)
+            if config.get("attack", {}).get("type") == "preloaded":
+                config["attack"]["shard"] = list(self.shard)
+
+        self.checkpoint_interval = config["scenario"].get("checkpoint_interval")
+        if self.checkpoint_interval and not self.supports_checkpoints:
+            logger.warning(f"{type(self).__name__} does not save checkpoints")
+            self.checkpoint_interval = None
+        # Model weights are not checkpointed, so resuming would retrain the model
+        #     and mix metrics of two different models
+        trains_model = bool((config.get("model") or {}).get("fit")) or (
+            (config.get("defense") or {}).get("type") == "Trainer"
+        )
+        if trains_model:
+            if self.resume:
+                raise ValueError(
+                    "Cannot resume an evaluation that trains its model, with "
+                    "model.fit or a Trainer defense"
+                )
+            if self.checkpoint_interval:
+                logger.warning("Checkpoints are not saved when training the model")
+                self.checkpoint_interval = None
+        self._checkpoint_key = {key: config.get(key) for key in CHECKPOINT_CONFIG_KEYS}
+        self._checkpoint_key["scenario"] = [
+            config["scenario"].get("module"),
+            config["scenario"].get("name"),
+            config["scenario"].get("kwargs"),
+            num_eval_batches,
+            bool(skip_benign),
+            bool(skip_attack),
+        ]
+        self._completed_phases = []
+        if self.resume:
+            self._load_checkpoint()
+
+        self.instrumentation = instrumentation.Instrumentation(
+            (config.get("metric") or {}).get("profiler_type")
+        )
         try:
-            results = self._evaluate(config, num_eval_batches, skip_benign, skip_attack)
+            with instrumentation.activate(self.instrumentation):
+                with self.instrumentation.profile():
+                    results = self._evaluate(
+                        config, num_eval_batches, skip_benign, skip_attack
+                    )
         except Exception as e:
             if str(e) == "assignment destination is read-only":
                 logger.exception(
@@ -84,12 +155,58 @@ class Scenario(abc.ABC):
                 )
             else:
                 logger.exception("Encountered error during scenario evaluation.")
+            if os.path.isfile(self._checkpoint_path()):
+                logger.error(
+                    f"Resume from the last checkpoint with --resume {config['eval_id']}"
+                )
             sys.exit(1)
 
         if results is None:
             logger.warning(f"{self._evaluate} returned None, not a dict")
+        elif self.instrumentation.histograms and "timing" not in results:
+            # Scenarios without a MetricsLogger
+            results["timing"] = self.instrumentation.results()
         output = self._prepare_results(config, results)
         self._save(output)
+        self.instrumentation.save_profile(
+            os.path.join(self.scenario_output_dir, PROFILE_FILENAME)
+        )
+        if self.shard is not None or (config.get("metric") or {}).get("save_state"):
+            self._save_metrics_state()
+        if mongo_host is not None:
+            self._send_to_mongo(mongo_host, output)
+        if os.path.isfile(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+
+    def merge_shards(self, config: dict, shard_eval_ids: list, mongo_host=None):
+        """
+        Merge the metrics of sharded evaluations into the results of config
+
+        shard_eval_ids are the eval_ids of the shards, in shard order
+        """
+        self._set_output_dir(config)
+        output_dir = paths.runtime_paths().output_dir
+        metrics_logger = None
+        profiles = []
+        for eval_id in shard_eval_ids:
+            profile = os.path.join(output_dir, eval_id, PROFILE_FILENAME)
+            if os.path.isfile(profile):
+                profiles.append(profile)
+            filepath = os.path.join(output_dir, eval_id, METRICS_STATE_FILENAME)
+            logger.info(f"Merging metrics from {filepath}")
+            with open(filepath, "rb") as f:
+                shard_logger = metrics.MetricsLogger.from_state(f.read())
+            if metrics_logger is None:
+                metrics_logger = shard_logger
+            else:
+                metrics_logger.merge(shard_logger)
+        output = self._prepare_results(config, metrics_logger.results())
+        output["shards"] = list(shard_eval_ids)
+        self._save(output)
+        if profiles:
+            instrumentation.merge_profiles(
+                profiles, os.path.join(self.scenario_output_dir, PROFILE_FILENAME)
+            )
         if mongo_host is not None:
             self._send_to_mongo(mongo_host, output)
 
@@ -99,6 +216,27 @@ class Scenario(abc.ABC):
         """
         self.check_run = bool(check_run)
 
+    def set_shard(self, shard):
+        """
+        Set the (index, num_shards) slice of the evaluation data to use, or None
+        """
+        if shard is not None:
+            if not self.supports_sharding:
+                raise ValueError(f"{type(self).__name__} does not support sharding")
+            index, num_shards = shard
+            if not 0 <= index < num_shards:
+                raise ValueError(f"shard index {index} not in [0, {num_shards})")
+            shard = (index, num_shards)
+        self.shard = shard
+
+    def set_resume(self, resume):
+        """
+        Set whether to resume from the checkpoint in the output directory of eval_id
+        """
+        if resume and not self.supports_checkpoints:
+            raise ValueError(f"{type(self).__name__} does not support checkpoints")
+        self.resume = bool(resume)
+
     @abc.abstractmethod
     def _evaluate(
         self,
@@ -169,6 +307,132 @@ class Scenario(abc.ABC):
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Encountered error {e} sending evaluation results to MongoDB")
 
+    def _save_metrics_state(self):
+        """
+        Save the state of self.metrics_logger, e.g., for merging with other shards
+        """
+        if self.metrics_logger is None:
+            logger.warning(f"{type(self).__name__} does not save a metrics state")
+            return
+        filepath = os.path.join(self.scenario_output_dir, METRICS_STATE_FILENAME)
+        logger.info(f"Saving metrics state to {filepath} path inside container.")
+        with open(filepath, "wb") as f:
+            f.write(self.metrics_logger.state())
+
+    def _checkpointed(
+        self, batches, phase, sample_exporter=None, label_targeter=None, flush=None
+    ):
+        """
+        Yield from batches for the given phase of evaluation (e.g., "benign")
+
+        If config["scenario"]["checkpoint_interval"] is set, the progress of the
+            evaluation is saved every checkpoint_interval batches and at the end of
+            the phase. It includes self.metrics_logger, the given sample_exporter and
+            label_targeter, and random number generator states. flush, if given, is
+            called before saving to wait for pending updates of those.
+
+        When resuming, phases completed before the checkpoint yield nothing, and the
+            batches processed before the checkpoint are skipped. If batches, or the
+            iterable wrapped by a tqdm batches, has a skip method (as EvalGenerator
+            does), they are skipped in the dataset, and otherwise read but not
+            yielded.
+        """
+        checkpoint = self._checkpoint
+        start = 0
+        if checkpoint is not None:
+            if checkpoint["metrics_state"] is not None:
+                self.metrics_logger.load_state(checkpoint["metrics_state"])
+                checkpoint["metrics_state"] = None
+            if phase in checkpoint["completed_phases"]:
+                logger.info(f"Skipping {phase} phase completed before checkpoint")
+                self._completed_phases.append(phase)
+                return
+            self._checkpoint = None
+            if checkpoint["phase"] == phase:
+                start = checkpoint["batch"]
+
+        if start:
+            logger.info(f"Skipping {start} {phase} batches processed before checkpoint")
+            source = getattr(batches, "iterable", batches)
+            if hasattr(source, "skip"):
+                source.skip(start)
+                if hasattr(batches, "update"):
+                    batches.update(start)
+            else:
+                batches = iter(batches)
+                for _ in range(start):
+                    next(batches, None)
+        if checkpoint is not None:
+            if sample_exporter is not None and checkpoint["sample_exporter"]:
+                sample_exporter.load_state(checkpoint["sample_exporter"])
+            if label_targeter is not None and checkpoint["label_targeter"]:
+                vars(label_targeter).update(checkpoint["label_targeter"])
+            _set_rng_states(checkpoint["rng_states"])
+
+        batch = start
+        for x_y in batches:
+            yield x_y
+            batch += 1
+            if self.checkpoint_interval and batch % self.checkpoint_interval == 0:
+                if flush is not None:
+                    flush()
+                self._save_checkpoint(phase, batch, sample_exporter, label_targeter)
+        self._completed_phases.append(phase)
+        if self.checkpoint_interval:
+            if flush is not None:
+                flush()
+            self._save_checkpoint(None, 0, sample_exporter, label_targeter)
+
+    def _checkpoint_path(self):
+        return os.path.join(self.scenario_output_dir, CHECKPOINT_FILENAME)
+
+    def _save_checkpoint(self, phase, batch, sample_exporter, label_targeter):
+        """
+        Save the progress of evaluation after batch batches of phase (None between
+            phases), replacing any previous checkpoint
+        """
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "config": self._checkpoint_key,
+            "completed_phases": list(self._completed_phases),
+            "phase": phase,
+            "batch": batch,
+            "metrics_state": self.metrics_logger.state(),
+            "sample_exporter": None,
+            "label_targeter": None,
+            "rng_states": _get_rng_states(),
+        }
+        if sample_exporter is not None:
+            checkpoint["sample_exporter"] = sample_exporter.state()
+        if label_targeter is not None:
+            checkpoint["label_targeter"] = copy.deepcopy(vars(label_targeter))
+
+        filepath = self._checkpoint_path()
+        logger.debug(f"Saving checkpoint of {phase} batch {batch} to {filepath}")
+        # Write a temporary file first, so that interruptions leave a checkpoint
+        with open(filepath + ".tmp", "wb") as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filepath + ".tmp", filepath)
+
+    def _load_checkpoint(self):
+        filepath = self._checkpoint_path()
+        if not os.path.isfile(filepath):
+            logger.warning(f"No checkpoint at {filepath}. Evaluating from the start")
+            return
+        logger.info(f"Resuming from checkpoint {filepath}")
+        with open(filepath, "rb") as f:
+            checkpoint = pickle.load(f)
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(
+                f"Checkpoint version {checkpoint.get('version')} != {CHECKPOINT_VERSION}"
+            )
+        if checkpoint["config"] != self._checkpoint_key:
+            raise ValueError(
+                f"Checkpoint {filepath} was saved for a different config or "
+                "evaluation options"
+            )
+        self._checkpoint = checkpoint
+
     def _set_output_dir(self, config):
         runtime_paths = paths.runtime_paths()
         self.scenario_output_dir = os.path.join(
@@ -176,6 +440,30 @@ class Scenario(abc.ABC):
         )
 
 
+def _get_rng_states():
+    """
+    Return the states of the python, numpy, and (if imported) torch random number
+        generators
+    """
+    states = {"random": random.getstate(), "numpy": np.random.get_state()}
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        states["torch"] = torch.get_rng_state()
+        if torch.cuda.is_available():
+            states["torch.cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def _set_rng_states(states):
+    random.setstate(states["random"])
+    np.random.set_state(states["numpy"])
+    torch = sys.modules.get("torch")
+    if torch is not None and "torch" in states:
+        torch.set_rng_state(states["torch"])
+        if "torch.cuda" in states and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(states["torch.cuda"])
+
+
 def parse_config(config_path):
     with open(config_path) as f:
         config = json.load(f)
@@ -253,6 +541,8 @@ def run_config(
     num_eval_batches=None,
     skip_benign=None,
     skip_attack=None,
+    shard=None,
+    resume=False,
 ):
     config = _get_config(config_json, from_file=from_file)
     scenario_config = config.get("scenario")
@@ -261,9 +551,23 @@ def run_config(
     _scenario_setup(config)
     scenario = config_loading.load(scenario_config)
     scenario.set_check_run(check)
+    scenario.set_shard(shard)
+    scenario.set_resume(resume)
     scenario.evaluate(config, mongo_host, num_eval_batches, skip_benign, skip_attack)
 
 
+def run_merge_shards(
+    config_json, shard_eval_ids, from_file=False, mongo_host=None,
+):
+    config = _get_config(config_json, from_file=from_file)
+    scenario_config = config.get("scenario")
+    if scenario_config is None:
+        raise KeyError('"scenario" missing from evaluation config')
+    _scenario_setup(config)
+    scenario = config_loading.load(scenario_config)
+    scenario.merge_shards(config, shard_eval_ids, mongo_host)
+
+
 def init_interactive(config_json, from_file=True):
     """
     Init environment variables from config to setup environment for interactive use.
@@ -330,6 +634,22 @@ if __name__ == "__main__":
         action="store_true",
         help="Validate model configuration against several checks",
     )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Evaluate only shard <index>/<num_shards> of the evaluation data",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="<eval_id>",
+        help="Merge the metrics of the given sharded evaluations instead of evaluating",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the checkpoint in the output directory of the eval_id",
+    )
     args = parser.parse_args()
     coloredlogs.install(level=args.log_level)
     calling_version = os.getenv(environment.ARMORY_VERSION, "UNKNOWN")
@@ -351,6 +671,10 @@ if __name__ == "__main__":
         run_validation(
             args.config, args.from_file,
         )
+    elif args.merge_shards:
+        run_merge_shards(
+            args.config, args.merge_shards, args.from_file, args.mongo_host,
+        )
     else:
         run_config(
             args.config,
@@ -360,5 +684,7 @@ if __name__ == "__main__":
             args.num_eval_batches,
             args.skip_benign,
             args.skip_attack,
+            args.shard,
+            args.resume,
         )
     print(END_SENTINEL)  # indicates to host that the scenario finished w/out error
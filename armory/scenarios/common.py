@@ -1 +1,14 @@
 END_SENTINEL = "Scenario has finished running cleanly"
+
+
+def parse_shard(shard: str):
+    """
+    Parse a shard of the form "<index>/<num_shards>", e.g. "0/4", into a tuple
+    """
+    try:
+        index, num_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"shard {shard} is not of the form '<index>/<num_shards>'")
+    if not 0 <= index < num_shards:
+        raise ValueError(f"shard index {index} not in [0, {num_shards})")
+    return index, num_shards
@@ -3,6 +3,8 @@ General image recognition scenario for image classification and object detection
 """
 
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from copy import deepcopy
 
@@ -18,14 +20,21 @@ from armory.utils.config_loading import (
     load_defense_internal,
     load_label_targeter,
 )
+from armory.utils import instrumentation
 from armory.utils import metrics
 from armory.scenarios.base import Scenario
 from armory.utils.export import SampleExporter
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of batches awaiting metric updates in pipelined evaluation
+MAX_PENDING_BATCHES = 4
+
 
 class ImageClassificationTask(Scenario):
+    supports_sharding = True
+    supports_checkpoints = True
+
     def _evaluate(
         self,
         config: dict,
@@ -98,8 +107,20 @@ class ImageClassificationTask(Scenario):
             skip_attack=skip_attack,
             targeted=targeted,
         )
+        self.metrics_logger = metrics_logger
 
         eval_split = config["dataset"].get("eval_split", "test")
+        if config["scenario"].get("pipelined"):
+            if skip_benign or skip_attack or attack_type == "preloaded":
+                logger.warning(
+                    "Pipelined evaluation requires both benign and generated "
+                    "adversarial examples. Running separate passes instead."
+                )
+            else:
+                return self._evaluate_pipelined(
+                    config, estimator, metrics_logger, num_eval_batches, targeted
+                )
+
         if skip_benign:
             logger.info("Skipping benign classification...")
         else:
@@ -114,16 +135,16 @@ class ImageClassificationTask(Scenario):
             )
 
             logger.info("Running inference on benign examples...")
-            for x, y in tqdm(test_data, desc="Benign"):
-                # Ensure that input sample isn't overwritten by estimator
-                x.flags.writeable = False
-                with metrics.resource_context(
-                    name="Inference",
-                    profiler=config["metric"].get("profiler_type"),
-                    computational_resource_dict=metrics_logger.computational_resource_dict,
+            with instrumentation.span("benign"):
+                for x, y in self._checkpointed(
+                    tqdm(test_data, desc="Benign"), "benign"
                 ):
-                    y_pred = estimator.predict(x)
-                metrics_logger.update_task(y, y_pred)
+                    # Ensure that input sample isn't overwritten by estimator
+                    x.flags.writeable = False
+                    with instrumentation.span("predict"):
+                        y_pred = estimator.predict(x)
+                    with instrumentation.span("metrics"):
+                        metrics_logger.update_task(y, y_pred)
             metrics_logger.log_task()
 
         if skip_attack:
@@ -159,54 +180,178 @@ class ImageClassificationTask(Scenario):
                 num_batches=num_eval_batches,
                 shuffle_files=False,
             )
-            if targeted:
-                label_targeter = load_label_targeter(attack_config["targeted_labels"])
+        label_targeter = None
+        if targeted and attack_type != "preloaded":
+            label_targeter = load_label_targeter(attack_config["targeted_labels"])
 
-        export_samples = config["scenario"].get("export_samples")
-        if export_samples is not None and export_samples > 0:
-            sample_exporter = SampleExporter(
-                self.scenario_output_dir, test_data.context, export_samples
-            )
-        else:
-            sample_exporter = None
+        sample_exporter = self._load_sample_exporter(config, test_data)
 
-        for x, y in tqdm(test_data, desc="Attack"):
-            with metrics.resource_context(
-                name="Attack",
-                profiler=config["metric"].get("profiler_type"),
-                computational_resource_dict=metrics_logger.computational_resource_dict,
+        with instrumentation.span("attack"):
+            for x, y in self._checkpointed(
+                tqdm(test_data, desc="Attack"),
+                "attack",
+                sample_exporter,
+                label_targeter,
             ):
                 if attack_type == "preloaded":
                     if len(x) == 2:
                         x, x_adv = x
                     else:
                         x_adv = x
+                    y_target = None
                     if targeted:
                         y, y_target = y
                 else:
-                    generate_kwargs = deepcopy(attack_config.get("generate_kwargs", {}))
-                    # Temporary workaround for ART code requirement of ndarray mask
-                    if "mask" in generate_kwargs:
-                        generate_kwargs["mask"] = np.array(generate_kwargs["mask"])
-                    if attack_config.get("use_label"):
-                        generate_kwargs["y"] = y
-                    elif targeted:
-                        y_target = label_targeter.generate(y)
-                        generate_kwargs["y"] = y_target
-                    x_adv = attack.generate(x=x, **generate_kwargs)
-
-            # Ensure that input sample isn't overwritten by estimator
-            x_adv.flags.writeable = False
-            y_pred_adv = estimator.predict(x_adv)
+                    with instrumentation.span("generate"):
+                        x_adv, y_target = self._generate(
+                            attack, attack_config, x, y, label_targeter
+                        )
+
+                # Ensure that input sample isn't overwritten by estimator
+                x_adv.flags.writeable = False
+                with instrumentation.span("predict"):
+                    y_pred_adv = estimator.predict(x_adv)
+                self._update_adversarial(
+                    metrics_logger, sample_exporter, x, x_adv, y, y_target, y_pred_adv
+                )
+        metrics_logger.log_task(adversarial=True)
+        if targeted:
+            metrics_logger.log_task(adversarial=True, targeted=True)
+        return metrics_logger.results()
+
+    def _evaluate_pipelined(
+        self,
+        config: dict,
+        estimator,
+        metrics_logger: metrics.MetricsLogger,
+        num_eval_batches: Optional[int],
+        targeted: bool,
+    ) -> dict:
+        """
+        Evaluate benign and adversarial examples in a single pass over the test set
+
+        Each batch is loaded once and used for benign inference, attack generation,
+            and adversarial inference. Metric updates and sample export run in order
+            on a background thread, so they overlap with the next batch. Unless the
+            dataset config sets prefetch_batches, one batch is loaded in advance.
+        """
+        attack_config = config["attack"]
+        if targeted and attack_config.get("use_label"):
+            raise ValueError("Targeted attacks cannot have 'use_label'")
+        attack = load_attack(attack_config, estimator)
+        if targeted != getattr(attack, "targeted", False):
+            logger.warning(
+                f"targeted config {targeted} != attack field {getattr(attack, 'targeted', False)}"
+            )
+        label_targeter = None
+        if targeted:
+            label_targeter = load_label_targeter(attack_config["targeted_labels"])
+
+        logger.info(f"Loading test dataset {config['dataset']['name']}...")
+        test_data = load_dataset(
+            {"prefetch_batches": 1, **config["dataset"]},
+            epochs=1,
+            split=config["dataset"].get("eval_split", "test"),
+            num_batches=num_eval_batches,
+            shuffle_files=False,
+        )
+        sample_exporter = self._load_sample_exporter(config, test_data)
+
+        logger.info("Running inference on benign and adversarial examples...")
+        with ThreadPoolExecutor(max_workers=1) as worker, instrumentation.span(
+            "pipelined"
+        ):
+            pending = deque()
+
+            def flush():
+                while pending:
+                    pending.popleft().result()
+
+            for x, y in self._checkpointed(
+                tqdm(test_data, desc="Benign and attack"),
+                "pipelined",
+                sample_exporter,
+                label_targeter,
+                flush,
+            ):
+                # Ensure that input sample isn't overwritten by estimator
+                x.flags.writeable = False
+                with instrumentation.span("predict"):
+                    y_pred = estimator.predict(x)
+                with instrumentation.span("generate"):
+                    x_adv, y_target = self._generate(
+                        attack, attack_config, x, y, label_targeter
+                    )
+                x_adv.flags.writeable = False
+                with instrumentation.span("predict adversarial"):
+                    y_pred_adv = estimator.predict(x_adv)
+
+                pending.append(
+                    worker.submit(self._update_benign, metrics_logger, y, y_pred)
+                )
+                pending.append(
+                    worker.submit(
+                        self._update_adversarial,
+                        metrics_logger,
+                        sample_exporter,
+                        x,
+                        x_adv,
+                        y,
+                        y_target,
+                        y_pred_adv,
+                    )
+                )
+                # Surface errors early and bound the batches held in memory
+                while pending and (
+                    pending[0].done() or len(pending) > 2 * MAX_PENDING_BATCHES
+                ):
+                    pending.popleft().result()
+            flush()
+
+        metrics_logger.log_task()
+        metrics_logger.log_task(adversarial=True)
+        if targeted:
+            metrics_logger.log_task(adversarial=True, targeted=True)
+        return metrics_logger.results()
+
+    def _generate(self, attack, attack_config, x, y, label_targeter=None):
+        """
+        Return adversarial examples for x and the target labels (or None)
+        """
+        y_target = None
+        generate_kwargs = deepcopy(attack_config.get("generate_kwargs", {}))
+        # Temporary workaround for ART code requirement of ndarray mask
+        if "mask" in generate_kwargs:
+            generate_kwargs["mask"] = np.array(generate_kwargs["mask"])
+        if attack_config.get("use_label"):
+            generate_kwargs["y"] = y
+        elif label_targeter is not None:
+            y_target = label_targeter.generate(y)
+            generate_kwargs["y"] = y_target
+        return attack.generate(x=x, **generate_kwargs), y_target
+
+    def _update_benign(self, metrics_logger, y, y_pred):
+        with instrumentation.span("metrics"):
+            metrics_logger.update_task(y, y_pred)
+
+    def _update_adversarial(
+        self, metrics_logger, sample_exporter, x, x_adv, y, y_target, y_pred_adv
+    ):
+        with instrumentation.span("metrics"):
             metrics_logger.update_task(y, y_pred_adv, adversarial=True)
-            if targeted:
+            if y_target is not None:
                 metrics_logger.update_task(
                     y_target, y_pred_adv, adversarial=True, targeted=True
                 )
             metrics_logger.update_perturbation(x, x_adv)
-            if sample_exporter is not None:
+        if sample_exporter is not None:
+            with instrumentation.span("export"):
                 sample_exporter.export(x, x_adv, y, y_pred_adv)
-        metrics_logger.log_task(adversarial=True)
-        if targeted:
-            metrics_logger.log_task(adversarial=True, targeted=True)
-        return metrics_logger.results()
+
+    def _load_sample_exporter(self, config, test_data):
+        export_samples = config["scenario"].get("export_samples")
+        if export_samples is not None and export_samples > 0:
+            return SampleExporter(
+                self.scenario_output_dir, test_data.context, export_samples
+            )
+        return None
@@ -18,6 +18,7 @@ from armory.utils.config_loading import (
     load_defense_internal,
     load_label_targeter,
 )
+from armory.utils import instrumentation
 from armory.utils import metrics
 from armory.scenarios.base import Scenario
 from armory.utils.export import SampleExporter
@@ -172,16 +173,14 @@ class So2SatClassification(Scenario):
             )
 
             logger.info("Running inference on benign examples...")
-            for x, y in tqdm(test_data, desc="Benign"):
-                # Ensure that input sample isn't overwritten by estimator
-                x.flags.writeable = False
-                with metrics.resource_context(
-                    name="Inference",
-                    profiler=config["metric"].get("profiler_type"),
-                    computational_resource_dict=performance_logger.computational_resource_dict,
-                ):
-                    y_pred = estimator.predict(x)
-                performance_logger.update_task(y, y_pred)
+            with instrumentation.span("benign"):
+                for x, y in tqdm(test_data, desc="Benign"):
+                    # Ensure that input sample isn't overwritten by estimator
+                    x.flags.writeable = False
+                    with instrumentation.span("predict"):
+                        y_pred = estimator.predict(x)
+                    with instrumentation.span("metrics"):
+                        performance_logger.update_task(y, y_pred)
             performance_logger.log_task()
 
         if skip_attack:
@@ -247,74 +246,84 @@ class So2SatClassification(Scenario):
         else:
             sample_exporter = None
 
-        for x, y in tqdm(test_data, desc="Attack"):
-            with metrics.resource_context(
-                name="Attack",
-                profiler=config["metric"].get("profiler_type"),
-                computational_resource_dict=performance_logger.computational_resource_dict,
-            ):
-                if attack_type == "preloaded":
-                    logger.warning(
-                        "Specified preloaded attack. Ignoring `attack_modality` parameter"
-                    )
-                    if len(x) == 2:
-                        x, x_adv = x
+        with instrumentation.span("attack"):
+            for x, y in tqdm(test_data, desc="Attack"):
+                with instrumentation.span("generate"):
+                    if attack_type == "preloaded":
+                        logger.warning(
+                            "Specified preloaded attack. Ignoring `attack_modality` parameter"
+                        )
+                        if len(x) == 2:
+                            x, x_adv = x
+                        else:
+                            x_adv = x
+                        if targeted:
+                            y, y_target = y
                     else:
-                        x_adv = x
+                        generate_kwargs = deepcopy(
+                            attack_config.get("generate_kwargs", {})
+                        )
+                        generate_kwargs["mask"] = attack_channels_mask
+                        if attack_config.get("use_label"):
+                            generate_kwargs["y"] = y
+                        elif targeted:
+                            y_target = label_targeter.generate(y)
+                            generate_kwargs["y"] = y_target
+                        x_adv = attack.generate(x=x, **generate_kwargs)
+
+                # Ensure that input sample isn't overwritten by estimator
+                x_adv.flags.writeable = False
+                with instrumentation.span("predict"):
+                    y_pred_adv = estimator.predict(x_adv)
+                with instrumentation.span("metrics"):
+                    performance_logger.update_task(y, y_pred_adv, adversarial=True)
                     if targeted:
-                        y, y_target = y
-                else:
-                    generate_kwargs = deepcopy(attack_config.get("generate_kwargs", {}))
-                    generate_kwargs["mask"] = attack_channels_mask
-                    if attack_config.get("use_label"):
-                        generate_kwargs["y"] = y
-                    elif targeted:
-                        y_target = label_targeter.generate(y)
-                        generate_kwargs["y"] = y_target
-                    x_adv = attack.generate(x=x, **generate_kwargs)
-
-            # Ensure that input sample isn't overwritten by estimator
-            x_adv.flags.writeable = False
-            y_pred_adv = estimator.predict(x_adv)
-            performance_logger.update_task(y, y_pred_adv, adversarial=True)
-            if targeted:
-                performance_logger.update_task(
-                    y_target, y_pred_adv, adversarial=True, targeted=True
-                )
+                        performance_logger.update_task(
+                            y_target, y_pred_adv, adversarial=True, targeted=True
+                        )
 
-            # Update perturbation metrics for SAR/EO separately
-            x_sar = np.stack(
-                (x[..., 0] + 1j * x[..., 1], x[..., 2] + 1j * x[..., 3]), axis=3
-            )
-            x_adv_sar = np.stack(
-                (
-                    x_adv[..., 0] + 1j * x_adv[..., 1],
-                    x_adv[..., 2] + 1j * x_adv[..., 3],
-                ),
-                axis=3,
-            )
-            x_eo = x[..., 4:]
-            x_adv_eo = x_adv[..., 4:]
-            if sar_perturbation_logger is not None:
-                sar_perturbation_logger.update_perturbation(x_sar, x_adv_sar)
-            if eo_perturbation_logger is not None:
-                eo_perturbation_logger.update_perturbation(x_eo, x_adv_eo)
+                    # Update perturbation metrics for SAR/EO separately
+                    x_sar = np.stack(
+                        (x[..., 0] + 1j * x[..., 1], x[..., 2] + 1j * x[..., 3]), axis=3
+                    )
+                    x_adv_sar = np.stack(
+                        (
+                            x_adv[..., 0] + 1j * x_adv[..., 1],
+                            x_adv[..., 2] + 1j * x_adv[..., 3],
+                        ),
+                        axis=3,
+                    )
+                    x_eo = x[..., 4:]
+                    x_adv_eo = x_adv[..., 4:]
+                    if sar_perturbation_logger is not None:
+                        sar_perturbation_logger.update_perturbation(x_sar, x_adv_sar)
+                    if eo_perturbation_logger is not None:
+                        eo_perturbation_logger.update_perturbation(x_eo, x_adv_eo)
 
-            if sample_exporter is not None:
-                sample_exporter.export(x, x_adv, y, y_pred_adv)
+                if sample_exporter is not None:
+                    with instrumentation.span("export"):
+                        sample_exporter.export(x, x_adv, y, y_pred_adv)
 
         performance_logger.log_task(adversarial=True)
         if targeted:
             performance_logger.log_task(adversarial=True, targeted=True)
 
-        # Merge performance, SAR, EO results
+        # Merge performance, SAR, EO results. Timing is shared by all loggers
         combined_results = performance_logger.results()
         if sar_perturbation_logger is not None:
             combined_results.update(
-                {f"sar_{k}": v for k, v in sar_perturbation_logger.results().items()}
+                {
+                    f"sar_{k}": v
+                    for k, v in sar_perturbation_logger.results().items()
+                    if k != "timing"
+                }
             )
         if eo_perturbation_logger is not None:
             combined_results.update(
-                {f"eo_{k}": v for k, v in eo_perturbation_logger.results().items()}
+                {
+                    f"eo_{k}": v
+                    for k, v in eo_perturbation_logger.results().items()
+                    if k != "timing"
+                }
             )
         return combined_results
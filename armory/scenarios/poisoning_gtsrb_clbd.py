@@ -15,65 +15,76 @@ from tensorflow import set_random_seed, ConfigProto, Session
 from tensorflow.keras.backend import set_session
 from tensorflow.keras.utils import to_categorical
 from tqdm import tqdm
-from PIL import ImageOps, Image
 
 from art.defences.trainer import AdversarialTrainerMadryPGD
 
+from armory.art_experimental.attacks.poison_loader import poison_images
+from armory.data import image_ops
+from armory.data.training_store import TrainingStore, compact
 from armory.utils.config_loading import (
     load_dataset,
     load_model,
     load,
     load_fn,
 )
+from armory.utils import instrumentation
 from armory.utils import metrics
 from armory.scenarios.base import Scenario
+from armory.scenarios import poisoning_sweep
 
 logger = logging.getLogger(__name__)
 
 
 def poison_scenario_preprocessing(batch):
     img_size = 48
-    img_out = []
     quantization = 255.0
-    for im in batch:
-        img_eq = ImageOps.equalize(Image.fromarray(im))
-        width, height = img_eq.size
-        min_side = min(img_eq.size)
-        center = width // 2, height // 2
+    # Equalize, center crop, and resize as PIL would, batched and across threads
+    img_out = image_ops.equalize_crop_resize(
+        batch, (img_size, img_size), num_workers=None
+    )
+    return np.array(img_out / quantization, dtype=np.float32)
 
-        left = center[0] - min_side // 2
-        top = center[1] - min_side // 2
-        right = center[0] + min_side // 2
-        bottom = center[1] + min_side // 2
 
-        img_eq = img_eq.crop((left, top, right, bottom))
-        img_eq = np.array(img_eq.resize([img_size, img_size])) / quantization
-
-        img_out.append(img_eq)
-
-    return np.array(img_out, dtype=np.float32)
-
-
-def poison_dataset(src_imgs, src_lbls, src, tgt, ds_size, attack, poisoned_indices):
+def poison_dataset(
+    src_imgs, src_lbls, src, tgt, ds_size, attack, poisoned_indices, inplace=False
+):
     # In this example, all images of "src" class have a trigger
     # added and re-labeled as "tgt" class
-    poison_x = []
-    poison_y = []
-    for idx in range(ds_size):
-        if src_lbls[idx] == src and idx in poisoned_indices:
-            src_img = src_imgs[idx]
-            p_img, p_label = attack.poison(src_img, [tgt])
-            poison_x.append(p_img)
-            poison_y.append(p_label)
-        else:
-            poison_x.append(src_imgs[idx])
-            poison_y.append(src_lbls[idx])
-    poison_x, poison_y = np.array(poison_x), np.array(poison_y)
+    #
+    # poisoned_indices may be an index array or a boolean mask of length ds_size
+    # If inplace, src_imgs and src_lbls are modified and returned instead of copied
+    poisoned = np.zeros(ds_size, dtype=bool)
+    poisoned[poisoned_indices] = True
+    poisoned &= src_lbls[:ds_size] == src
+
+    if inplace:
+        poison_x, poison_y = src_imgs[:ds_size], src_lbls[:ds_size]
+    else:
+        poison_x, poison_y = np.array(src_imgs[:ds_size]), np.array(src_lbls[:ds_size])
+    if poisoned.any():
+        poison_x[poisoned] = poison_images(attack, poison_x[poisoned], tgt)
+        poison_y[poisoned] = tgt
 
     return poison_x, poison_y
 
 
 class GTSRB_CLBD(Scenario):
+    def __init__(self):
+        super().__init__()
+        # Preprocessed clean splits shared by the trials of a sweep
+        self.shared_datasets = {}
+
+    def _load_clean_dataset(self, config: dict, split: str):
+        if split in self.shared_datasets:
+            return self.shared_datasets[split]
+        return load_dataset(
+            config["dataset"],
+            epochs=1,
+            split=split,
+            preprocessing_fn=poison_scenario_preprocessing,
+            shuffle_files=False,
+        )
+
     def _evaluate(
         self,
         config: dict,
@@ -96,12 +107,25 @@ class GTSRB_CLBD(Scenario):
         if skip_attack:
             raise ValueError("skip_attack shouldn't be set for poisoning scenario")
 
+        config_adhoc = config.get("adhoc") or {}
+        if config_adhoc.get("sweep"):
+            splits = [
+                config["dataset"].get("train_split", "train"),
+                config["dataset"].get("eval_split", "test"),
+            ]
+            return poisoning_sweep.run_sweep(
+                self,
+                config,
+                splits,
+                lambda split: self._load_clean_dataset(config, split),
+                fraction_path=("attack", "kwargs", "pp_poison"),
+            )
+
         model_config = config["model"]
         # Scenario assumes canonical preprocessing_fn is used makes images all same size
         classifier, _ = load_model(model_config)
         proxy_classifier, _ = load_model(model_config)
 
-        config_adhoc = config.get("adhoc") or {}
         train_epochs = config_adhoc["train_epochs"]
         src_class = config_adhoc["source_class"]
         tgt_class = config_adhoc["target_class"]
@@ -126,26 +150,21 @@ class GTSRB_CLBD(Scenario):
 
         logger.info(f"Loading dataset {config['dataset']['name']}...")
 
-        clean_data = load_dataset(
-            config["dataset"],
-            epochs=1,
-            split=config["dataset"].get("train_split", "train"),
-            preprocessing_fn=poison_scenario_preprocessing,
-            shuffle_files=False,
+        clean_data = self._load_clean_dataset(
+            config, config["dataset"].get("train_split", "train")
         )
         # Flag for whether to poison dataset -- used to evaluate
         #     performance of defense on clean data
         poison_dataset_flag = config["adhoc"]["poison_dataset"]
         # detect_poison does not currently support data generators
-        #     therefore, make in memory dataset
-        x_train_all, y_train_all = [], []
-
-        logger.info("Building in-memory dataset for poisoning detection and training")
+        #     therefore, make a memory-mapped dataset
+        logger.info(
+            "Building memory-mapped dataset for poisoning detection and training"
+        )
+        train_store = TrainingStore(clean_data.samples_per_epoch)
         for x_train, y_train in clean_data:
-            x_train_all.append(x_train)
-            y_train_all.append(y_train)
-        x_train_all = np.concatenate(x_train_all, axis=0)
-        y_train_all = np.concatenate(y_train_all, axis=0)
+            train_store.append(x_train, y_train)
+        x_train_all, y_train_all = train_store.x, train_store.y
 
         if poison_dataset_flag:
             y_train_all_categorical = to_categorical(y_train_all)
@@ -188,6 +207,7 @@ class GTSRB_CLBD(Scenario):
                 x_train_all, y_train_all_categorical
             )
             y_train_all = np.argmax(y_train_all_categorical, axis=1)
+            del y_train_all_categorical
 
         if use_poison_filtering_defense:
             y_train_defense = to_categorical(y_train_all)
@@ -209,8 +229,9 @@ class GTSRB_CLBD(Scenario):
 
             logger.info("Filtering out detected poisoned samples")
             indices_to_keep = is_clean == 1
-            x_train_final = x_train_all[indices_to_keep]
-            y_train_final = y_train_all[indices_to_keep]
+            del defense, y_train_defense
+            x_train_final = compact(x_train_all, indices_to_keep)
+            y_train_final = compact(y_train_all, indices_to_keep)
         else:
             logger.info(
                 "Defense does not require filtering. Model fitting will use all data."
@@ -221,31 +242,29 @@ class GTSRB_CLBD(Scenario):
             logger.info(
                 f"Fitting model of {model_config['module']}.{model_config['name']}..."
             )
-            classifier.fit(
-                x_train_final,
-                y_train_final,
-                batch_size=fit_batch_size,
-                nb_epochs=train_epochs,
-                verbose=False,
-                shuffle=True,
-            )
+            with instrumentation.span("fit"):
+                classifier.fit(
+                    x_train_final,
+                    y_train_final,
+                    batch_size=fit_batch_size,
+                    nb_epochs=train_epochs,
+                    verbose=False,
+                    shuffle=True,
+                )
         else:
             logger.warning("All data points filtered by defense. Skipping training")
 
         logger.info("Validating on clean test data")
-        test_data = load_dataset(
-            config["dataset"],
-            epochs=1,
-            split=config["dataset"].get("eval_split", "test"),
-            preprocessing_fn=poison_scenario_preprocessing,
-            shuffle_files=False,
+        test_data = self._load_clean_dataset(
+            config, config["dataset"].get("eval_split", "test")
         )
         benign_validation_metric = metrics.MetricList("categorical_accuracy")
         target_class_benign_metric = metrics.MetricList("categorical_accuracy")
         for x, y in tqdm(test_data, desc="Testing"):
             # Ensure that input sample isn't overwritten by classifier
             x.flags.writeable = False
-            y_pred = classifier.predict(x)
+            with instrumentation.span("predict"):
+                y_pred = classifier.predict(x)
             benign_validation_metric.append(y, y_pred)
             y_pred_tgt_class = y_pred[y == src_class]
             if len(y_pred_tgt_class):
@@ -268,12 +287,8 @@ class GTSRB_CLBD(Scenario):
 
         if poison_dataset_flag:
             logger.info("Testing on poisoned test data")
-            test_data = load_dataset(
-                config["dataset"],
-                epochs=1,
-                split=config["dataset"].get("eval_split", "test"),
-                preprocessing_fn=poison_scenario_preprocessing,
-                shuffle_files=False,
+            test_data = self._load_clean_dataset(
+                config, config["dataset"].get("eval_split", "test")
             )
             for x_test, y_test in tqdm(test_data, desc="Testing"):
                 src_indices = np.where(y_test == src_class)[0]
@@ -287,7 +302,8 @@ class GTSRB_CLBD(Scenario):
                     backdoor,
                     poisoned_indices,
                 )
-                y_pred = classifier.predict(x_test)
+                with instrumentation.span("predict"):
+                    y_pred = classifier.predict(x_test)
                 poisoned_test_metric.append(y_test, y_pred)
 
                 y_pred_targeted = y_pred[y_test == src_class]
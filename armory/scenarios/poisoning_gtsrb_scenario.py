@@ -14,44 +14,37 @@ from tensorflow import set_random_seed, ConfigProto, Session
 from tensorflow.keras.backend import set_session
 from tensorflow.keras.utils import to_categorical
 from tqdm import tqdm
-from PIL import ImageOps, Image
 
+from armory.art_experimental.attacks.poison_loader import poison_images
+from armory.data import image_ops
+from armory.data.training_store import TrainingStore
 from armory.utils.config_loading import (
     load_dataset,
     load_model,
     load,
     load_fn,
 )
+from armory.utils import instrumentation
 from armory.utils import metrics
 from armory.scenarios.base import Scenario
+from armory.scenarios import poisoning_sweep
 
 logger = logging.getLogger(__name__)
 
 
 def poison_scenario_preprocessing(batch):
     img_size = 48
-    img_out = []
     quantization = 255.0
-    for im in batch:
-        img_eq = ImageOps.equalize(Image.fromarray(im))
-        width, height = img_eq.size
-        min_side = min(img_eq.size)
-        center = width // 2, height // 2
+    # Equalize, center crop, and resize as PIL would, batched and across threads
+    img_out = image_ops.equalize_crop_resize(
+        batch, (img_size, img_size), num_workers=None
+    )
+    return np.array(img_out / quantization, dtype=np.float32)
 
-        left = center[0] - min_side // 2
-        top = center[1] - min_side // 2
-        right = center[0] + min_side // 2
-        bottom = center[1] + min_side // 2
 
-        img_eq = img_eq.crop((left, top, right, bottom))
-        img_eq = np.array(img_eq.resize([img_size, img_size])) / quantization
-
-        img_out.append(img_eq)
-
-    return np.array(img_out, dtype=np.float32)
-
-
-def poison_dataset(src_imgs, src_lbls, src, tgt, ds_size, attack, poisoned_indices):
+def poison_dataset(
+    src_imgs, src_lbls, src, tgt, ds_size, attack, poisoned_indices, inplace=False
+):
     # In this example, all images of "src" class have a trigger
     # added and re-labeled as "tgt" class
     # NOTE: currently art.attacks.PoisonAttackBackdoor only supports
@@ -60,24 +53,43 @@ def poison_dataset(src_imgs, src_lbls, src, tgt, ds_size, attack, poisoned_indic
     #   (N,W,H,C) to N separate (C,W,H)-tuple, where C would be
     #   interpreted by PoisonAttackBackdoor as the batch size,
     #   and each channel would have a backdoor trigger added
-    poison_x = []
-    poison_y = []
-    for idx in range(ds_size):
-        if src_lbls[idx] == src and idx in poisoned_indices:
-            src_img = np.transpose(src_imgs[idx], (2, 0, 1))
-            p_img, p_label = attack.poison(src_img, [tgt])
-            poison_x.append(np.transpose(p_img, (1, 2, 0)))
-            poison_y.append(p_label)
-        else:
-            poison_x.append(src_imgs[idx])
-            poison_y.append(src_lbls[idx])
-
-    poison_x, poison_y = np.array(poison_x), np.array(poison_y)
+    #
+    # poisoned_indices may be an index array or a boolean mask of length ds_size
+    # If inplace, src_imgs and src_lbls are modified and returned instead of copied
+    poisoned = np.zeros(ds_size, dtype=bool)
+    poisoned[poisoned_indices] = True
+    poisoned &= src_lbls[:ds_size] == src
+
+    if inplace:
+        poison_x, poison_y = src_imgs[:ds_size], src_lbls[:ds_size]
+    else:
+        poison_x, poison_y = np.array(src_imgs[:ds_size]), np.array(src_lbls[:ds_size])
+    if poisoned.any():
+        poison_x[poisoned] = poison_images(
+            attack, poison_x[poisoned], tgt, axes=(2, 0, 1)
+        )
+        poison_y[poisoned] = tgt
 
     return poison_x, poison_y
 
 
 class GTSRB(Scenario):
+    def __init__(self):
+        super().__init__()
+        # Preprocessed clean splits shared by the trials of a sweep
+        self.shared_datasets = {}
+
+    def _load_clean_dataset(self, config: dict, split: str):
+        if split in self.shared_datasets:
+            return self.shared_datasets[split]
+        return load_dataset(
+            config["dataset"],
+            epochs=1,
+            split=split,
+            preprocessing_fn=poison_scenario_preprocessing,
+            shuffle_files=False,
+        )
+
     def _evaluate(
         self,
         config: dict,
@@ -100,11 +112,23 @@ class GTSRB(Scenario):
         if skip_attack:
             raise ValueError("skip_attack shouldn't be set for poisoning scenario")
 
+        config_adhoc = config.get("adhoc") or {}
+        if config_adhoc.get("sweep"):
+            splits = [
+                config["dataset"].get("train_split", "train"),
+                config["dataset"].get("eval_split", "test"),
+            ]
+            return poisoning_sweep.run_sweep(
+                self,
+                config,
+                splits,
+                lambda split: self._load_clean_dataset(config, split),
+            )
+
         model_config = config["model"]
         # Scenario assumes canonical preprocessing_fn is used makes images all same size
         classifier, _ = load_model(model_config)
 
-        config_adhoc = config.get("adhoc") or {}
         train_epochs = config_adhoc["train_epochs"]
         src_class = config_adhoc["source_class"]
         tgt_class = config_adhoc["target_class"]
@@ -129,12 +153,8 @@ class GTSRB(Scenario):
 
         logger.info(f"Loading dataset {config['dataset']['name']}...")
 
-        clean_data = load_dataset(
-            config["dataset"],
-            epochs=1,
-            split=config["dataset"].get("train_split", "train"),
-            preprocessing_fn=poison_scenario_preprocessing,
-            shuffle_files=False,
+        clean_data = self._load_clean_dataset(
+            config, config["dataset"].get("train_split", "train")
         )
 
         attack_config = config["attack"]
@@ -145,8 +165,8 @@ class GTSRB(Scenario):
         #     performance of defense on clean data
         poison_dataset_flag = config["adhoc"]["poison_dataset"]
         # detect_poison does not currently support data generators
-        #     therefore, make in memory dataset
-        x_train_all, y_train_all = [], []
+        #     therefore, make a memory-mapped dataset
+        num_preloaded = 0
 
         if attack_type == "preloaded":
             # Number of datapoints in train split of target clasc
@@ -155,6 +175,7 @@ class GTSRB(Scenario):
                 f"Loading poison dataset {config_adhoc['poison_samples']['name']}..."
             )
             num_poisoned = int(config_adhoc["fraction_poisoned"] * num_images_tgt_class)
+            num_preloaded = num_poisoned
             if num_poisoned == 0:
                 raise ValueError(
                     "For the preloaded attack, fraction_poisoned must be set so that at least on data point is poisoned."
@@ -168,50 +189,46 @@ class GTSRB(Scenario):
                 preprocessing_fn=None,
             )
 
-            logger.info(
-                "Building in-memory dataset for poisoning detection and training"
-            )
-            for x_clean, y_clean in clean_data:
-                x_train_all.append(x_clean)
-                y_train_all.append(y_clean)
-            x_poison, y_poison = poison_data.get_batch()
-            x_poison = np.array([xp for xp in x_poison], dtype=np.float32)
-            x_train_all.append(x_poison)
-            y_train_all.append(y_poison)
-            x_train_all = np.concatenate(x_train_all, axis=0)
-            y_train_all = np.concatenate(y_train_all, axis=0)
         else:
             attack = load(attack_config)
-            logger.info(
-                "Building in-memory dataset for poisoning detection and training"
-            )
-            for x_train, y_train in clean_data:
-                x_train_all.append(x_train)
-                y_train_all.append(y_train)
-            x_train_all = np.concatenate(x_train_all, axis=0)
-            y_train_all = np.concatenate(y_train_all, axis=0)
-            if poison_dataset_flag:
-                total_count = np.bincount(y_train_all)[src_class]
-                poison_count = int(fraction_poisoned * total_count)
-                if poison_count == 0:
-                    logger.warning(
-                        f"No poisons generated with fraction_poisoned {fraction_poisoned} for class {src_class}."
-                    )
-                src_indices = np.where(y_train_all == src_class)[0]
-                poisoned_indices = np.sort(
-                    np.random.choice(src_indices, size=poison_count, replace=False)
-                )
-                x_train_all, y_train_all = poison_dataset(
-                    x_train_all,
-                    y_train_all,
-                    src_class,
-                    tgt_class,
-                    y_train_all.shape[0],
-                    attack,
-                    poisoned_indices,
+
+        logger.info(
+            "Building memory-mapped dataset for poisoning detection and training"
+        )
+        train_store = TrainingStore(clean_data.samples_per_epoch + num_preloaded)
+        for x_train, y_train in clean_data:
+            train_store.append(x_train, y_train)
+        if attack_type == "preloaded":
+            x_poison, y_poison = poison_data.get_batch()
+            x_poison = np.array([xp for xp in x_poison], dtype=np.float32)
+            train_store.append(x_poison, y_poison)
+        x_train_all, y_train_all = train_store.x, train_store.y
+
+        if attack_type != "preloaded" and poison_dataset_flag:
+            total_count = np.bincount(y_train_all)[src_class]
+            poison_count = int(fraction_poisoned * total_count)
+            if poison_count == 0:
+                logger.warning(
+                    f"No poisons generated with fraction_poisoned {fraction_poisoned} for class {src_class}."
                 )
+            src_indices = np.where(y_train_all == src_class)[0]
+            poisoned_indices = np.sort(
+                np.random.choice(src_indices, size=poison_count, replace=False)
+            )
+            x_train_all, y_train_all = poison_dataset(
+                x_train_all,
+                y_train_all,
+                src_class,
+                tgt_class,
+                y_train_all.shape[0],
+                attack,
+                poisoned_indices,
+                inplace=True,
+            )
 
-        y_train_all_categorical = to_categorical(y_train_all)
+        # Labels stay sparse until needed, and are then made categorical over all
+        #     classes in the training data
+        num_classes = int(y_train_all.max()) + 1
 
         # Flag to determine whether defense_classifier is trained directly
         #     (default API) or is trained as part of detect_poisons method
@@ -225,7 +242,7 @@ class GTSRB(Scenario):
         )
         if use_poison_filtering_defense:
             if defense_categorical_labels:
-                y_train_defense = y_train_all_categorical
+                y_train_defense = to_categorical(y_train_all, num_classes)
             else:
                 y_train_defense = y_train_all
 
@@ -261,43 +278,41 @@ class GTSRB(Scenario):
 
             logger.info("Filtering out detected poisoned samples")
             indices_to_keep = is_clean == 1
-            x_train_final = x_train_all[indices_to_keep]
-            y_train_final = y_train_all_categorical[indices_to_keep]
+            del defense, y_train_defense
+            x_train_final, y_train_final = train_store.filter(indices_to_keep)
         else:
             logger.info(
                 "Defense does not require filtering. Model fitting will use all data."
             )
             x_train_final = x_train_all
-            y_train_final = y_train_all_categorical
+            y_train_final = y_train_all
         if len(x_train_final):
             logger.info(
                 f"Fitting model of {model_config['module']}.{model_config['name']}..."
             )
-            classifier.fit(
-                x_train_final,
-                y_train_final,
-                batch_size=fit_batch_size,
-                nb_epochs=train_epochs,
-                verbose=False,
-                shuffle=True,
-            )
+            with instrumentation.span("fit"):
+                classifier.fit(
+                    x_train_final,
+                    to_categorical(y_train_final, num_classes),
+                    batch_size=fit_batch_size,
+                    nb_epochs=train_epochs,
+                    verbose=False,
+                    shuffle=True,
+                )
         else:
             logger.warning("All data points filtered by defense. Skipping training")
 
         logger.info("Validating on clean test data")
-        test_data = load_dataset(
-            config["dataset"],
-            epochs=1,
-            split=config["dataset"].get("eval_split", "test"),
-            preprocessing_fn=poison_scenario_preprocessing,
-            shuffle_files=False,
+        test_data = self._load_clean_dataset(
+            config, config["dataset"].get("eval_split", "test")
         )
         benign_validation_metric = metrics.MetricList("categorical_accuracy")
         target_class_benign_metric = metrics.MetricList("categorical_accuracy")
         for x, y in tqdm(test_data, desc="Testing"):
             # Ensure that input sample isn't overwritten by classifier
             x.flags.writeable = False
-            y_pred = classifier.predict(x)
+            with instrumentation.span("predict"):
+                y_pred = classifier.predict(x)
             benign_validation_metric.append(y, y_pred)
             y_pred_tgt_class = y_pred[y == src_class]
             if len(y_pred_tgt_class):
@@ -330,32 +345,26 @@ class GTSRB(Scenario):
                 test_data_poison, desc="Testing poison"
             ):
                 x_poison_test = np.array([xp for xp in x_poison_test], dtype=np.float32)
-                y_pred = classifier.predict(x_poison_test)
+                with instrumentation.span("predict"):
+                    y_pred = classifier.predict(x_poison_test)
                 y_true = [src_class] * len(y_pred)
                 poisoned_targeted_test_metric.append(y_poison_test, y_pred)
                 poisoned_test_metric.append(y_true, y_pred)
-            test_data_clean = load_dataset(
-                config["dataset"],
-                epochs=1,
-                split=config["dataset"].get("eval_split", "test"),
-                preprocessing_fn=poison_scenario_preprocessing,
-                shuffle_files=False,
+            test_data_clean = self._load_clean_dataset(
+                config, config["dataset"].get("eval_split", "test")
             )
             for x_clean_test, y_clean_test in tqdm(
                 test_data_clean, desc="Testing clean"
             ):
                 x_clean_test = np.array([xp for xp in x_clean_test], dtype=np.float32)
-                y_pred = classifier.predict(x_clean_test)
+                with instrumentation.span("predict"):
+                    y_pred = classifier.predict(x_clean_test)
                 poisoned_test_metric.append(y_clean_test, y_pred)
 
         elif poison_dataset_flag:
             logger.info("Testing on poisoned test data")
-            test_data = load_dataset(
-                config["dataset"],
-                epochs=1,
-                split=config["dataset"].get("eval_split", "test"),
-                preprocessing_fn=poison_scenario_preprocessing,
-                shuffle_files=False,
+            test_data = self._load_clean_dataset(
+                config, config["dataset"].get("eval_split", "test")
             )
             for x_test, y_test in tqdm(test_data, desc="Testing"):
                 src_indices = np.where(y_test == src_class)[0]
@@ -369,7 +378,8 @@ class GTSRB(Scenario):
                     attack,
                     poisoned_indices,
                 )
-                y_pred = classifier.predict(x_test)
+                with instrumentation.span("predict"):
+                    y_pred = classifier.predict(x_test)
                 poisoned_test_metric.append(y_test, y_pred)
 
                 y_pred_targeted = y_pred[y_test == src_class]
@@ -0,0 +1,260 @@
+"""
+Sweeps of poisoning scenarios over random seeds and poisoning fractions
+
+Poisoning results are only meaningful when averaged over many split_id seeds for
+    each fraction_poisoned. A sweep is requested with an "adhoc" "sweep" entry:
+
+    "sweep": {
+        "split_ids": [0, 1, 2, 3, 4],
+        "fraction_poisoned": [0.01, 0.05, 0.1],
+        "num_workers": 4
+    }
+
+The clean train and eval splits are decoded and preprocessed once, and written to
+    memory-mapped files in the scenario tmp directory. Each (split_id,
+    fraction_poisoned) trial then runs the scenario's usual evaluation in a worker
+    process that maps those files copy-on-write, so workers share the page cache
+    and may poison their own copy in place.
+
+Workers are spawned rather than forked, as TensorFlow is not fork-safe once the
+    parent has used it to load the datasets.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+import coloredlogs
+import numpy as np
+
+from armory import paths
+from armory.utils import config_loading
+
+logger = logging.getLogger(__name__)
+
+
+class SharedDataset:
+    """
+    Iterable of (x, y) batches of in-memory or memory-mapped arrays
+
+    Used by the poisoning scenarios in place of an ArmoryDataGenerator for splits
+        that have already been loaded and preprocessed.
+    """
+
+    def __init__(self, x, y, batch_size):
+        if len(x) != len(y):
+            raise ValueError(f"len(x) {len(x)} != len(y) {len(y)}")
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.samples_per_epoch = len(x)
+
+    def __iter__(self):
+        for start in range(0, len(self.x), self.batch_size):
+            end = start + self.batch_size
+            yield self.x[start:end], self.y[start:end]
+
+
+def _save_split(dataset, directory, split):
+    """
+    Write the batches of dataset to flat files and return their description
+    """
+    spec = {}
+    files = {}
+    try:
+        for batch in dataset:
+            for name, array in zip(("x", "y"), batch):
+                if name not in files:
+                    filename = os.path.join(directory, f"{split}_{name}.bin")
+                    files[name] = open(filename, "wb")
+                    spec[name] = {
+                        "filename": filename,
+                        "dtype": array.dtype.str,
+                        "shape": [0] + list(array.shape[1:]),
+                    }
+                np.ascontiguousarray(array, dtype=spec[name]["dtype"]).tofile(
+                    files[name]
+                )
+                spec[name]["shape"][0] += len(array)
+    finally:
+        for f in files.values():
+            f.close()
+    if not spec:
+        raise ValueError(f"split {split} is empty")
+    return spec
+
+
+def _open_split(spec, batch_size) -> SharedDataset:
+    arrays = []
+    for name in ("x", "y"):
+        array_spec = spec[name]
+        if array_spec["shape"][0]:
+            array = np.memmap(
+                array_spec["filename"],
+                dtype=array_spec["dtype"],
+                mode="c",
+                shape=tuple(array_spec["shape"]),
+            )
+        else:
+            array = np.empty(array_spec["shape"], dtype=array_spec["dtype"])
+        arrays.append(array)
+    return SharedDataset(*arrays, batch_size)
+
+
+# Path in the config of the fraction of training data that is poisoned
+FRACTION_POISONED = ("adhoc", "fraction_poisoned")
+
+
+def _get_path(config, path):
+    for key in path:
+        config = config[key]
+    return config
+
+
+def _set_path(config, path, value):
+    for key in path[:-1]:
+        config = config[key]
+    config[path[-1]] = value
+
+
+def sweep_trials(config: dict, fraction_path=FRACTION_POISONED):
+    """
+    Return the (fraction_poisoned, split_id) pairs of the sweep in config["adhoc"]
+
+    fraction_path is the path of keys in config of the scenario's poisoning
+        fraction, e.g., ("attack", "kwargs", "pp_poison") for GTSRB_CLBD. Values
+        missing from "sweep" default to the single values in config.
+    """
+    config_adhoc = config["adhoc"]
+    sweep = config_adhoc["sweep"]
+    split_ids = sweep.get("split_ids", [config_adhoc["split_id"]])
+    if "fraction_poisoned" in sweep:
+        fractions = sweep["fraction_poisoned"]
+    else:
+        try:
+            fractions = [_get_path(config, fraction_path)]
+        except (KeyError, TypeError):
+            raise ValueError(
+                f"sweep has no fraction_poisoned and config has no {'.'.join(fraction_path)}"
+            )
+    return list(itertools.product(fractions, split_ids))
+
+
+def trial_configs(config: dict, fraction_path=FRACTION_POISONED):
+    """
+    Return a list of (fraction_poisoned, split_id, config) for each trial of the
+        sweep in config["adhoc"], where config runs that single trial
+    """
+    trials = []
+    for fraction, split_id in sweep_trials(config, fraction_path):
+        trial_config = copy.deepcopy(config)
+        trial_config["adhoc"].pop("sweep")
+        trial_config["adhoc"]["split_id"] = split_id
+        _set_path(trial_config, fraction_path, fraction)
+        trials.append((fraction, split_id, trial_config))
+    return trials
+
+
+def aggregate(trials) -> dict:
+    """
+    Return results with the mean and std of each metric for each fraction_poisoned
+
+    trials is a list of dicts with keys "split_id", "fraction_poisoned", and
+        "results". "<metric>_mean" and "<metric>_std" map fraction_poisoned to
+        values over split_ids, as expected by armory.eval.plot_poisoning.
+    """
+    by_fraction = {}
+    for trial in trials:
+        by_fraction.setdefault(trial["fraction_poisoned"], []).append(trial["results"])
+
+    results = {"trials": trials}
+    for fraction, fraction_results in sorted(by_fraction.items()):
+        for metric in sorted(set().union(*fraction_results)):
+            values = [r[metric] for r in fraction_results if r.get(metric) is not None]
+            if not values:
+                continue
+            values = np.array(values, dtype=float)
+            for stat, value in (("mean", values.mean()), ("std", values.std())):
+                results.setdefault(f"{metric}_{stat}", {})[str(fraction)] = float(value)
+    return results
+
+
+# Scenario instance of a sweep worker process
+_scenario = None
+
+
+def _init_worker(sys_path, no_docker, scenario_config, check_run, specs, batch_size):
+    global _scenario
+    sys.path[:] = sys_path
+    paths.set_mode("host" if no_docker else "docker")
+    coloredlogs.install(level=logging.INFO)
+    _scenario = config_loading.load(scenario_config)
+    _scenario.set_check_run(check_run)
+    _scenario.shared_datasets = {
+        split: _open_split(spec, batch_size) for split, spec in specs.items()
+    }
+
+
+def _run_trial(config):
+    return _scenario._evaluate(config, None, None, None)
+
+
+def run_sweep(
+    scenario, config: dict, splits, load_split, fraction_path=FRACTION_POISONED
+) -> dict:
+    """
+    Run scenario._evaluate for every trial of the sweep in config["adhoc"]
+
+    splits are the dataset splits to share between trials, and load_split(split)
+        returns an iterable of their preprocessed (x, y) batches. Swept
+        fraction_poisoned values are set at fraction_path in each trial's config.
+    """
+    trials = trial_configs(config, fraction_path)
+    num_workers = config["adhoc"]["sweep"].get("num_workers", 1)
+
+    directory = os.path.join(paths.runtime_paths().tmp_dir, config["eval_id"], "sweep")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        specs = {}
+        for split in splits:
+            if split not in specs:
+                logger.info(f"Loading {split} split once for {len(trials)} trials")
+                specs[split] = _save_split(load_split(split), directory, split)
+
+        logger.info(f"Running {len(trials)} trials with {num_workers} workers")
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                list(sys.path),
+                paths.NO_DOCKER,
+                config["scenario"],
+                scenario.check_run,
+                specs,
+                config["dataset"]["batch_size"],
+            ),
+        ) as pool:
+            trial_results = []
+            for (fraction, split_id, _), results in zip(
+                trials, pool.map(_run_trial, [trial[2] for trial in trials])
+            ):
+                logger.info(
+                    f"Trial split_id={split_id} fraction_poisoned={fraction}: {results}"
+                )
+                trial_results.append(
+                    {
+                        "split_id": split_id,
+                        "fraction_poisoned": fraction,
+                        "results": results,
+                    }
+                )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return aggregate(trial_results)
@@ -4,6 +4,7 @@ Helper utilies to load things from armory configuration files.
 
 from importlib import import_module
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +28,10 @@ from art.defences.postprocessor import Postprocessor
 from art.defences.preprocessor import Preprocessor
 from art.defences.trainer import Trainer
 
+from armory import paths
 from armory.art_experimental.attacks import patch
-from armory.data.datasets import ArmoryDataGenerator, EvalGenerator
+from armory.data import preprocessed_cache
+from armory.data.datasets import ArmoryDataGenerator, EvalGenerator, shard_split
 from armory.data.utils import maybe_download_weights_from_s3
 from armory.utils import labels
 
@@ -58,8 +61,54 @@ def load_dataset(dataset_config, *args, num_batches=None, **kwargs):
     batch_size = dataset_config["batch_size"]
     framework = dataset_config.get("framework", "numpy")
     dataset = dataset_fn(batch_size=batch_size, framework=framework, *args, **kwargs)
+    if framework == "pytorch":
+        return _pytorch_dataloader(dataset, dataset_config, num_batches)
+    for key in ("dataloader_workers", "pin_memory"):
+        if dataset_config.get(key):
+            logger.warning(f"{key} only applies to framework 'pytorch'. Ignoring")
     if not isinstance(dataset, ArmoryDataGenerator):
         raise ValueError(f"{dataset} is not an instance of {ArmoryDataGenerator}")
+    # Only evaluation data, which is read in a deterministic order, is sharded
+    if dataset_config.get("shard") and kwargs.get("shuffle_files") is False:
+        kwargs = _shard_kwargs(dataset, dataset_config["shard"], kwargs)
+        dataset = dataset_fn(
+            batch_size=batch_size, framework=framework, *args, **kwargs
+        )
+    if dataset_config.get("preprocessed_cache"):
+        if kwargs.get("shuffle_files") is False:
+            # dataset_fn code includes its TFDS name and version
+            key = preprocessed_cache.cache_key(
+                dataset_fn,
+                batch_size,
+                framework,
+                args,
+                kwargs,
+                {
+                    k: v
+                    for k, v in dataset_config.items()
+                    if k
+                    not in (
+                        "check_run",
+                        "prefetch_batches",
+                        "prefetch_workers",
+                        "dataloader_workers",
+                        "pin_memory",
+                    )
+                },
+                dataset.preprocessing_fn,
+                dataset.label_preprocessing_fn,
+                vars(dataset.context) if dataset.context is not None else None,
+            )
+            dataset_dir = kwargs.get("dataset_dir") or paths.runtime_paths().dataset_dir
+            cache_dir = os.path.join(dataset_dir, "preprocessed_cache")
+            dataset = preprocessed_cache.cached_dataset(dataset, key, cache_dir)
+        else:
+            logger.warning("preprocessed_cache requires shuffle_files=False. Ignoring")
+    if dataset_config.get("prefetch_batches"):
+        dataset.set_prefetch(
+            dataset_config["prefetch_batches"],
+            num_workers=dataset_config.get("prefetch_workers", 1),
+        )
     if dataset_config.get("check_run"):
         return EvalGenerator(dataset, num_eval_batches=1)
     if num_batches:
@@ -67,6 +116,45 @@ def load_dataset(dataset_config, *args, num_batches=None, **kwargs):
     return dataset
 
 
+def _pytorch_dataloader(dataloader, dataset_config, num_batches=None):
+    """
+    Return dataloader, rebuilt with the dataloader_workers and pin_memory of config
+
+    Batches from different workers are interleaved, so their order differs from
+        dataloader_workers=0.
+    """
+    ignored = [
+        k
+        for k in ("shard", "preprocessed_cache", "prefetch_batches", "check_run")
+        if dataset_config.get(k)
+    ]
+    if num_batches:
+        ignored.append("num_batches")
+    if ignored:
+        logger.warning(f"{ignored} do not apply to framework 'pytorch'. Ignoring")
+    num_workers = dataset_config.get("dataloader_workers", 0)
+    pin_memory = dataset_config.get("pin_memory", False)
+    if not num_workers and not pin_memory:
+        return dataloader
+    from armory.data import pytorch_loader
+
+    return pytorch_loader.make_dataloader(
+        dataloader.dataset, num_workers=num_workers, pin_memory=pin_memory
+    )
+
+
+def _shard_kwargs(dataset, shard, kwargs):
+    """
+    Return dataset kwargs with the split restricted to shard (index, num_shards)
+    """
+    if "split" not in kwargs:
+        raise ValueError("Sharded datasets must be loaded with a 'split' kwarg")
+    index, num_shards = shard
+    split = shard_split(kwargs["split"], dataset.samples_per_epoch, index, num_shards)
+    logger.info(f"Using shard {index} of {num_shards} of {kwargs['split']}: {split}")
+    return {**kwargs, "split": split}
+
+
 def load_model(model_config):
     """
     Loads a model and preprocessing function from configuration file
@@ -159,6 +247,8 @@ def load_adversarial_dataset(config, num_batches=None, **kwargs):
     dataset = dataset_fn(**dataset_kwargs)
     if not isinstance(dataset, ArmoryDataGenerator):
         raise ValueError(f"{dataset} is not an instance of {ArmoryDataGenerator}")
+    if config.get("shard"):
+        dataset = dataset_fn(**_shard_kwargs(dataset, config["shard"], dataset_kwargs))
     if config.get("check_run"):
         return EvalGenerator(dataset, num_eval_batches=1)
     if num_batches:
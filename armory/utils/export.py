@@ -47,6 +47,27 @@ class SampleExporter:
                 with open(os.path.join(self.output_dir, "predictions.pkl"), "wb") as f:
                     pickle.dump(self.y_dict, f)
 
+    def state(self):
+        """
+        Return the progress of the exporter, as accepted by load_state
+        """
+        return {
+            "saved_samples": self.saved_samples,
+            "output_dir": self.output_dir,
+            "y_dict": self.y_dict,
+        }
+
+    def load_state(self, state):
+        """
+        Continue exporting samples from a state returned by state()
+        """
+        if state["output_dir"] != self.output_dir:
+            if not os.listdir(self.output_dir):
+                os.rmdir(self.output_dir)
+            self.output_dir = state["output_dir"]
+        self.saved_samples = state["saved_samples"]
+        self.y_dict = dict(state["y_dict"])
+
     def _make_output_dir(self):
         assert os.path.exists(self.base_output_dir) and os.path.isdir(
             self.base_output_dir
@@ -0,0 +1,308 @@
+"""
+Low-overhead timing of nested spans of scenario evaluation
+
+Spans are timed with:
+    with instrumentation.span("predict"):
+        y_pred = estimator.predict(x)
+
+Nested spans are recorded under the "/"-separated path of their enclosing spans on
+    the same thread, e.g., "attack/generate". Each path has a fixed-size histogram
+    of durations, from which count, total, mean, quantiles, and max are reported.
+    Spans are only recorded while an enabled Instrumentation is active, as set by
+    Scenario.evaluate from the "profiler_type" of the metric config.
+"""
+
+import cProfile
+import logging
+import math
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROFILER_TYPES = ["Basic", "Deterministic"]
+
+
+class Histogram:
+    """
+    Fixed-size histogram of durations in seconds with logarithmic bins
+
+    Bin 0 holds durations up to MIN_SECONDS. Each further factor of 2 is split into
+        BINS_PER_OCTAVE bins, so quantiles are accurate to within a factor of
+        2 ** (1 / BINS_PER_OCTAVE), about 4%. The last bin holds all durations
+        over about 12 days.
+    """
+
+    MIN_SECONDS = 1e-6
+    BINS_PER_OCTAVE = 16
+    NUM_BINS = 40 * BINS_PER_OCTAVE + 1
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BINS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > self.MIN_SECONDS:
+            index = int(math.log2(seconds / self.MIN_SECONDS) * self.BINS_PER_OCTAVE)
+            index = min(index + 1, self.NUM_BINS - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        Return the geometric center of the bin holding the q quantile of durations,
+            clipped to the observed range
+        """
+        if not self.count:
+            raise ValueError("No durations recorded")
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                break
+        if index == 0:
+            value = self.MIN_SECONDS
+        elif index == self.NUM_BINS - 1:
+            value = self.max
+        else:
+            value = self.MIN_SECONDS * 2 ** ((index - 0.5) / self.BINS_PER_OCTAVE)
+        return min(max(value, self.min), self.max)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def results(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+    def state(self):
+        """
+        Return a JSON-able dict of the histogram, as accepted by from_state
+        """
+        return {
+            "bins": [[i, count] for i, count in enumerate(self.counts) if count],
+            "count": self.count,
+            "total": self.total,
+            "min": self.min if self.count else None,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        histogram = cls()
+        for index, count in state["bins"]:
+            histogram.counts[index] = count
+        histogram.count = state["count"]
+        histogram.total = state["total"]
+        if state["min"] is not None:
+            histogram.min = state["min"]
+        histogram.max = state["max"]
+        return histogram
+
+
+class _Span:
+    __slots__ = ("instrumentation", "name", "path", "start")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        stack = self.instrumentation._stack()
+        self.path = f"{stack[-1]}/{self.name}" if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.instrumentation._stack().pop()
+        self.instrumentation.record(self.path, seconds)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation:
+    """
+    Records spans into a Histogram per path
+
+    profiler_type - None (no spans are recorded), "Basic" (spans are recorded), or
+        "Deterministic" (spans are recorded, and profile() runs cProfile)
+    """
+
+    def __init__(self, profiler_type=None):
+        if profiler_type is not None and profiler_type not in PROFILER_TYPES:
+            raise ValueError(
+                f"Profiler {profiler_type} is not one of {PROFILER_TYPES}."
+            )
+        self.profiler_type = profiler_type
+        self.enabled = profiler_type is not None
+        self.histograms = {}
+        self.profiler = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name):
+        """
+        Return a context manager that records the time spent in it under name
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, path, seconds):
+        with self._lock:
+            histogram = self.histograms.get(path)
+            if histogram is None:
+                histogram = self.histograms[path] = Histogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def profile(self):
+        """
+        Run cProfile for the duration of the context if profiler_type is
+            "Deterministic", accumulating its statistics across calls. Only the
+            calling thread is profiled
+        """
+        if self.profiler_type != "Deterministic":
+            yield
+            return
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def save_profile(self, filepath):
+        """
+        Save the cProfile statistics as a pstats binary, if any were collected
+        """
+        if self.profiler is None:
+            return
+        logger.info(f"Saving profiler stats to {filepath} path inside container.")
+        self.profiler.dump_stats(filepath)
+
+    def merge(self, other):
+        for path, other_histogram in other.histograms.items():
+            if path not in self.histograms:
+                self.histograms[path] = Histogram()
+            self.histograms[path].merge(other_histogram)
+
+    def results(self):
+        """
+        Return a dict mapping each path to the statistics of its durations in seconds
+        """
+        return {
+            path: histogram.results()
+            for path, histogram in sorted(self.histograms.items())
+        }
+
+    def state(self):
+        """
+        Return a JSON-able dict of the recorded spans, as accepted by load_state
+        """
+        return {
+            "profiler_type": self.profiler_type,
+            "histograms": {
+                path: histogram.state() for path, histogram in self.histograms.items()
+            },
+        }
+
+    def load_state(self, state):
+        """
+        Replace the recorded spans with those in state, as returned by state()
+        """
+        self.histograms = {
+            path: Histogram.from_state(histogram_state)
+            for path, histogram_state in state["histograms"].items()
+        }
+
+
+def merge_profiles(filepaths, filepath):
+    """
+    Save the sum of the pstats binaries at filepaths to filepath
+    """
+    stats = pstats.Stats(*filepaths)
+    stats.dump_stats(filepath)
+
+
+_active = None
+
+
+def active():
+    """
+    Return the active Instrumentation, or None if none is active
+    """
+    return _active
+
+
+@contextmanager
+def activate(instrumentation):
+    """
+    Make instrumentation the active Instrumentation for the duration of the context
+    """
+    global _active
+    previous = _active
+    _active = instrumentation
+    try:
+        yield instrumentation
+    finally:
+        _active = previous
+
+
+def span(name):
+    """
+    Return a context manager that records the time spent in it under name in the
+        active Instrumentation, if any
+    """
+    if _active is None:
+        return _NULL_SPAN
+    return _active.span(name)
@@ -6,22 +6,24 @@ Outputs are lists of python variables amenable to JSON serialization:
     numpy data types and tensors generally fail to serialize
 """
 
+import abc
+import json
 import logging
+import numbers
 import numpy as np
-import time
-from contextlib import contextmanager
 import io
-from collections import defaultdict, Counter
-
-import cProfile
-import pstats
+from collections import Counter
 
 from armory.data.adversarial_datasets import ADV_PATCH_MAGIC_NUMBER_LABEL_ID
 from armory.data.adversarial.apricot_metadata import APRICOT_PATCHES
+from armory.utils import instrumentation
 
 
 logger = logging.getLogger(__name__)
 
+# Version of the binary format of MetricsLogger.state
+STATE_VERSION = 2
+
 
 def categorical_accuracy(y, y_pred):
     """
@@ -75,22 +77,150 @@ def top_n_categorical_accuracy(y, y_pred, n):
         raise ValueError(f"{y} and {y_pred} have mismatched dimensions")
 
 
-def norm(x, x_adv, ord):
+def _as_batch(x):
     """
-    Return the given norm over a batch, outputting a list of floats
+    Return x as an array whose first axis indexes samples. Batches of variable-length
+        samples, such as those from ArmoryDataGenerator.np_1D_object_array, are
+        returned as 1D object arrays.
+    """
+    if isinstance(x, np.ndarray):
+        return x
+    try:
+        return np.asarray(x)
+    except ValueError:
+        # Ragged sequences cannot be converted directly in newer versions of numpy
+        batch = np.empty(len(x), dtype=object)
+        for i, x_i in enumerate(x):
+            batch[i] = x_i
+        return batch
+
+
+def _pack_perturbation(x, x_adv, pack_x=True):
     """
-    x = np.asarray(x)
-    x_adv = np.asarray(x_adv)
-    # elevate to 64-bit types first to prevent overflow errors
+    Pack a batch of samples and their perturbations into flat buffers
+
+    Returns (flat_x, flat_diff, offsets), where flat_diff is x - x_adv and sample i of
+        each is stored in flat[offsets[i]:offsets[i + 1]]. flat_x is None if not pack_x.
+        Regular batches are flattened without copying x where possible, and
+        variable-length batches are copied once. Floating point samples keep their
+        precision, while integer samples are promoted to floating point to prevent
+        overflow errors. flat_diff is always a new array, so it may be modified in place.
+    """
+    if len(x) != len(x_adv):
+        raise ValueError(f"len(x) {len(x)} != len(x_adv) {len(x_adv)}")
+    x = _as_batch(x)
+    x_adv = _as_batch(x_adv)
+
+    if x.dtype != object and x_adv.dtype != object:
+        if x.shape != x_adv.shape:
+            raise ValueError(f"x.shape {x.shape} != x_adv.shape {x_adv.shape}")
+        x_samples, x_adv_samples = [x], [x_adv]
+        sample_size = x.size // len(x) if len(x) else 0
+        offsets = np.arange(len(x) + 1) * sample_size
+    else:
+        x_samples = [np.asarray(x_i) for x_i in x]
+        x_adv_samples = [np.asarray(x_adv_i) for x_adv_i in x_adv]
+        for x_i, x_adv_i in zip(x_samples, x_adv_samples):
+            if x_i.shape != x_adv_i.shape:
+                raise ValueError(
+                    f"x_i.shape {x_i.shape} != x_adv_i.shape {x_adv_i.shape}"
+                )
+        offsets = np.zeros(len(x_samples) + 1, dtype=np.int64)
+        np.cumsum([x_i.size for x_i in x_samples], out=offsets[1:])
+
+    x_dtype = np.result_type(*[x_i.dtype for x_i in x_samples])
+    x_adv_dtype = np.result_type(*[x_adv_i.dtype for x_adv_i in x_adv_samples])
     assert not (
-        np.iscomplexobj(x) ^ np.iscomplexobj(x_adv)
+        np.issubdtype(x_dtype, np.complexfloating)
+        ^ np.issubdtype(x_adv_dtype, np.complexfloating)
     ), "x and x_adv mix real/complex types"
-    dtype = complex if np.iscomplexobj(x) else float
-    diff = (x.astype(dtype) - x_adv.astype(dtype)).reshape(x.shape[0], -1)
-    values = np.linalg.norm(diff, ord=ord, axis=1)
-    # normalize l0 norm by number of elements in array
-    if ord == 0:
-        return list(float(x) / diff[i].size for i, x in enumerate(values))
+    dtype = np.result_type(x_dtype, x_adv_dtype, np.float32)
+
+    flat_diff = np.empty(offsets[-1], dtype=dtype)
+    for start, x_i, x_adv_i in zip(offsets, x_samples, x_adv_samples):
+        np.subtract(
+            x_i,
+            x_adv_i,
+            out=flat_diff[start : start + x_i.size].reshape(x_i.shape),
+            dtype=dtype,
+        )
+    if pack_x:
+        flat_x = _concatenate_flat(x_samples, dtype, offsets[-1])
+    else:
+        flat_x = None
+    return flat_x, flat_diff, offsets
+
+
+def _concatenate_flat(arrays, dtype, size):
+    """
+    Ravel and concatenate arrays into a single 1D buffer of the given dtype and size
+    """
+    if len(arrays) == 1:
+        return arrays[0].reshape(-1).astype(dtype, copy=False)
+    flat = np.empty(size, dtype=dtype)
+    start = 0
+    for array in arrays:
+        flat[start : start + array.size] = array.reshape(-1)
+        start += array.size
+    return flat
+
+
+def _segment_reduce(ufunc, values, offsets, dtype=None):
+    """
+    Reduce each segment values[offsets[i]:offsets[i + 1]] with the given ufunc
+
+    Empty segments reduce to 0. If dtype is given, the reduction accumulates in that
+        dtype without making a converted copy of values.
+    """
+    lengths = np.diff(offsets)
+    num_segments = len(lengths)
+    if values.size == 0:
+        return np.zeros(num_segments, dtype=dtype or values.dtype)
+    if (lengths == lengths[0]).all():
+        # Regular batch, so reduce along the sample axis
+        return ufunc.reduce(values.reshape(num_segments, -1), axis=1, dtype=dtype)
+    starts = np.minimum(offsets[:-1], values.size - 1)
+    reduced = ufunc.reduceat(values, starts, dtype=dtype)
+    # reduceat returns values[start] for empty segments
+    reduced[lengths == 0] = 0
+    return reduced
+
+
+def _squared_magnitude(values):
+    if np.iscomplexobj(values):
+        return np.square(values.real) + np.square(values.imag)
+    return np.square(values)
+
+
+def norm(x, x_adv, ord):
+    """
+    Return the given norm over a batch, outputting a list of floats
+
+    Supports batches of variable-length samples, which are computed together
+    """
+    _, diff, offsets = _pack_perturbation(x, x_adv, pack_x=False)
+    if np.iscomplexobj(diff):
+        diff = np.abs(diff)
+    else:
+        diff = np.abs(diff, out=diff)
+    if ord == np.inf:
+        values = _segment_reduce(np.maximum, diff, offsets)
+    elif ord == -np.inf:
+        values = _segment_reduce(np.minimum, diff, offsets)
+    elif ord == 0:
+        # normalize l0 norm by number of elements in array
+        values = _segment_reduce(np.add, diff != 0, offsets, dtype=np.float64)
+        values = values / np.diff(offsets)
+    elif ord == 1:
+        values = _segment_reduce(np.add, diff, offsets, dtype=np.float64)
+    elif ord == 2:
+        diff = np.square(diff, out=diff)
+        values = np.sqrt(_segment_reduce(np.add, diff, offsets, dtype=np.float64))
+    else:
+        # elevate to 64-bit types first to prevent overflow errors
+        values = _segment_reduce(
+            np.add, np.power(diff, ord, dtype=np.float64), offsets
+        ) ** (1.0 / ord)
     return list(float(x) for x in values)
 
 
@@ -132,29 +262,27 @@ def l0(x, x_adv):
     return norm(x, x_adv, 0)
 
 
-def _snr(x_i, x_adv_i):
-    assert not (
-        np.iscomplexobj(x_i) ^ np.iscomplexobj(x_adv_i)
-    ), "x_i and x_adv_i mix real/complex types"
-    dtype = complex if np.iscomplexobj(x_i) else float
-    x_i = np.asarray(x_i, dtype=dtype)
-    x_adv_i = np.asarray(x_adv_i, dtype=dtype)
-    if x_i.shape != x_adv_i.shape:
-        raise ValueError(f"x_i.shape {x_i.shape} != x_adv_i.shape {x_adv_i.shape}")
-    signal_power = (np.abs(x_i) ** 2).mean()
-    noise_power = (np.abs(x_i - x_adv_i) ** 2).mean()
-    if noise_power == 0:
-        return np.inf
-    return signal_power / noise_power
+def _mean_power(values, offsets):
+    """
+    Return the mean squared magnitude of each segment of values
+    """
+    return _segment_reduce(
+        np.add, _squared_magnitude(values), offsets, dtype=np.float64
+    ) / np.diff(offsets)
 
 
 def snr(x, x_adv):
     """
     Return the SNR of a batch of samples with raw audio input
+
+    Supports batches of variable-length samples, which are computed together
     """
-    if len(x) != len(x_adv):
-        raise ValueError(f"len(x) {len(x)} != len(x_adv) {len(x_adv)}")
-    return [float(_snr(x_i, x_adv_i)) for (x_i, x_adv_i) in zip(x, x_adv)]
+    flat_x, diff, offsets = _pack_perturbation(x, x_adv)
+    signal_power = _mean_power(flat_x, offsets)
+    noise_power = _mean_power(diff, offsets)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = np.where(noise_power == 0, np.inf, signal_power / noise_power)
+    return [float(x) for x in values]
 
 
 def snr_db(x, x_adv):
@@ -164,52 +292,98 @@ def snr_db(x, x_adv):
     return [float(i) for i in 10 * np.log10(snr(x, x_adv))]
 
 
-def _snr_spectrogram(x_i, x_adv_i):
-    x_i = np.asarray(x_i, dtype=float)
-    x_adv_i = np.asarray(x_adv_i, dtype=float)
-    if x_i.shape != x_adv_i.shape:
-        raise ValueError(f"x_i.shape {x_i.shape} != x_adv_i.shape {x_adv_i.shape}")
-    signal_power = np.abs(x_i).mean()
-    noise_power = np.abs(x_i - x_adv_i).mean()
-    return signal_power / noise_power
-
-
 def word_error_rate(y, y_pred):
     """
     Return the word error rate for a batch of transcriptions.
     """
     if len(y) != len(y_pred):
         raise ValueError(f"len(y) {len(y)} != len(y_pred) {len(y_pred)}")
-    return [_word_error_rate(y_i, y_pred_i) for (y_i, y_pred_i) in zip(y, y_pred)]
+    references = [_reference_words(y_i) for y_i in y]
+    hypotheses = [y_pred_i.split() for y_pred_i in y_pred]
+    edit_distances = _edit_distances(references, hypotheses)
+    return [
+        (float(distance), len(reference))
+        for distance, reference in zip(edit_distances, references)
+    ]
 
 
 def _word_error_rate(y_i, y_pred_i):
+    return word_error_rate([y_i], [y_pred_i])[0]
+
+
+def _reference_words(y_i):
     if isinstance(y_i, str):
-        reference = y_i.split()
+        return y_i.split()
     elif isinstance(y_i, bytes):
-        reference = y_i.decode("utf-8").split()
+        return y_i.decode("utf-8").split()
     else:
         raise TypeError(f"y_i is of type {type(y_i)}, expected string or bytes")
-    hypothesis = y_pred_i.split()
-    r_length = len(reference)
-    h_length = len(hypothesis)
-    matrix = np.zeros((r_length + 1, h_length + 1))
-    for i in range(r_length + 1):
-        for j in range(h_length + 1):
-            if i == 0:
-                matrix[0][j] = j
-            elif j == 0:
-                matrix[i][0] = i
-    for i in range(1, r_length + 1):
-        for j in range(1, h_length + 1):
-            if reference[i - 1] == hypothesis[j - 1]:
-                matrix[i][j] = matrix[i - 1][j - 1]
-            else:
-                substitute = matrix[i - 1][j - 1] + 1
-                insertion = matrix[i][j - 1] + 1
-                deletion = matrix[i - 1][j] + 1
-                matrix[i][j] = min(substitute, insertion, deletion)
-    return (matrix[r_length][h_length], r_length)
+
+
+def _edit_distances(sequences_1, sequences_2):
+    """
+    Return the Levenshtein distance between each pair of token sequences as an array
+
+    All pairs are computed together. Tokens are mapped to integer IDs, and each pair is
+        oriented so that the longer sequence indexes the rows of the dynamic programme
+        and the shorter one its columns. Only one row is kept at a time, so memory is
+        O(batch_size * min(n, m)). Within a row, insertions are resolved with a running
+        minimum instead of a loop over columns.
+    """
+    vocabulary = {}
+
+    def encode(tokens):
+        return [vocabulary.setdefault(token, len(vocabulary)) for token in tokens]
+
+    encoded_rows, encoded_columns = [], []
+    for tokens_1, tokens_2 in zip(sequences_1, sequences_2):
+        if len(tokens_1) < len(tokens_2):
+            tokens_1, tokens_2 = tokens_2, tokens_1
+        encoded_rows.append(encode(tokens_1))
+        encoded_columns.append(encode(tokens_2))
+    if not encoded_rows:
+        return np.zeros(0, dtype=np.int64)
+
+    # Process pairs in order of decreasing row length, so that the pairs still being
+    # computed at row i are always a prefix of the batch
+    row_lengths = np.array([len(tokens) for tokens in encoded_rows])
+    order = np.argsort(-row_lengths, kind="stable")
+    row_lengths = row_lengths[order]
+    column_lengths = np.array([len(encoded_columns[k]) for k in order])
+
+    # Pad with distinct negative IDs, which never match each other or a real token
+    num_pairs = len(order)
+    rows = np.full((num_pairs, row_lengths.max()), -1, dtype=np.int64)
+    columns = np.full((num_pairs, column_lengths.max()), -2, dtype=np.int64)
+    for pair_idx, k in enumerate(order):
+        rows[pair_idx, : row_lengths[pair_idx]] = encoded_rows[k]
+        columns[pair_idx, : column_lengths[pair_idx]] = encoded_columns[k]
+
+    column_indices = np.arange(columns.shape[1] + 1)
+    distances = np.empty(num_pairs, dtype=np.int64)
+    previous = np.tile(column_indices, (num_pairs, 1))
+    finished = row_lengths == 0
+    distances[finished] = column_indices[column_lengths[finished]]
+    for i in range(1, rows.shape[1] + 1):
+        num_active = np.count_nonzero(row_lengths >= i)
+        previous = previous[:num_active]
+        substitution_cost = rows[:num_active, i - 1, None] != columns[:num_active]
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        current[:, 1:] = np.minimum(
+            previous[:, 1:] + 1, previous[:, :-1] + substitution_cost
+        )
+        # Insertions: current[j] = min over k <= j of current[k] + (j - k)
+        current = (
+            np.minimum.accumulate(current - column_indices, axis=1) + column_indices
+        )
+        finished = np.flatnonzero(row_lengths[:num_active] == i)
+        distances[finished] = current[finished, column_lengths[finished]]
+        previous = current
+
+    edit_distances = np.empty(num_pairs, dtype=np.int64)
+    edit_distances[order] = distances
+    return edit_distances
 
 
 # Metrics specific to MARS model preprocessing in video UCF101 scenario
@@ -256,42 +430,6 @@ def mars_mean_patch(x, x_adv):
     return out
 
 
-@contextmanager
-def resource_context(name="Name", profiler=None, computational_resource_dict=None):
-    if profiler is None:
-        yield
-        return 0
-    profiler_types = ["Basic", "Deterministic"]
-    if profiler is not None and profiler not in profiler_types:
-        raise ValueError(f"Profiler {profiler} is not one of {profiler_types}.")
-    if profiler == "Deterministic":
-        logger.warn(
-            "Using Deterministic profiler. This may reduce timing accuracy and result in a large results file."
-        )
-        pr = cProfile.Profile()
-        pr.enable()
-    startTime = time.perf_counter()
-    yield
-    elapsedTime = time.perf_counter() - startTime
-    if profiler == "Deterministic":
-        pr.disable()
-        s = io.StringIO()
-        sortby = "cumulative"
-        ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-        ps.print_stats()
-        stats = s.getvalue()
-    if name not in computational_resource_dict:
-        computational_resource_dict[name] = defaultdict(lambda: 0)
-        if profiler == "Deterministic":
-            computational_resource_dict[name]["stats"] = ""
-    comp = computational_resource_dict[name]
-    comp["execution_count"] += 1
-    comp["total_time"] += elapsedTime
-    if profiler == "Deterministic":
-        comp["stats"] += stats
-    return 0
-
-
 def snr_spectrogram(x, x_adv):
     """
     Return the SNR of a batch of samples with spectrogram input
@@ -305,7 +443,17 @@ def snr_spectrogram(x, x_adv):
     """
     if x.shape != x_adv.shape:
         raise ValueError(f"x.shape {x.shape} != x_adv.shape {x_adv.shape}")
-    return [float(_snr_spectrogram(x_i, x_adv_i)) for (x_i, x_adv_i) in zip(x, x_adv)]
+    flat_x, diff, offsets = _pack_perturbation(x, x_adv)
+    lengths = np.diff(offsets)
+    signal_power = (
+        _segment_reduce(np.add, np.abs(flat_x), offsets, dtype=np.float64) / lengths
+    )
+    noise_power = (
+        _segment_reduce(np.add, np.abs(diff, out=diff), offsets, dtype=np.float64)
+        / lengths
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return [float(x) for x in signal_power / noise_power]
 
 
 def snr_spectrogram_db(x, x_adv):
@@ -318,12 +466,26 @@ def snr_spectrogram_db(x, x_adv):
 def _image_circle_patch_diameter(x_i, x_adv_i):
     if x_i.shape != x_adv_i.shape:
         raise ValueError(f"x_i.shape {x_i.shape} != x_adv_i.shape {x_adv_i.shape}")
-    img_shape = x_i.shape
+    return _image_circle_patch_diameter_batch(x_i[np.newaxis], x_adv_i[np.newaxis])[0]
+
+
+def _image_circle_patch_diameter_batch(x, x_adv):
+    """
+    Vectorized _image_circle_patch_diameter over a batch of images of the same shape
+    """
+    if x.shape != x_adv.shape:
+        raise ValueError(f"x.shape {x.shape} != x_adv.shape {x_adv.shape}")
+    img_shape = x.shape[1:]
     if len(img_shape) != 3:
-        raise ValueError(f"Expected image with 3 dimensions. x_i has shape {x_i.shape}")
-    if (x_i == x_adv_i).mean() < 0.5:
+        raise ValueError(f"Expected image with 3 dimensions. x_i has shape {img_shape}")
+    perturbed = x != x_adv
+    image_axes = (1, 2, 3)
+    fraction_perturbed = np.count_nonzero(perturbed, axis=image_axes) / np.prod(
+        img_shape
+    )
+    for fraction in fraction_perturbed[fraction_perturbed > 0.5]:
         logger.warning(
-            f"x_i and x_adv_i differ at {int(100*(x_i != x_adv_i).mean())} percent of "
+            f"x_i and x_adv_i differ at {int(100*fraction)} percent of "
             "indices. image_circle_patch_area may not be accurate"
         )
     # Identify which axes of input array are spatial vs. depth dimensions
@@ -331,37 +493,54 @@ def _image_circle_patch_diameter(x_i, x_adv_i):
     spat_ind = 1 if depth_dim != 1 else 0
 
     # Determine which indices (along the spatial dimension) are perturbed
-    pert_spatial_indices = set(np.where(x_i != x_adv_i)[spat_ind])
-    if len(pert_spatial_indices) == 0:
+    pert_spatial_indices = perturbed.any(
+        axis=tuple(axis for axis in image_axes if axis != spat_ind + 1)
+    )
+    num_indices = pert_spatial_indices.shape[1]
+    indices = np.arange(num_indices)
+    is_perturbed = pert_spatial_indices.any(axis=1)
+    for _ in range(np.count_nonzero(~is_perturbed)):
         logger.warning("x_i == x_adv_i. image_circle_patch_area is 0")
-        return 0
 
-    # Find which indices (preceding the patch's max index) are unperturbed, in order
-    # to determine the index of the edge of the patch
-    max_ind_of_patch = max(pert_spatial_indices)
-    unpert_ind_less_than_patch_max_ind = [
-        i for i in range(max_ind_of_patch) if i not in pert_spatial_indices
-    ]
-    min_ind_of_patch = (
-        max(unpert_ind_less_than_patch_max_ind) + 1
-        if unpert_ind_less_than_patch_max_ind
-        else 0
+    # Find the last unperturbed index preceding the patch's max index, in order to
+    # determine the index of the edge of the patch
+    max_ind_of_patch = num_indices - 1 - pert_spatial_indices[:, ::-1].argmax(axis=1)
+    unpert_ind_less_than_patch_max_ind = ~pert_spatial_indices & (
+        indices < max_ind_of_patch[:, np.newaxis]
+    )
+    min_ind_of_patch = np.where(
+        unpert_ind_less_than_patch_max_ind.any(axis=1),
+        num_indices - unpert_ind_less_than_patch_max_ind[:, ::-1].argmax(axis=1),
+        0,
     )
 
     # If there are any perturbed indices outside the range of the patch just computed
-    if min(pert_spatial_indices) < min_ind_of_patch:
+    multiple_regions = pert_spatial_indices.argmax(axis=1) < min_ind_of_patch
+    for _ in range(np.count_nonzero(multiple_regions & is_perturbed)):
         logger.warning("Multiple regions of the image have been perturbed")
 
     diameter = max_ind_of_patch - min_ind_of_patch + 1
     spatial_dims = [dim for i, dim in enumerate(img_shape) if i != depth_dim]
     patch_diameter = diameter / min(spatial_dims)
-    return patch_diameter
+    return [
+        float(d) if perturbed_i else 0
+        for d, perturbed_i in zip(patch_diameter, is_perturbed)
+    ]
 
 
 def image_circle_patch_diameter(x, x_adv):
     """
     Returns diameter of circular image patch, normalized by the smaller spatial dimension
+
+    Batches of images with the same shape, such as the frames of a video, are computed
+        together
     """
+    if len(x) != len(x_adv):
+        raise ValueError(f"len(x) {len(x)} != len(x_adv) {len(x_adv)}")
+    x = _as_batch(x)
+    x_adv = _as_batch(x_adv)
+    if x.dtype != object and x_adv.dtype != object:
+        return _image_circle_patch_diameter_batch(x, x_adv)
     return [
         _image_circle_patch_diameter(x_i, x_adv_i) for (x_i, x_adv_i) in zip(x, x_adv)
     ]
@@ -484,147 +663,179 @@ def _intersection_over_union(box_1, box_2):
     return iou
 
 
-def object_detection_AP_per_class(list_of_ys, list_of_y_preds):
+def _intersection_over_union_pairs(boxes_1, boxes_2):
     """
-    Mean average precision for object detection. This function returns a dictionary
-    mapping each class to the average precision (AP) for the class. The mAP can be computed
-    by taking the mean of the AP's across all classes.
+    Vectorized version of _intersection_over_union. Assumes each input has shape (N, 4)
+        and returns the IoU of each pair of corresponding rows as an array of shape (N,)
+    """
+    assert (boxes_1[:, 2] >= boxes_1[:, 0]).all()
+    assert (boxes_2[:, 2] >= boxes_2[:, 0]).all()
+    assert (boxes_1[:, 3] >= boxes_1[:, 1]).all()
+    assert (boxes_2[:, 3] >= boxes_2[:, 1]).all()
+
+    normalized_1 = ((boxes_1 <= 1.0) | (boxes_1 <= 0)).all(axis=1)
+    normalized_2 = ((boxes_2 <= 1.0) | (boxes_2 <= 0)).all(axis=1)
+    if (normalized_1 ^ normalized_2).any():
+        logger.warning(
+            "One set of boxes appears to be normalized while the other is not"
+        )
 
-    This metric is computed over all evaluation samples, rather than on a per-sample basis.
+    # Determine coordinates of intersection boxes
+    x_left = np.maximum(boxes_1[:, 1], boxes_2[:, 1])
+    x_right = np.minimum(boxes_1[:, 3], boxes_2[:, 3])
+    y_top = np.maximum(boxes_1[:, 0], boxes_2[:, 0])
+    y_bottom = np.minimum(boxes_1[:, 2], boxes_2[:, 2])
+
+    intersect_area = np.maximum(0, x_right - x_left) * np.maximum(0, y_bottom - y_top)
+
+    box_1_area = (boxes_1[:, 3] - boxes_1[:, 1]) * (boxes_1[:, 2] - boxes_1[:, 0])
+    box_2_area = (boxes_2[:, 3] - boxes_2[:, 1]) * (boxes_2[:, 2] - boxes_2[:, 0])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = intersect_area / (box_1_area + box_2_area - intersect_area)
+    # Return double precision, so threshold comparisons do not depend on box dtype
+    iou = np.where(intersect_area == 0, 0, iou).astype(np.float64)
+    assert (iou >= 0).all()
+    assert (iou <= 1).all()
+    return iou
+
+
+def _object_detection_boxes_to_columns(y, y_pred):
     """
+    Flatten a batch of label and prediction dicts into columnar arrays, with one row
+        per box. Each box is tagged with the index of the image (within the batch)
+        it belongs to.
 
-    IOU_THRESHOLD = 0.5
-    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
-    RECALL_POINTS = np.linspace(0, 1, 11)
+    Returns (gt_img_idx, gt_labels, gt_boxes), (pred_img_idx, pred_labels, pred_boxes,
+        pred_scores)
+    """
+    gt_columns = ([], [], [])
+    pred_columns = ([], [], [], [])
+    for img_idx in range(len(y_pred)):
+        img_labels = y[img_idx]["labels"].flatten()
+        num_boxes = img_labels.shape[0]
+        gt_columns[0].append(np.full(num_boxes, img_idx, dtype=np.int64))
+        gt_columns[1].append(img_labels)
+        gt_columns[2].append(y[img_idx]["boxes"].reshape((-1, 4))[:num_boxes])
+
+        pred_labels = y_pred[img_idx]["labels"].flatten()
+        num_boxes = pred_labels.shape[0]
+        pred_columns[0].append(np.full(num_boxes, img_idx, dtype=np.int64))
+        pred_columns[1].append(pred_labels)
+        pred_columns[2].append(y_pred[img_idx]["boxes"].reshape((-1, 4))[:num_boxes])
+        pred_columns[3].append(y_pred[img_idx]["scores"].flatten()[:num_boxes])
+
+    return (
+        tuple(np.concatenate(column) for column in gt_columns),
+        tuple(np.concatenate(column) for column in pred_columns),
+    )
 
-    # Converting all boxes to a list of dicts (a list for predicted boxes, and a
-    # separate list for ground truth boxes), where each dict corresponds to a box and
-    # has the following keys "img_idx", "label", "box", as well as "score" for predicted boxes
-    pred_boxes_list = []
-    gt_boxes_list = []
-    # Each element in list_of_y_preds is a list with length equal to batch size
-    batch_size = len(list_of_y_preds[0])
-    for batch_idx, (y, y_pred) in enumerate(zip(list_of_ys, list_of_y_preds)):
-        for img_idx in range(len(y_pred)):
-            global_img_idx = (batch_size * batch_idx) + img_idx
-            img_labels = y[img_idx]["labels"].flatten()
-            img_boxes = y[img_idx]["boxes"].reshape((-1, 4))
-            for gt_box_idx in range(img_labels.flatten().shape[0]):
-                label = img_labels[gt_box_idx]
-                box = img_boxes[gt_box_idx]
-                gt_box_dict = {"img_idx": global_img_idx, "label": label, "box": box}
-                gt_boxes_list.append(gt_box_dict)
-
-            for pred_box_idx in range(y_pred[img_idx]["labels"].flatten().shape[0]):
-                pred_label = y_pred[img_idx]["labels"][pred_box_idx]
-                pred_box = y_pred[img_idx]["boxes"][pred_box_idx]
-                pred_score = y_pred[img_idx]["scores"][pred_box_idx]
-                pred_box_dict = {
-                    "img_idx": global_img_idx,
-                    "label": pred_label,
-                    "box": pred_box,
-                    "score": pred_score,
-                }
-                pred_boxes_list.append(pred_box_dict)
 
-    # Union of (1) the set of all true classes and (2) the set of all predicted classes
-    set_of_class_ids = set([i["label"] for i in gt_boxes_list]) | set(
-        [i["label"] for i in pred_boxes_list]
+def _object_detection_match_boxes(
+    gt_img_idx,
+    gt_labels,
+    gt_boxes,
+    pred_img_idx,
+    pred_labels,
+    pred_boxes,
+    pred_scores,
+    iou_threshold,
+):
+    """
+    Greedily match predicted boxes to ground-truth boxes of the same class and image,
+        returning a boolean array indicating whether each predicted box is a true positive
+
+    Predicted boxes are processed in order of descending confidence. Each one is
+        compared to the ground-truth box with which it has the highest IoU (the last one,
+        in case of ties). It is a true positive if that IoU exceeds iou_threshold and
+        no higher-confidence prediction has already been matched to the same box.
+
+    Rather than looping over predictions, boxes are bucketed by (class, image). Every
+        predicted box is paired with all ground-truth boxes in its bucket, which
+        flattens the block-diagonal IoU matrix into a single vectorized computation.
+    """
+    num_preds = len(pred_labels)
+    is_true_positive = np.zeros(num_preds, dtype=bool)
+    if num_preds == 0 or len(gt_labels) == 0:
+        return is_true_positive
+
+    # Assign a bucket ID to each unique (class, image) pair
+    num_gt = len(gt_labels)
+    keys = np.concatenate(
+        [
+            np.stack([gt_labels, gt_img_idx], axis=1),
+            np.stack([pred_labels, pred_img_idx], axis=1),
+        ]
+    ).astype(np.int64)
+    _, buckets = np.unique(keys, axis=0, return_inverse=True)
+    buckets = buckets.reshape(-1)
+    gt_buckets, pred_buckets = buckets[:num_gt], buckets[num_gt:]
+
+    # Index gt boxes by bucket, preserving their original order within each bucket
+    gt_order = np.argsort(gt_buckets, kind="stable")
+    gt_counts = np.bincount(gt_buckets, minlength=buckets.max() + 1)
+    gt_starts = np.cumsum(gt_counts) - gt_counts
+
+    # Sort predicted boxes by class, then by descending confidence
+    pred_order = np.lexsort((-pred_scores, pred_labels))
+    sorted_buckets = pred_buckets[pred_order]
+
+    # Pair each predicted box with every gt box from its bucket
+    num_pairs = gt_counts[sorted_buckets]
+    pair_starts = np.cumsum(num_pairs) - num_pairs
+    pair_pred = np.repeat(pred_order, num_pairs)
+    pair_offset = np.arange(num_pairs.sum()) - np.repeat(pair_starts, num_pairs)
+    pair_gt = gt_order[np.repeat(gt_starts[sorted_buckets], num_pairs) + pair_offset]
+    if len(pair_gt) == 0:
+        return is_true_positive
+    ious = _intersection_over_union_pairs(pred_boxes[pair_pred], gt_boxes[pair_gt])
+
+    # For each predicted box with any candidates, find the highest IoU and the last
+    # gt box attaining it
+    has_candidates = num_pairs > 0
+    segment_starts = pair_starts[has_candidates]
+    highest_ious = np.maximum.reduceat(ious, segment_starts)
+    is_highest = ious == np.repeat(highest_ious, num_pairs[has_candidates])
+    highest_pair = np.maximum.reduceat(
+        np.where(is_highest, np.arange(len(ious)), -1), segment_starts
     )
+    best_gt = pair_gt[highest_pair]
 
-    # Remove the class ID that corresponds to a physical adversarial patch in APRICOT
-    # dataset, if present
-    set_of_class_ids.discard(ADV_PATCH_MAGIC_NUMBER_LABEL_ID)
+    # Within each bucket, only the most confident prediction above the threshold
+    # covers a given gt box. Any subsequent ones are false positives
+    above_threshold = highest_ious > iou_threshold
+    candidate_preds = pred_order[has_candidates][above_threshold]
+    _, first_match = np.unique(best_gt[above_threshold], return_index=True)
+    is_true_positive[candidate_preds[first_match]] = True
+    return is_true_positive
 
-    # Initialize dict that will store AP for each class
-    average_precisions_by_class = {}
 
-    # Compute AP for each class
-    for class_id in set_of_class_ids:
-
-        # Build lists that contain all the predicted/ground-truth boxes with a
-        # label of class_id
-        class_predicted_boxes = []
-        class_gt_boxes = []
-        for pred_box in pred_boxes_list:
-            if pred_box["label"] == class_id:
-                class_predicted_boxes.append(pred_box)
-        for gt_box in gt_boxes_list:
-            if gt_box["label"] == class_id:
-                class_gt_boxes.append(gt_box)
-
-        # Determine how many gt boxes (of class_id) there are in each image
-        num_gt_boxes_per_img = Counter([gt["img_idx"] for gt in class_gt_boxes])
-
-        # Initialize dict where we'll keep track of whether a gt box has been matched to a
-        # prediction yet. This is necessary because if multiple predicted boxes of class_id
-        # overlap with a single gt box, only one of the predicted boxes can be considered a
-        # true positive
-        img_idx_to_gtboxismatched_array = {}
-        for img_idx, num_gt_boxes in num_gt_boxes_per_img.items():
-            img_idx_to_gtboxismatched_array[img_idx] = np.zeros(num_gt_boxes)
-
-        # Sort all predicted boxes (of class_id) by descending confidence
-        class_predicted_boxes.sort(key=lambda x: x["score"], reverse=True)
-
-        # Initialize arrays. Once filled in, true_positives[i] indicates (with a 1 or 0)
-        # whether the ith predicted box (of class_id) is a true positive. Likewise for
-        # false_positives array
-        true_positives = np.zeros(len(class_predicted_boxes))
-        false_positives = np.zeros(len(class_predicted_boxes))
-
-        # Iterating over all predicted boxes of class_id
-        for pred_idx, pred_box in enumerate(class_predicted_boxes):
-            # Only compare gt boxes from the same image as the predicted box
-            gt_boxes_from_same_img = [
-                gt_box
-                for gt_box in class_gt_boxes
-                if gt_box["img_idx"] == pred_box["img_idx"]
-            ]
-
-            # If there are no gt boxes in the predicted box's image that have the predicted class
-            if len(gt_boxes_from_same_img) == 0:
-                false_positives[pred_idx] = 1
-                continue
-
-            # Iterate over all gt boxes (of class_id) from the same image as the predicted box,
-            # determining which gt box has the highest iou with the predicted box
-            highest_iou = 0
-            for gt_idx, gt_box in enumerate(gt_boxes_from_same_img):
-                iou = _intersection_over_union(pred_box["box"], gt_box["box"])
-                if iou >= highest_iou:
-                    highest_iou = iou
-                    highest_iou_gt_idx = gt_idx
-
-            if highest_iou > IOU_THRESHOLD:
-                # If the gt box has not yet been covered
-                if (
-                    img_idx_to_gtboxismatched_array[pred_box["img_idx"]][
-                        highest_iou_gt_idx
-                    ]
-                    == 0
-                ):
-                    true_positives[pred_idx] = 1
-
-                    # Record that we've now covered this gt box. Any subsequent
-                    # pred boxes that overlap with it are considered false positives
-                    img_idx_to_gtboxismatched_array[pred_box["img_idx"]][
-                        highest_iou_gt_idx
-                    ] = 1
-                else:
-                    # This gt box was already covered previously (i.e a different predicted
-                    # box was deemed a true positive after overlapping with this gt box)
-                    false_positives[pred_idx] = 1
-            else:
-                false_positives[pred_idx] = 1
+def _average_precision_per_class(
+    pred_labels, pred_scores, is_true_positive, class_ids, total_gt_boxes_by_class
+):
+    """
+    Compute the 11-point interpolated average precision for each class in class_ids,
+        given the true positive status of every predicted box and the number of
+        ground-truth boxes of each class
+    """
+    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
+    RECALL_POINTS = np.linspace(0, 1, 11)
 
-        # Cumulative sums of false/true positives across all predictions which were sorted by
-        # descending confidence
-        tp_cumulative_sum = np.cumsum(true_positives)
-        fp_cumulative_sum = np.cumsum(false_positives)
+    # Sort all predicted boxes by class, then by descending confidence
+    pred_order = np.lexsort((-pred_scores, pred_labels))
+    sorted_labels = pred_labels[pred_order]
+    sorted_true_positives = is_true_positive[pred_order].astype(np.int64)
+    class_starts = np.searchsorted(sorted_labels, class_ids, side="left")
+    class_ends = np.searchsorted(sorted_labels, class_ids, side="right")
 
-        # Total number of gt boxes with a label of class_id
-        total_gt_boxes = len(class_gt_boxes)
+    average_precisions_by_class = {}
+    for class_id, start, end, total_gt_boxes in zip(
+        class_ids, class_starts, class_ends, total_gt_boxes_by_class
+    ):
+        # Cumulative sums of false/true positives across all predictions of class_id,
+        # which were sorted by descending confidence
+        tp_cumulative_sum = np.cumsum(sorted_true_positives[start:end])
+        fp_cumulative_sum = np.arange(1, end - start + 1) - tp_cumulative_sum
 
         if total_gt_boxes > 0:
             recalls = tp_cumulative_sum / total_gt_boxes
@@ -633,17 +844,17 @@ def object_detection_AP_per_class(list_of_ys, list_of_y_preds):
 
         precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
 
-        interpolated_precisions = np.zeros(len(RECALL_POINTS))
         # Interpolate the precision at each recall level by taking the max precision for which
-        # the corresponding recall exceeds the recall point
+        # the corresponding recall exceeds the recall point. Since recalls are nondecreasing,
+        # this is the suffix maximum of the precisions, starting at the first such recall
         # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
-        for i, recall_point in enumerate(RECALL_POINTS):
-            precisions_points = precisions[np.where(recalls >= recall_point)]
-            # If there's no cutoff at which the recall > recall_point
-            if len(precisions_points) == 0:
-                interpolated_precisions[i] = 0
-            else:
-                interpolated_precisions[i] = max(precisions_points)
+        interpolated_precisions = np.zeros(len(RECALL_POINTS))
+        if len(precisions):
+            max_precisions = np.maximum.accumulate(precisions[::-1])[::-1]
+            cutoffs = np.searchsorted(recalls, RECALL_POINTS, side="left")
+            # If there's no cutoff at which the recall > recall_point, precision is 0
+            has_cutoff = cutoffs < len(precisions)
+            interpolated_precisions[has_cutoff] = max_precisions[cutoffs[has_cutoff]]
 
         # Compute mean precision across the different recall levels
         average_precision = interpolated_precisions.mean()
@@ -654,185 +865,257 @@ def object_detection_AP_per_class(list_of_ys, list_of_y_preds):
     return average_precisions_by_class
 
 
-def apricot_patch_targeted_AP_per_class(list_of_ys, list_of_y_preds):
+class _APAccumulator(abc.ABC):
     """
-    Average precision indicating how successfully the APRICOT patch causes the detector
-    to predict the targeted class of the patch at the location of the patch. A higher
-    value for this metric implies a more successful patch.
+    Incrementally accumulates the information needed to compute average precision
+        per class, one batch at a time.
 
-    The box associated with the patch is assigned the label of the patch's targeted class.
-    Thus, a true positive is the case where the detector predicts the patch's targeted
-    class (at a location overlapping the patch). A false positive is the case where the
-    detector predicts a non-targeted class at a location overlapping the patch. If the
-    detector predicts multiple instances of the target class (that overlap with the patch),
-    one of the predictions is considered a true positive and the others are ignored.
+    Boxes are matched as each batch arrives. Only the label, score, and true positive
+        status of each retained predicted box are kept, along with the number of
+        ground-truth boxes of each class, so memory is bounded by the number of
+        detections rather than by the raw labels and predictions.
+    """
 
-    This metric is computed over all evaluation samples, rather than on a per-sample basis.
-    It returns a dictionary mapping each class to the average precision (AP) for the class.
-    The only classes with potentially nonzero AP's are the classes targeted by the patches
-    (see above paragraph).
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._pred_labels = []
+        self._pred_scores = []
+        self._is_true_positive = []
+        self._total_gt_boxes_by_class = Counter()
+
+    @abc.abstractmethod
+    def _match_batch(self, y, y_pred):
+        """
+        Return (pred_labels, pred_scores, is_true_positive, gt_labels) for a batch
+        """
+
+    def update(self, y, y_pred):
+        """
+        Match the boxes of a batch of labels and predictions
+        """
+        if not len(y_pred):
+            # e.g., an empty shard or a filtered batch
+            return
+        pred_labels, pred_scores, is_true_positive, gt_labels = self._match_batch(
+            y, y_pred
+        )
+        self._pred_labels.append(pred_labels.astype(np.int64))
+        self._pred_scores.append(pred_scores)
+        self._is_true_positive.append(is_true_positive)
+        self._total_gt_boxes_by_class.update(gt_labels.astype(np.int64).tolist())
+
+    def _consolidate(self):
+        # Merge per-batch arrays into one array each, preserving arrival order
+        for arrays in self._pred_labels, self._pred_scores, self._is_true_positive:
+            if len(arrays) > 1:
+                arrays[:] = [np.concatenate(arrays)]
+
+    def merge(self, other):
+        """
+        Add the boxes accumulated by other, as if its batches arrived after these
+        """
+        if type(other) is not type(self):
+            raise ValueError(f"Cannot merge {type(other)} into {type(self)}")
+        self._pred_labels.extend(other._pred_labels)
+        self._pred_scores.extend(other._pred_scores)
+        self._is_true_positive.extend(other._is_true_positive)
+        self._total_gt_boxes_by_class.update(other._total_gt_boxes_by_class)
+
+    def state(self):
+        """
+        Return a dict of arrays of the accumulated boxes, as accepted by load_state
+        """
+        self._consolidate()
+        if self._pred_labels:
+            pred_labels = self._pred_labels[0]
+            pred_scores = self._pred_scores[0]
+            is_true_positive = self._is_true_positive[0]
+        else:
+            pred_labels = np.zeros(0, dtype=np.int64)
+            pred_scores = np.zeros(0, dtype=np.float64)
+            is_true_positive = np.zeros(0, dtype=bool)
+        return {
+            "pred_labels": pred_labels,
+            "pred_scores": pred_scores,
+            "is_true_positive": is_true_positive,
+            "gt_classes": np.fromiter(self._total_gt_boxes_by_class, dtype=np.int64),
+            "gt_counts": np.fromiter(
+                self._total_gt_boxes_by_class.values(), dtype=np.int64
+            ),
+        }
+
+    def load_state(self, state):
+        self.clear()
+        if len(state["pred_labels"]):
+            self._pred_labels.append(state["pred_labels"])
+            self._pred_scores.append(state["pred_scores"])
+            self._is_true_positive.append(state["is_true_positive"])
+        self._total_gt_boxes_by_class.update(
+            dict(zip(state["gt_classes"].tolist(), state["gt_counts"].tolist()))
+        )
+
+    def AP_per_class(self):
+        """
+        Return a dictionary mapping each class to its AP over all batches seen so far
+        """
+        if not self._pred_labels:
+            # Classes present only in the gt boxes have zero AP
+            return {int(i): 0.0 for i in self._total_gt_boxes_by_class}
+        self._consolidate()
+        pred_labels = self._pred_labels[0]
+        class_ids = np.union1d(
+            np.fromiter(self._total_gt_boxes_by_class, dtype=np.int64), pred_labels
+        )
+        total_gt_boxes_by_class = np.array(
+            [self._total_gt_boxes_by_class[i] for i in class_ids.tolist()],
+            dtype=np.int64,
+        )
+        return _average_precision_per_class(
+            pred_labels,
+            self._pred_scores[0],
+            self._is_true_positive[0],
+            class_ids,
+            total_gt_boxes_by_class,
+        )
+
+
+class ObjectDetectionAPAccumulator(_APAccumulator):
+    """
+    Incrementally computes object_detection_AP_per_class
+    """
+
+    IOU_THRESHOLD = 0.5
+
+    def _match_batch(self, y, y_pred):
+        (
+            (gt_img_idx, gt_labels, gt_boxes),
+            (pred_img_idx, pred_labels, pred_boxes, pred_scores),
+        ) = _object_detection_boxes_to_columns(y, y_pred)
+
+        # Remove boxes with the class ID that corresponds to a physical adversarial
+        # patch in APRICOT dataset, if present
+        gt_keep = gt_labels != ADV_PATCH_MAGIC_NUMBER_LABEL_ID
+        pred_keep = pred_labels != ADV_PATCH_MAGIC_NUMBER_LABEL_ID
+        gt_img_idx, gt_labels, gt_boxes = (
+            gt_img_idx[gt_keep],
+            gt_labels[gt_keep],
+            gt_boxes[gt_keep],
+        )
+        pred_img_idx, pred_labels, pred_boxes, pred_scores = (
+            pred_img_idx[pred_keep],
+            pred_labels[pred_keep],
+            pred_boxes[pred_keep],
+            pred_scores[pred_keep],
+        )
+
+        is_true_positive = _object_detection_match_boxes(
+            gt_img_idx,
+            gt_labels,
+            gt_boxes,
+            pred_img_idx,
+            pred_labels,
+            pred_boxes,
+            pred_scores,
+            self.IOU_THRESHOLD,
+        )
+        return pred_labels, pred_scores, is_true_positive, gt_labels
+
+
+class ApricotPatchTargetedAPAccumulator(_APAccumulator):
+    """
+    Incrementally computes apricot_patch_targeted_AP_per_class
     """
 
     # From https://arxiv.org/abs/1912.08166: use a low IOU since "the patches will sometimes
     # generate many small, overlapping predictions in the region of the attack"
     IOU_THRESHOLD = 0.1
 
-    # Precision will be computed at recall points of 0, 0.1, 0.2, ..., 1
-    RECALL_POINTS = np.linspace(0, 1, 11)
-
-    # Converting boxes to a list of dicts (a list for predicted boxes that overlap with the patch,
-    # and a separate list for ground truth patch boxes), where each dict corresponds to a box and
-    # has the following keys "img_idx", "label", "box", as well as "score" for predicted boxes
-    patch_boxes_list = []
-    overlappping_pred_boxes_list = []
-    # Each element in list_of_y_preds is a list with length equal to batch size
-    batch_size = len(list_of_y_preds[0])
-    for batch_idx, (y, y_pred) in enumerate(zip(list_of_ys, list_of_y_preds)):
+    def _match_batch(self, y, y_pred):
+        pred_labels, pred_scores, is_true_positive, patch_labels = [], [], [], []
         for img_idx in range(len(y_pred)):
-            global_img_idx = (batch_size * batch_idx) + img_idx
             idx_of_patch = np.where(
                 y[img_idx]["labels"].flatten() == ADV_PATCH_MAGIC_NUMBER_LABEL_ID
             )[0]
             patch_box = y[img_idx]["boxes"].reshape((-1, 4))[idx_of_patch].flatten()
             patch_id = int(y[img_idx]["patch_id"].flatten()[idx_of_patch])
             patch_target_label = APRICOT_PATCHES[patch_id]["adv_target"]
-            patch_box_dict = {
-                "img_idx": global_img_idx,
-                "label": patch_target_label,
-                "box": patch_box,
-            }
-            patch_boxes_list.append(patch_box_dict)
-
-            for pred_box_idx in range(y_pred[img_idx]["labels"].size):
-                box = y_pred[img_idx]["boxes"][pred_box_idx]
-                if _intersection_over_union(box, patch_box) > IOU_THRESHOLD:
-                    label = y_pred[img_idx]["labels"][pred_box_idx]
-                    score = y_pred[img_idx]["scores"][pred_box_idx]
-                    pred_box_dict = {
-                        "img_idx": global_img_idx,
-                        "label": label,
-                        "box": box,
-                        "score": score,
-                    }
-                    overlappping_pred_boxes_list.append(pred_box_dict)
-
-    # Union of (1) the set of classes targeted by patches and (2) the set of all classes
-    # predicted at a location that overlaps the patch in the image
-    set_of_class_ids = set([i["label"] for i in patch_boxes_list]) | set(
-        [i["label"] for i in overlappping_pred_boxes_list]
-    )
-
-    # Initialize dict that will store AP for each class
-    average_precisions_by_class = {}
+            patch_labels.append(patch_target_label)
+
+            # Only keep predicted boxes that overlap with the patch
+            labels = y_pred[img_idx]["labels"].flatten()
+            boxes = y_pred[img_idx]["boxes"].reshape((-1, 4))[: labels.size]
+            scores = y_pred[img_idx]["scores"].flatten()[: labels.size]
+            if labels.size:
+                ious = _intersection_over_union_pairs(
+                    boxes, np.broadcast_to(patch_box, boxes.shape)
+                )
+                overlapping = ious > self.IOU_THRESHOLD
+                labels, scores = labels[overlapping], scores[overlapping]
+
+            # A true positive is the most confident prediction of the patch's targeted
+            # class. If the detector predicts multiple instances of the target class,
+            # the others are ignored. Predictions of any other class are false positives
+            is_target = labels == patch_target_label
+            keep = ~is_target
+            is_tp = np.zeros(labels.size, dtype=bool)
+            if is_target.any():
+                target_indices = np.flatnonzero(is_target)
+                best = target_indices[np.argmax(scores[target_indices])]
+                keep[best] = True
+                is_tp[best] = True
+
+            pred_labels.append(labels[keep])
+            pred_scores.append(scores[keep])
+            is_true_positive.append(is_tp[keep])
+
+        return (
+            np.concatenate(pred_labels),
+            np.concatenate(pred_scores),
+            np.concatenate(is_true_positive),
+            np.array(patch_labels, dtype=np.int64),
+        )
 
-    # Compute AP for each class
-    for class_id in set_of_class_ids:
-        # Build lists that contain all the predicted and patch boxes with a
-        # label of class_id
-        class_predicted_boxes = []
-        class_patch_boxes = []
-        for pred_box in overlappping_pred_boxes_list:
-            if pred_box["label"] == class_id:
-                class_predicted_boxes.append(pred_box)
-        for patch_box in patch_boxes_list:
-            if patch_box["label"] == class_id:
-                class_patch_boxes.append(patch_box)
-
-        # Determine how many patch boxes (of class_id) there are in each image
-        num_patch_boxes_per_img = Counter([gt["img_idx"] for gt in class_patch_boxes])
-
-        # Initialize dict where we'll keep track of whether a patch box has been matched to a
-        # prediction yet. This is necessary because if multiple predicted boxes of class_id
-        # overlap with a patch box, only one of the predicted boxes can be considered a
-        # true positive. The rest will be ignored
-        img_idx_to_patchboxismatched_array = {}
-        for img_idx, num_patch_boxes in num_patch_boxes_per_img.items():
-            img_idx_to_patchboxismatched_array[img_idx] = np.zeros(num_patch_boxes)
-
-        # Sort all predicted boxes (of class_id) by descending confidence
-        class_predicted_boxes.sort(key=lambda x: x["score"], reverse=True)
-
-        # Initialize list. Once filled in, true_positives[i] indicates (with a 1 or 0)
-        # whether the ith predicted box (of class_id) is a true positive or false positive
-        is_true_positive = []
-
-        # Iterating over all predicted boxes of class_id
-        for pred_idx, pred_box in enumerate(class_predicted_boxes):
-            # Only compare patch boxes from the same image as the predicted box
-            patch_boxes_from_same_img = [
-                patch_box
-                for patch_box in class_patch_boxes
-                if patch_box["img_idx"] == pred_box["img_idx"]
-            ]
-
-            # If there are no patch boxes in the predicted box's image that target the predicted class
-            if len(patch_boxes_from_same_img) == 0:
-                is_true_positive.append(0)
-                continue
-
-            # Iterate over all patch boxes (of class_id) from the same image as the predicted box,
-            # determining which patch box has the highest iou with the predicted box.
-            highest_iou = 0
-            for patch_idx, patch_box in enumerate(patch_boxes_from_same_img):
-                iou = _intersection_over_union(pred_box["box"], patch_box["box"])
-                if iou >= highest_iou:
-                    highest_iou = iou
-                    highest_iou_patch_idx = patch_idx
-
-            # If the patch box has not yet been covered
-            if (
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ]
-                == 0
-            ):
-                is_true_positive.append(1)
-
-                # Record that we've now covered this patch box. Any subsequent
-                # pred boxes that overlap with it are ignored
-                img_idx_to_patchboxismatched_array[pred_box["img_idx"]][
-                    highest_iou_patch_idx
-                ] = 1
-            else:
-                # This patch box was already covered previously (i.e a different predicted
-                # box was deemed a true positive after overlapping with this patch box).
-                # The predicted box is thus ignored.
-                continue
 
-        # Cumulative sums of false/true positives across all predictions which were sorted by
-        # descending confidence
-        tp_cumulative_sum = np.cumsum(is_true_positive)
-        fp_cumulative_sum = np.cumsum([not i for i in is_true_positive])
+def object_detection_AP_per_class(list_of_ys, list_of_y_preds):
+    """
+    Mean average precision for object detection. This function returns a dictionary
+    mapping each class to the average precision (AP) for the class. The mAP can be computed
+    by taking the mean of the AP's across all classes.
 
-        # Total number of patch boxes with a label of class_id
-        total_patch_boxes = len(class_patch_boxes)
+    This metric is computed over all evaluation samples, rather than on a per-sample basis.
+    See ObjectDetectionAPAccumulator to compute it incrementally, batch by batch.
+    """
+    accumulator = ObjectDetectionAPAccumulator()
+    for y, y_pred in zip(list_of_ys, list_of_y_preds):
+        accumulator.update(y, y_pred)
+    return accumulator.AP_per_class()
 
-        if total_patch_boxes > 0:
-            recalls = tp_cumulative_sum / total_patch_boxes
-        else:
-            recalls = np.zeros_like(tp_cumulative_sum)
 
-        precisions = tp_cumulative_sum / (tp_cumulative_sum + fp_cumulative_sum + 1e-8)
-
-        interpolated_precisions = np.zeros(len(RECALL_POINTS))
-        # Interpolate the precision at each recall level by taking the max precision for which
-        # the corresponding recall exceeds the recall point
-        # See http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.157.5766&rep=rep1&type=pdf
-        for i, recall_point in enumerate(RECALL_POINTS):
-            precisions_points = precisions[np.where(recalls >= recall_point)]
-            # If there's no cutoff at which the recall > recall_point
-            if len(precisions_points) == 0:
-                interpolated_precisions[i] = 0
-            else:
-                interpolated_precisions[i] = max(precisions_points)
+def apricot_patch_targeted_AP_per_class(list_of_ys, list_of_y_preds):
+    """
+    Average precision indicating how successfully the APRICOT patch causes the detector
+    to predict the targeted class of the patch at the location of the patch. A higher
+    value for this metric implies a more successful patch.
 
-        # Compute mean precision across the different recall levels
-        average_precision = interpolated_precisions.mean()
-        average_precisions_by_class[int(class_id)] = np.around(
-            average_precision, decimals=2
-        )
+    The box associated with the patch is assigned the label of the patch's targeted class.
+    Thus, a true positive is the case where the detector predicts the patch's targeted
+    class (at a location overlapping the patch). A false positive is the case where the
+    detector predicts a non-targeted class at a location overlapping the patch. If the
+    detector predicts multiple instances of the target class (that overlap with the patch),
+    one of the predictions is considered a true positive and the others are ignored.
 
-    return average_precisions_by_class
+    This metric is computed over all evaluation samples, rather than on a per-sample basis.
+    It returns a dictionary mapping each class to the average precision (AP) for the class.
+    The only classes with potentially nonzero AP's are the classes targeted by the patches
+    (see above paragraph). See ApricotPatchTargetedAPAccumulator to compute it
+    incrementally, batch by batch.
+    """
+    accumulator = ApricotPatchTargetedAPAccumulator()
+    for y, y_pred in zip(list_of_ys, list_of_y_preds):
+        accumulator.update(y, y_pred)
+    return accumulator.AP_per_class()
 
 
 SUPPORTED_METRICS = {
@@ -859,6 +1142,12 @@ SUPPORTED_METRICS = {
     "object_detection_class_recall": object_detection_class_recall,
 }
 
+# Metrics computed across all samples, which are accumulated batch by batch
+AP_ACCUMULATORS = {
+    "apricot_patch_targeted_AP_per_class": ApricotPatchTargetedAPAccumulator,
+    "object_detection_AP_per_class": ObjectDetectionAPAccumulator,
+}
+
 # Image-based metrics applied to video
 
 
@@ -892,6 +1181,15 @@ for metric_name in "l0", "l1", "l2", "linf", "image_circle_patch_diameter":
         SUPPORTED_METRICS[new_metric_name] = new_metric
 
 
+def _is_number(value):
+    """
+    Return whether value is a real number, including numpy scalars
+    """
+    if isinstance(value, np.ndarray):
+        return value.ndim == 0 and value.dtype.kind in "biuf"
+    return isinstance(value, (numbers.Real, np.bool_))
+
+
 class MetricList:
     """
     Keeps track of all results from a single metric
@@ -909,10 +1207,15 @@ class MetricList:
             raise ValueError(f"function must be callable or None, not {function}")
         self.name = name
         self._values = []
-        self._inputs = []
+        if name in AP_ACCUMULATORS:
+            self._accumulator = AP_ACCUMULATORS[name]()
+        else:
+            self._accumulator = None
 
     def clear(self):
         self._values.clear()
+        if self._accumulator is not None:
+            self._accumulator.clear()
 
     def append(self, *args, **kwargs):
         value = self.function(*args, **kwargs)
@@ -931,7 +1234,89 @@ class MetricList:
         return sum(float(x) for x in self._values) / len(self._values)
 
     def append_inputs(self, *args):
-        self._inputs.append(args)
+        # Metrics computed across all samples are accumulated batch by batch
+        if self._accumulator is None:
+            raise ValueError(f"append_inputs() not supported for {self.name} metric")
+        self._accumulator.update(*args)
+
+    def merge(self, other):
+        """
+        Add the results of other, as if its samples followed those of self
+        """
+        if other.name != self.name:
+            raise ValueError(f"Cannot merge {other.name} metric into {self.name}")
+        self._values.extend(other._values)
+        if self._accumulator is not None:
+            self._accumulator.merge(other._accumulator)
+
+    def state(self):
+        """
+        Return (header, arrays) for the results of the metric, as accepted by
+            from_state. header is a JSON-able dict and arrays maps names to arrays
+        """
+        header = {"name": self.name}
+        if self._values and all(isinstance(x, tuple) for x in self._values):
+            # e.g., (edit distance, number of words) for word_error_rate
+            if len(set(len(x) for x in self._values)) != 1:
+                raise ValueError(
+                    f"Tuple values of metric {self.name} must all have the same length"
+                )
+            columns = list(zip(*self._values))
+            header["tuple_values"] = True
+        else:
+            columns = [self._values]
+        arrays = {}
+        for i, column in enumerate(columns):
+            # Checked before conversion, as numpy cannot convert ragged values
+            if not all(_is_number(x) for x in column):
+                raise ValueError(
+                    f"Values of metric {self.name} must be numbers or tuples of numbers"
+                )
+            array = np.array(column)
+            if array.ndim != 1 or array.dtype.kind not in "biuf":
+                raise ValueError(
+                    f"Values of metric {self.name} must be numbers or tuples of numbers"
+                )
+            if array.dtype.kind in "iu" and array.size:
+                # Store e.g. categorical_accuracy as one byte per sample
+                array = array.astype(
+                    np.result_type(
+                        np.min_scalar_type(array.min()), np.min_scalar_type(array.max())
+                    )
+                )
+            arrays[f"values_{i}"] = array
+            if array.dtype.kind == "f":
+                # Restore ints among floats, e.g., [0, 0.5], so results are unchanged
+                is_int = np.fromiter((type(x) is int for x in column), dtype=bool)
+                if is_int.any():
+                    arrays[f"values_{i}_is_int"] = is_int
+        if self._accumulator is not None:
+            arrays.update(
+                (f"accumulator_{k}", v) for k, v in self._accumulator.state().items()
+            )
+        return header, arrays
+
+    @classmethod
+    def from_state(cls, header, arrays):
+        metric = cls(header["name"])
+        columns = []
+        while f"values_{len(columns)}" in arrays:
+            key = f"values_{len(columns)}"
+            column = arrays[key].tolist()
+            if f"{key}_is_int" in arrays:
+                for j in np.flatnonzero(arrays[f"{key}_is_int"]).tolist():
+                    column[j] = int(column[j])
+            columns.append(column)
+        if header.get("tuple_values"):
+            metric._values.extend(zip(*columns))
+        else:
+            metric._values.extend(columns[0])
+        if metric._accumulator is not None:
+            prefix = "accumulator_"
+            metric._accumulator.load_state(
+                {k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)}
+            )
+        return metric
 
     def total_wer(self):
         # checks if all values are tuples from the WER metric
@@ -946,16 +1331,19 @@ class MetricList:
             raise ValueError("total_wer() only for WER metric")
 
     def AP_per_class(self):
-        # Computed at once across all samples
-        y_s = [i[0] for i in self._inputs]
-        y_preds = [i[1] for i in self._inputs]
-        return object_detection_AP_per_class(y_s, y_preds)
+        # Computed across all samples seen so far
+        if not isinstance(self._accumulator, ObjectDetectionAPAccumulator):
+            raise ValueError("AP_per_class() only for object_detection_AP_per_class")
+        return self._accumulator.AP_per_class()
 
     def apricot_patch_targeted_AP_per_class(self):
-        # Computed at once across all samples
-        y_s = [i[0] for i in self._inputs]
-        y_preds = [i[1] for i in self._inputs]
-        return apricot_patch_targeted_AP_per_class(y_s, y_preds)
+        # Computed across all samples seen so far
+        if not isinstance(self._accumulator, ApricotPatchTargetedAPAccumulator):
+            raise ValueError(
+                "apricot_patch_targeted_AP_per_class() only for "
+                "apricot_patch_targeted_AP_per_class metric"
+            )
+        return self._accumulator.AP_per_class()
 
 
 class MetricsLogger:
@@ -970,7 +1358,6 @@ class MetricsLogger:
         means=True,
         record_metric_per_sample=False,
         profiler_type=None,
-        computational_resource_dict=None,
         skip_benign=None,
         skip_attack=None,
         targeted=False,
@@ -981,6 +1368,10 @@ class MetricsLogger:
         perturbation - single metric or list of metrics
         means - whether to return the mean value for each metric
         record_metric_per_sample - whether to return metric values for each sample
+        profiler_type - None, "Basic", or "Deterministic". Timing results are taken
+            from the Instrumentation active at construction, which Scenario.evaluate
+            creates with this profiler_type. If none is active, the logger records
+            into its own Instrumentation of this profiler_type
         """
         self.tasks = [] if skip_benign else self._generate_counters(task)
         self.adversarial_tasks = [] if skip_attack else self._generate_counters(task)
@@ -992,7 +1383,9 @@ class MetricsLogger:
         )
         self.means = bool(means)
         self.full = bool(record_metric_per_sample)
-        self.computational_resource_dict = {}
+        self.instrumentation = instrumentation.active()
+        if self.instrumentation is None:
+            self.instrumentation = instrumentation.Instrumentation(profiler_type)
         if not self.means and not self.full:
             logger.warning(
                 "No per-sample metric results will be produced. "
@@ -1032,6 +1425,105 @@ class MetricsLogger:
         for metric in self.tasks + self.adversarial_tasks + self.perturbations:
             metric.clear()
 
+    def _metric_groups(self):
+        return {
+            "tasks": self.tasks,
+            "adversarial_tasks": self.adversarial_tasks,
+            "targeted_tasks": self.targeted_tasks,
+            "perturbations": self.perturbations,
+        }
+
+    def merge(self, other):
+        """
+        Add the metrics and timing recorded by other, which must
+            track the same metrics, as if its samples followed those of self
+
+        Merging the loggers of disjoint, consecutive slices of a dataset in order
+            produces the same results as a single logger over the whole dataset.
+        """
+        other_groups = other._metric_groups()
+        for group, metrics in self._metric_groups().items():
+            other_metrics = other_groups[group]
+            if [m.name for m in metrics] != [m.name for m in other_metrics]:
+                raise ValueError(
+                    f"Cannot merge {group} {[m.name for m in other_metrics]} into "
+                    f"{[m.name for m in metrics]}"
+                )
+            for metric, other_metric in zip(metrics, other_metrics):
+                metric.merge(other_metric)
+
+        self.instrumentation.merge(other.instrumentation)
+
+    def state(self) -> bytes:
+        """
+        Return the recorded results in a compact binary format, as accepted by
+            from_state
+
+        The format is an uncompressed .npz file, as written by np.savez, holding the
+            values of every metric as arrays, plus a JSON header of metric names and
+            options in the uint8 array "header". It can be loaded without pickle.
+        """
+        header = {
+            "version": STATE_VERSION,
+            "means": self.means,
+            "record_metric_per_sample": self.full,
+            "instrumentation": self.instrumentation.state(),
+        }
+        arrays = {}
+        for group, metrics in self._metric_groups().items():
+            header[group] = []
+            for i, metric in enumerate(metrics):
+                metric_header, metric_arrays = metric.state()
+                header[group].append(metric_header)
+                arrays.update(
+                    (f"{group}.{i}.{key}", value)
+                    for key, value in metric_arrays.items()
+                )
+        arrays["header"] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_state(cls, state: bytes):
+        """
+        Return a MetricsLogger with the results recorded in state
+        """
+        metrics_logger = cls.__new__(cls)
+        metrics_logger.load_state(state)
+        return metrics_logger
+
+    def load_state(self, state: bytes):
+        """
+        Replace the recorded results with those in state, as returned by state()
+        """
+        with np.load(io.BytesIO(state), allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+        header = json.loads(arrays.pop("header").tobytes().decode())
+        if header.get("version") != STATE_VERSION:
+            raise ValueError(
+                f"Metrics state version {header.get('version')} != {STATE_VERSION}"
+            )
+
+        for group in "tasks", "adversarial_tasks", "targeted_tasks", "perturbations":
+            metrics = []
+            for i, metric_header in enumerate(header[group]):
+                prefix = f"{group}.{i}."
+                metric_arrays = {
+                    key[len(prefix) :]: value
+                    for key, value in arrays.items()
+                    if key.startswith(prefix)
+                }
+                metrics.append(MetricList.from_state(metric_header, metric_arrays))
+            setattr(self, group, metrics)
+        self.means = header["means"]
+        self.full = header["record_metric_per_sample"]
+        if getattr(self, "instrumentation", None) is None:
+            self.instrumentation = instrumentation.Instrumentation(
+                header["instrumentation"]["profiler_type"]
+            )
+        self.instrumentation.load_state(header["instrumentation"])
+
     def update_task(self, y, y_pred, adversarial=False, targeted=False):
         if targeted and not adversarial:
             raise ValueError("benign task cannot be targeted")
@@ -1043,10 +1535,7 @@ class MetricsLogger:
             else self.tasks
         )
         for metric in tasks:
-            if metric.name in [
-                "object_detection_AP_per_class",
-                "apricot_patch_targeted_AP_per_class",
-            ]:
+            if metric.name in AP_ACCUMULATORS:
                 metric.append_inputs(y, y_pred)
             else:
                 metric.append(y, y_pred)
@@ -1150,18 +1639,6 @@ class MetricsLogger:
                             f"No values to calculate WER in {prefix}_{metric.name}"
                         )
 
-        for name in self.computational_resource_dict:
-            entry = self.computational_resource_dict[name]
-            if "execution_count" not in entry or "total_time" not in entry:
-                raise ValueError(
-                    "Computational resource dictionary entry corrupted, missing data."
-                )
-            total_time = entry["total_time"]
-            execution_count = entry["execution_count"]
-            average_time = total_time / execution_count
-            results[
-                f"Avg. CPU time (s) for {execution_count} executions of {name}"
-            ] = average_time
-            if "stats" in entry:
-                results[f"{name} profiler stats"] = entry["stats"]
+        if self.instrumentation.histograms:
+            results["timing"] = self.instrumentation.results()
         return results
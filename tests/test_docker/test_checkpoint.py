@@ -0,0 +1,145 @@
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from tqdm import tqdm
+
+from armory import paths
+from armory.scenarios.base import Scenario, CHECKPOINT_FILENAME
+from armory.utils import metrics
+from armory.utils.labels import ManualTargeter
+
+
+class RandomScenario(Scenario):
+    """
+    Scenario whose predictions, attacks, and target labels depend on random state
+    """
+
+    supports_checkpoints = True
+
+    def __init__(self, fail_at=None):
+        super().__init__()
+        self.fail_at = fail_at
+        self.skipped = []
+
+    def _evaluate(self, config, num_eval_batches, skip_benign, skip_attack):
+        metrics_logger = metrics.MetricsLogger(
+            task=["categorical_accuracy"], perturbation=["linf"], targeted=True,
+        )
+        self.metrics_logger = metrics_logger
+        rng = np.random.default_rng(0)
+        data = [(rng.normal(size=(2, 3)), rng.integers(3, size=2)) for _ in range(7)]
+
+        for x, y in self._checkpointed(data, "benign"):
+            metrics_logger.update_task(y, np.random.rand(len(y), 3))
+        metrics_logger.log_task()
+
+        label_targeter = ManualTargeter([0, 1, 2, 1, 0], repeat=True)
+        batches = tqdm(Batches(data, self.skipped), desc="Attack")
+        for i, (x, y) in enumerate(
+            self._checkpointed(batches, "attack", label_targeter=label_targeter)
+        ):
+            if i == self.fail_at:
+                raise ValueError("interrupted")
+            x_adv = x + np.random.uniform(-0.1, 0.1, size=x.shape)
+            y_pred_adv = np.random.rand(len(y), 3)
+            metrics_logger.update_task(y, y_pred_adv, adversarial=True)
+            y_target = label_targeter.generate(y)
+            metrics_logger.update_task(
+                y_target, y_pred_adv, adversarial=True, targeted=True
+            )
+            metrics_logger.update_perturbation(x, x_adv)
+        return metrics_logger.results()
+
+
+class Batches:
+    """
+    Iterator over data that records the numbers of batches skipped with skip
+    """
+
+    def __init__(self, data, skipped):
+        self.data = iter(data)
+        self.skipped = skipped
+
+    def skip(self, num_batches):
+        self.skipped.append(num_batches)
+        for _ in range(num_batches):
+            next(self.data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.data)
+
+
+def evaluate(scenario, config, output_dir):
+    np.random.seed(1)
+    scenario.evaluate(config, None, None, None, None)
+    results = [name for name in os.listdir(output_dir) if name.startswith("Random")]
+    with open(os.path.join(output_dir, max(results))) as f:
+        return json.load(f)["results"]
+
+
+@pytest.mark.parametrize("fail_at", [0, 3, 4])
+def test_resume(tmp_path, monkeypatch, fail_at):
+    runtime_paths = SimpleNamespace(output_dir=str(tmp_path))
+    monkeypatch.setattr(paths, "runtime_paths", lambda: runtime_paths)
+    config = {
+        "eval_id": "checkpoint",
+        "dataset": {},
+        "metric": {},
+        "scenario": {"name": "Random", "checkpoint_interval": 2},
+        "sysconfig": {},
+    }
+    output_dir = tmp_path / "checkpoint"
+    output_dir.mkdir()
+    expected = evaluate(RandomScenario(), config, output_dir)
+    assert not (output_dir / CHECKPOINT_FILENAME).exists()
+
+    with pytest.raises(SystemExit):
+        evaluate(RandomScenario(fail_at=fail_at), config, output_dir)
+    assert (output_dir / CHECKPOINT_FILENAME).exists()
+    scenario = RandomScenario()
+    scenario.set_resume(True)
+    assert evaluate(scenario, config, output_dir) == expected
+    assert not (output_dir / CHECKPOINT_FILENAME).exists()
+    # Attack batches before the checkpoint are skipped in the dataset
+    assert scenario.skipped == ([fail_at // 2 * 2] if fail_at >= 2 else [])
+
+    config["dataset"]["batch_size"] = 2
+    with pytest.raises(SystemExit):
+        evaluate(RandomScenario(fail_at=fail_at), config, output_dir)
+    config["dataset"]["batch_size"] = 1
+    with pytest.raises(ValueError, match="different config"):
+        evaluate(scenario, config, output_dir)
+
+
+def test_resume_training(tmp_path, monkeypatch):
+    runtime_paths = SimpleNamespace(output_dir=str(tmp_path))
+    monkeypatch.setattr(paths, "runtime_paths", lambda: runtime_paths)
+    config = {
+        "eval_id": "checkpoint",
+        "dataset": {},
+        "metric": {},
+        "model": {"fit": True},
+        "scenario": {"name": "Random", "checkpoint_interval": 2},
+        "sysconfig": {},
+    }
+    output_dir = tmp_path / "checkpoint"
+    output_dir.mkdir()
+    # Checkpoints are not saved, as resuming would retrain the model
+    with pytest.raises(SystemExit):
+        evaluate(RandomScenario(fail_at=3), config, output_dir)
+    assert not (output_dir / CHECKPOINT_FILENAME).exists()
+
+    scenario = RandomScenario()
+    scenario.set_resume(True)
+    with pytest.raises(ValueError, match="trains its model"):
+        evaluate(scenario, config, output_dir)
+    config["model"]["fit"] = False
+    config["defense"] = {"type": "Trainer"}
+    with pytest.raises(ValueError, match="trains its model"):
+        evaluate(scenario, config, output_dir)
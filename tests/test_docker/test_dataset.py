@@ -52,6 +52,36 @@ def test_parse_split_index():
         datasets.parse_split_index("test[10:20:2]")
 
 
+def test_shard_split():
+    for split, num_examples, num_shards, shards in [
+        ("test", 10, 3, ["test[0:3]", "test[3:6]", "test[6:10]"]),
+        ("test[10:20]", 10, 3, ["test[10:13]", "test[13:16]", "test[16:20]"]),
+        ("train[:4]", 4, 4, ["train[0:1]", "train[1:2]", "train[2:3]", "train[3:4]"]),
+        ("test", 10, 1, ["test[0:10]"]),
+    ]:
+        for index, shard in enumerate(shards):
+            assert datasets.shard_split(split, num_examples, index, num_shards) == shard
+
+    for split in "test[:10%]", "test[-5:]", "test+train", "test[[1, 5, 7]]":
+        with pytest.raises(ValueError):
+            datasets.shard_split(split, 10, 0, 2)
+    for index, num_shards in (-1, 2), (2, 2), (0, 20):
+        with pytest.raises(ValueError):
+            datasets.shard_split("test", 10, index, num_shards)
+
+
+def test_offset_split():
+    assert datasets.offset_split("test", 10, 4) == "test[4:10]"
+    assert datasets.offset_split("test[10:20]", 10, 0) == "test[10:20]"
+    assert datasets.offset_split("train[:4]", 4, 3) == "train[3:4]"
+    for split in "test[:10%]", "test+train":
+        with pytest.raises(ValueError):
+            datasets.offset_split(split, 10, 2)
+    for offset in -1, 10:
+        with pytest.raises(ValueError):
+            datasets.offset_split("test", 10, offset)
+
+
 def test_parse_split_index_ordering():
     """
     Ensure that output order is deterministic for multiple splits
@@ -384,3 +414,205 @@ def test_numpy_generator():
     )
     x, y = dataset.get_batch()
     assert isinstance(x, np.ndarray)
+
+
+def test_prefetch():
+    def generator():
+        for i in range(10):
+            yield np.arange(i + 1)[None], np.array([i])
+
+    def make_dataset(prefetch_batches):
+        dataset = datasets.ArmoryDataGenerator(
+            generator(),
+            size=10,
+            epochs=1,
+            batch_size=3,
+            preprocessing_fn=lambda x: x * 2,
+            variable_length=True,
+        )
+        dataset.set_prefetch(prefetch_batches, num_workers=2)
+        return dataset
+
+    reference = list(make_dataset(0))
+    assert [len(y) for x, y in reference] == [3, 3, 3, 1]
+    prefetched = list(make_dataset(2))
+    assert len(prefetched) == len(reference)
+    for (x, y), (x_ref, y_ref) in zip(prefetched, reference):
+        assert (y == y_ref).all()
+        for x_i, x_ref_i in zip(x, x_ref):
+            assert (x_i == x_ref_i).all()
+
+    dataset = make_dataset(2)
+    with pytest.raises(StopIteration):
+        for _ in range(5):
+            dataset.get_batch()
+    with pytest.raises(StopIteration):
+        dataset.get_batch()
+
+    eval_dataset = datasets.EvalGenerator(make_dataset(2), num_eval_batches=2)
+    assert [y.tolist() for x, y in eval_dataset] == [[0, 1, 2], [3, 4, 5]]
+    assert eval_dataset.armory_generator._prefetcher is None
+
+    with pytest.raises(ValueError):
+        make_dataset(-1)
+
+
+def test_skip():
+    def generator(start=0):
+        for i in range(start, 10):
+            yield np.arange(i + 1)[None], np.array([i])
+
+    preprocessed = []
+
+    def preprocessing_fn(x):
+        preprocessed.extend(len(x_i) - 1 for x_i in x)
+        return x
+
+    def make_dataset(skip_source=None):
+        return datasets.ArmoryDataGenerator(
+            generator(),
+            size=10,
+            epochs=1,
+            batch_size=3,
+            preprocessing_fn=preprocessing_fn,
+            variable_length=True,
+            skip_source=skip_source,
+        )
+
+    sources = []
+
+    def skip_source(num_examples):
+        sources.append(num_examples)
+        return generator(num_examples)
+
+    for dataset in make_dataset(), make_dataset(skip_source):
+        preprocessed.clear()
+        eval_dataset = datasets.EvalGenerator(dataset, num_eval_batches=3)
+        eval_dataset.skip(2)
+        assert [y.tolist() for x, y in eval_dataset] == [[6, 7, 8]]
+        assert preprocessed == [6, 7, 8]
+    assert sources == [6]
+
+    # Skipping past the end of the dataset
+    dataset = make_dataset()
+    dataset.skip(5)
+    with pytest.raises(StopIteration):
+        dataset.get_batch()
+
+
+def test_preprocessed_cache(tmp_path):
+    from armory.data import preprocessed_cache
+
+    def generator():
+        for i in range(5):
+            x = np.arange(i + 1, dtype=np.uint8)[None]
+            yield x, {
+                "label": np.array([i]),
+                "text": np.array([b"t%d" % i], dtype=object),
+            }
+
+    def make_dataset(preprocessing_fn):
+        return datasets.ArmoryDataGenerator(
+            generator(),
+            size=5,
+            epochs=1,
+            batch_size=2,
+            preprocessing_fn=preprocessing_fn,
+            variable_length=True,
+            variable_y=True,
+        )
+
+    def scale(x):
+        return np.array([x_i / 2 for x_i in x] + [None], dtype=object)[:-1]
+
+    key = preprocessed_cache.cache_key("digit", scale)
+    assert key == preprocessed_cache.cache_key("digit", scale)
+    assert key != preprocessed_cache.cache_key("digit", lambda x: x)
+
+    dataset = preprocessed_cache.cached_dataset(make_dataset(scale), key, tmp_path)
+    reference = list(dataset)
+    assert os.listdir(tmp_path) == [key]
+
+    cached = preprocessed_cache.cached_dataset(make_dataset(None), key, tmp_path)
+    assert cached.preprocessing_fn is None
+    assert len(cached) == len(dataset)
+    batches = list(cached)
+    assert len(batches) == len(reference) == 3
+    for (x, y), (x_ref, y_ref) in zip(batches, reference):
+        assert x.dtype == object
+        for x_i, x_ref_i in zip(x, x_ref):
+            assert x_i.dtype == x_ref_i.dtype
+            assert (x_i == x_ref_i).all()
+        for y_i, y_ref_i in zip(y, y_ref):
+            assert (y_i["label"] == y_ref_i["label"]).all()
+            assert y_i["text"].tolist() == y_ref_i["text"].tolist()
+
+    # Partial iteration does not leave a cache entry behind
+    dataset = preprocessed_cache.cached_dataset(make_dataset(None), "partial", tmp_path)
+    eval_dataset = datasets.EvalGenerator(dataset, num_eval_batches=1)
+    assert len(list(eval_dataset)) == 1
+    assert os.listdir(tmp_path) == [key]
+
+
+class Scale:
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, x):
+        return x * self.factor
+
+    def scale(self, x):
+        return x * self.factor
+
+
+def test_preprocessed_cache_key_tracks_helpers(tmp_path, monkeypatch):
+    import importlib
+    import sys
+    from armory.data import preprocessed_cache
+
+    # Editing a helper module called by a preprocessing function changes the key
+    monkeypatch.syspath_prepend(str(tmp_path))
+    helper_path = tmp_path / "cache_key_helper.py"
+    helper_path.write_text("def crop(x):\n    return x[1:]\n")
+    helper = importlib.import_module("cache_key_helper")
+    monkeypatch.setitem(sys.modules, "cache_key_helper", helper)
+    namespace = {"cache_key_helper": helper}
+    exec("def fn(x):\n    return cache_key_helper.crop(x)\n", namespace)
+    key = preprocessed_cache.cache_key(namespace["fn"])
+    assert key == preprocessed_cache.cache_key(namespace["fn"])
+    helper_path.write_text("def crop(x):\n    return x[1:-1]\n")
+    importlib.reload(helper)
+    assert key != preprocessed_cache.cache_key(namespace["fn"])
+
+    # Callable instances and bound methods include the attributes of the instance
+    assert preprocessed_cache.cache_key(Scale(2)) == preprocessed_cache.cache_key(
+        Scale(2)
+    )
+    assert preprocessed_cache.cache_key(Scale(2)) != preprocessed_cache.cache_key(
+        Scale(3)
+    )
+    assert preprocessed_cache.cache_key(Scale(2).scale) != preprocessed_cache.cache_key(
+        Scale(3).scale
+    )
+
+
+def test_preprocessed_cache_key_is_stable():
+    import subprocess
+    import sys
+
+    # Preprocessing functions reference objects, such as loggers and contexts,
+    #     whose attributes and repr differ between processes
+    code = (
+        "from armory.data import datasets, preprocessed_cache;"
+        "print(preprocessed_cache.cache_key("
+        "datasets.cifar10, datasets.cifar10_canonical_preprocessing,"
+        "datasets.canonical_variable_image_preprocess, datasets.logger,"
+        "vars(datasets.cifar10_context), {'split': 'test', 'batch_size': 2}))"
+    )
+    keys = [
+        subprocess.run(
+            [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE
+        ).stdout.splitlines()[-1]
+        for _ in range(2)
+    ]
+    assert keys[0] == keys[1]
@@ -0,0 +1,243 @@
+"""
+Test dataset downloads against a local HTTP server
+"""
+
+import hashlib
+import http.server
+import io
+import os
+import re
+import tarfile
+import threading
+
+import pytest
+
+from armory.data import utils
+
+
+def make_archive(members):
+    """
+    Return the bytes of a gzipped tar archive of {path: content} files
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, content in members.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+MEMBERS = {
+    "mnist/3.0.1/mnist-train.tfrecord-00000-of-00001": os.urandom(60_000),
+    "mnist/3.0.1/dataset_info.json": b"{}",
+}
+CONTENT = make_archive(MEMBERS)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    accept_ranges = True
+    fail_ranges = set()
+
+    def log_message(self, *args):
+        pass
+
+    def send_content_headers(self, length):
+        self.send_header("Content-Length", str(length))
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_content_headers(len(CONTENT))
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and self.accept_ranges:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            if start in self.fail_ranges:
+                self.send_response(500)
+                self.send_content_headers(0)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(CONTENT)}")
+            self.send_content_headers(end - start)
+            self.wfile.write(CONTENT[start:end])
+        else:
+            self.send_response(200)
+            self.send_content_headers(len(CONTENT))
+            self.wfile.write(CONTENT)
+
+
+@pytest.fixture
+def server():
+    RangeRequestHandler.accept_ranges = True
+    RangeRequestHandler.fail_ranges = set()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/data.tar.gz"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_ranges(server, tmp_path):
+    digest = utils.download_requests(
+        server, str(tmp_path), "data.tar.gz", num_workers=4, part_size=7_000
+    )
+    filepath = tmp_path / "data.tar.gz"
+    assert filepath.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert not os.path.exists(f"{filepath}.progress")
+
+
+def test_download_ranges_pending_parts(server, tmp_path):
+    # The hash and callback are fed the chunks written, not parts read back
+    filepath = str(tmp_path / "data.tar.gz")
+    chunks = []
+    digest = utils._download_ranges(
+        server,
+        filepath,
+        len(CONTENT),
+        True,
+        num_workers=4,
+        part_size=7_000,
+        callback=chunks.append,
+        chunk_size=1_000,
+        max_pending_parts=1,
+    )
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert b"".join(chunks) == CONTENT
+    assert max(len(chunk) for chunk in chunks) <= 1_000
+
+    # Workers waiting for the prefix to advance are stopped by a failure
+    RangeRequestHandler.fail_ranges = {0}
+    with pytest.raises(Exception):
+        utils._download_ranges(
+            server,
+            str(tmp_path / "failed.tar.gz"),
+            len(CONTENT),
+            True,
+            num_workers=4,
+            part_size=7_000,
+            max_pending_parts=1,
+        )
+
+
+def test_download_resume(server, tmp_path):
+    part_size = 10_000
+    RangeRequestHandler.fail_ranges = {3 * part_size}
+    with pytest.raises(Exception):
+        utils.download_requests(
+            server, str(tmp_path), "data.tar.gz", num_workers=2, part_size=part_size
+        )
+    filepath = tmp_path / "data.tar.gz"
+    assert os.path.exists(f"{filepath}.progress")
+
+    RangeRequestHandler.fail_ranges = set()
+    digest = utils.download_requests(
+        server, str(tmp_path), "data.tar.gz", num_workers=2, part_size=part_size
+    )
+    assert filepath.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert not os.path.exists(f"{filepath}.progress")
+
+
+def test_download_without_ranges(server, tmp_path):
+    RangeRequestHandler.accept_ranges = False
+    digest = utils.download_requests(server, str(tmp_path), "data.tar.gz")
+    assert (tmp_path / "data.tar.gz").read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_extract_tar_stream(server, tmp_path):
+    stream = utils._ChunkStream()
+    extraction = {}
+
+    def extract():
+        extraction["filepaths"] = utils.extract_tar_stream(stream, str(tmp_path))
+
+    thread = threading.Thread(target=extract)
+    thread.start()
+    utils.download_requests(
+        server,
+        str(tmp_path),
+        "data.tar.gz",
+        num_workers=4,
+        part_size=7_000,
+        callback=stream.put,
+    )
+    stream.close_input()
+    thread.join()
+
+    assert len(extraction["filepaths"]) == len(MEMBERS)
+    for path, content in MEMBERS.items():
+        assert (tmp_path / path).read_bytes() == content
+
+    for members in [
+        {"../evil": b""},
+        {"/evil": b""},
+        {"mnist/x": b"", "other/y": b""},
+    ]:
+        with pytest.raises(ValueError):
+            utils.extract_tar_stream(io.BytesIO(make_archive(members)), str(tmp_path))
+
+
+def test_download_verify_dataset_cache(tmp_path, monkeypatch):
+    checksum_dir = tmp_path / "checksums"
+    checksum_dir.mkdir()
+    dataset_dir = tmp_path / "datasets"
+    (dataset_dir / "cache").mkdir(parents=True)
+    (dataset_dir / "cache" / "mnist.tar.gz").write_bytes(CONTENT)
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    (checksum_dir / "mnist.txt").write_text(
+        f"local mnist.tar.gz {len(CONTENT)} {digest}\n"
+    )
+    monkeypatch.setattr(utils, "CHECKSUMS_DIRS", [str(checksum_dir)])
+
+    assert utils.dataset_extracted(str(dataset_dir), "mnist") is None
+    utils.download_verify_dataset_cache(str(dataset_dir), "mnist.txt", "mnist")
+    assert utils.dataset_extracted(str(dataset_dir), "mnist") is True
+    for path, content in MEMBERS.items():
+        assert (dataset_dir / path).read_bytes() == content
+    assert sorted(os.listdir(dataset_dir)) == ["cache", "mnist"]
+
+    # The marker records the verified hash, so the archive is not hashed again
+    def fail(*args, **kwargs):
+        raise AssertionError("archive hashed again")
+
+    monkeypatch.setattr(utils, "verify_sha256", fail)
+    utils.download_verify_dataset_cache(str(dataset_dir), "mnist.txt", "mnist")
+    assert utils.dataset_extracted(str(dataset_dir), "mnist") is True
+
+    # A corrupted download does not overwrite the extracted dataset
+    corrupted = make_archive({path: b"corrupted" for path in MEMBERS})
+
+    def download_corrupted(url, dirpath, filepath, callback=None, **kwargs):
+        with open(filepath, "wb") as f:
+            f.write(corrupted)
+        for i in range(0, len(corrupted), 100):
+            callback(corrupted[i : i + 100])
+        return hashlib.sha256(corrupted).hexdigest()
+
+    monkeypatch.setattr(utils, "download_requests", download_corrupted)
+    (dataset_dir / "cache" / "mnist.tar.gz").unlink()
+    (checksum_dir / "mnist.txt").write_text(
+        f"bucket mnist.tar.gz {len(corrupted)} {digest}\n"
+    )
+    utils.download_verify_dataset_cache(str(dataset_dir), "mnist.txt", "mnist")
+    assert utils.dataset_extracted(str(dataset_dir), "mnist") is False
+    for path, content in MEMBERS.items():
+        assert (dataset_dir / path).read_bytes() == content
+    assert sorted(os.listdir(dataset_dir)) == ["cache", "mnist"]
+    assert not (dataset_dir / "cache" / "mnist.tar.gz").exists()
+
+    # The in-progress marker is not written when a local archive is missing
+    (checksum_dir / "mnist.txt").write_text(
+        f"local mnist.tar.gz {len(CONTENT)} {digest}\n"
+    )
+    os.remove(utils._extraction_marker(str(dataset_dir), "mnist", complete=False))
+    with pytest.raises(FileNotFoundError):
+        utils.download_verify_dataset_cache(str(dataset_dir), "mnist.txt", "mnist")
+    assert utils.dataset_extracted(str(dataset_dir), "mnist") is None
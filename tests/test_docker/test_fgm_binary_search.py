@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from art.estimators.classification.scikitlearn import ScikitlearnLogisticRegression
+from sklearn.linear_model import LogisticRegression
+
+from armory.art_experimental.attacks import FGMBinarySearch
+
+
+class CountingClassifier(ScikitlearnLogisticRegression):
+    """
+    Classifier that counts calls to predict
+    """
+
+    predict_calls = 0
+
+    def predict(self, x, **kwargs):
+        self.predict_calls += 1
+        return super().predict(x, **kwargs)
+
+
+def loop_binary_search(attack, batch, batch_labels):
+    """
+    Previous per-sample implementation of _minimal_perturbation_binary_batch
+    """
+    adv_batch = batch.copy()
+    batch_classes = np.argmax(batch_labels, axis=1)
+    perturbation = attack._compute_perturbation(batch, batch_labels, None)
+    for i in range(len(batch)):
+        min_eps = 0
+        max_eps = attack.eps
+        while max_eps - min_eps > attack.eps_step:
+            mid_eps = (max_eps + min_eps) / 2
+            adv_i = attack._apply_perturbation(batch[[i]], perturbation[[i]], mid_eps)
+            adv_class = np.argmax(attack.estimator.predict(adv_i), axis=1)
+            if attack.targeted:
+                success = batch_classes[[i]] == adv_class
+            else:
+                success = batch_classes[[i]] != adv_class
+            if success:
+                adv_batch[[i]] = adv_i
+                max_eps = mid_eps
+            else:
+                min_eps = mid_eps
+    return adv_batch
+
+
+@pytest.mark.parametrize("targeted", [False, True])
+def test_binary_search(targeted):
+    rng = np.random.default_rng(0)
+    x_train = rng.normal(size=(300, 10)).astype(np.float32)
+    y_train = np.argmax(x_train[:, :3], axis=1)
+    classifier = CountingClassifier(LogisticRegression().fit(x_train, y_train))
+
+    x = rng.normal(size=(40, 10)).astype(np.float32)
+    y = np.eye(3)[(np.argmax(x[:, :3], axis=1) + int(targeted)) % 3]
+    attack = FGMBinarySearch(
+        classifier, eps=4.0, eps_step=0.01, batch_size=16, targeted=targeted
+    )
+    expected = loop_binary_search(attack, x, y)
+
+    classifier.predict_calls = 0
+    x_adv = attack._minimal_perturbation_binary_batch(x, y)
+    assert np.array_equal(x_adv, expected)
+    assert 0 < classifier.predict_calls <= np.ceil(np.log2(4.0 / 0.01))
+    if not targeted:
+        assert not np.array_equal(x_adv, x)
@@ -0,0 +1,144 @@
+"""
+Test pipelined evaluation of ImageClassificationTask against two-pass evaluation
+"""
+
+import numpy as np
+import pytest
+
+from armory.scenarios import image_classification
+from armory.utils.labels import RandomLabelTargeter
+
+NUM_CLASSES = 3
+
+
+class LinearEstimator:
+    def __init__(self):
+        self.weights = np.random.default_rng(0).normal(size=(4, NUM_CLASSES))
+
+    def set_learning_phase(self, train):
+        pass
+
+    def predict(self, x):
+        return x @ self.weights
+
+
+class NoiseAttack:
+    """
+    Targeted attack that moves x towards y with random noise, so that its result
+        depends on the order of calls to np.random
+    """
+
+    targeted = True
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+
+    def generate(self, x, y):
+        x_adv = x + 0.5 * self.estimator.weights[:, y].T
+        return x_adv + np.random.uniform(-0.1, 0.1, size=x.shape)
+
+
+class Dataset:
+    context = None
+
+    def __init__(self, num_batches=6):
+        rng = np.random.default_rng(1)
+        self.batches = [
+            (rng.normal(size=(3, 4)), rng.integers(NUM_CLASSES, size=3))
+            for _ in range(num_batches)
+        ]
+
+    def __iter__(self):
+        return ((x.copy(), y.copy()) for x, y in self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class RecordingExporter:
+    """
+    Records the samples passed to export, failing on the fail_at-th call
+    """
+
+    fail_at = None
+
+    def __init__(self, base_output_dir, context, num_samples):
+        self.num_samples = num_samples
+        self.samples = []
+
+    def export(self, x, x_adv, y, y_adv):
+        if len(self.samples) == self.fail_at:
+            raise RuntimeError("export failed")
+        if len(self.samples) < self.num_samples:
+            self.samples.append((x.copy(), x_adv.copy(), y.copy(), y_adv.copy()))
+
+
+@pytest.fixture
+def scenario(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        image_classification, "load_model", lambda config: (LinearEstimator(), None)
+    )
+    monkeypatch.setattr(
+        image_classification,
+        "load_attack",
+        lambda config, estimator: NoiseAttack(estimator),
+    )
+    monkeypatch.setattr(
+        image_classification, "load_dataset", lambda config, **kwargs: Dataset()
+    )
+    monkeypatch.setattr(
+        image_classification,
+        "load_label_targeter",
+        lambda config: RandomLabelTargeter(NUM_CLASSES),
+    )
+    monkeypatch.setattr(image_classification, "SampleExporter", RecordingExporter)
+    scenario = image_classification.ImageClassificationTask()
+    scenario.scenario_output_dir = str(tmp_path)
+    return scenario
+
+
+def evaluate(scenario, pipelined):
+    config = {
+        "attack": {"kwargs": {"targeted": True}, "targeted_labels": {}},
+        "dataset": {"name": "stub"},
+        "metric": {
+            "means": True,
+            "perturbation": ["linf", "l2"],
+            "record_metric_per_sample": True,
+            "task": ["categorical_accuracy"],
+        },
+        "model": {"fit": False},
+        "scenario": {"export_samples": 4, "pipelined": pipelined},
+    }
+    exporters = []
+
+    def load_sample_exporter(config, test_data):
+        exporters.append(
+            RecordingExporter(None, None, config["scenario"]["export_samples"])
+        )
+        return exporters[-1]
+
+    scenario._load_sample_exporter = load_sample_exporter
+    np.random.seed(2)
+    results = scenario._evaluate(config, None, False, False)
+    (exporter,) = exporters
+    return results, exporter.samples
+
+
+def test_pipelined_equals_two_pass(scenario):
+    results, samples = evaluate(scenario, pipelined=False)
+    pipelined_results, pipelined_samples = evaluate(scenario, pipelined=True)
+
+    assert results["targeted_mean_categorical_accuracy"] > 0
+    assert pipelined_results == results
+    assert len(pipelined_samples) == len(samples) == 4
+    for sample, pipelined_sample in zip(samples, pipelined_samples):
+        for array, pipelined_array in zip(sample, pipelined_sample):
+            assert np.array_equal(array, pipelined_array)
+
+
+def test_pipelined_worker_error(scenario, monkeypatch):
+    # Errors in metric updates and export on the background thread are raised
+    monkeypatch.setattr(RecordingExporter, "fail_at", 2)
+    with pytest.raises(RuntimeError, match="export failed"):
+        evaluate(scenario, pipelined=True)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from armory.data import image_ops
+
+
+def pil_equalize_crop_resize(batch, size):
+    """
+    Per-image PIL implementation previously used by the GTSRB poisoning scenarios
+    """
+    img_out = []
+    for im in batch:
+        img_eq = ImageOps.equalize(Image.fromarray(im))
+        width, height = img_eq.size
+        min_side = min(img_eq.size)
+        center = width // 2, height // 2
+
+        left = center[0] - min_side // 2
+        top = center[1] - min_side // 2
+        right = center[0] + min_side // 2
+        bottom = center[1] + min_side // 2
+
+        img_eq = img_eq.crop((left, top, right, bottom))
+        img_out.append(np.array(img_eq.resize([size, size])))
+    return np.array(img_out)
+
+
+def random_batch(rng, num_images):
+    batch = []
+    for _ in range(num_images):
+        height, width = rng.integers(20, 100, size=2)
+        gamma = rng.uniform(0.3, 3.0)
+        im = rng.random((height, width, 3)) ** gamma * rng.uniform(50, 255)
+        batch.append(im.astype(np.uint8))
+    # Constant images and images with two values leave the histogram unchanged
+    batch.append(np.full((30, 31, 3), 7, dtype=np.uint8))
+    two_values = np.zeros((48, 48, 3), dtype=np.uint8)
+    two_values[0, 0] = 200
+    batch.append(two_values)
+    return batch
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_equalize_crop_resize(num_workers, monkeypatch):
+    monkeypatch.setattr(image_ops, "MIN_IMAGES_PER_WORKER", 16)
+    rng = np.random.default_rng(0)
+    batch = random_batch(rng, 300)
+    expected = pil_equalize_crop_resize(batch, 48)
+    out = image_ops.equalize_crop_resize(batch, (48, 48), num_workers=num_workers)
+    assert out.shape == expected.shape
+    assert out.dtype == np.uint8
+    # Allow for rounding differences between Pillow versions
+    assert np.abs(out.astype(int) - expected).max() <= 1
+
+
+def test_equalize_luts():
+    rng = np.random.default_rng(1)
+    batch = random_batch(rng, 10)
+    luts = image_ops.equalize_luts(batch)
+    for im, lut in zip(batch, luts):
+        expected = np.array(ImageOps.equalize(Image.fromarray(im)))
+        assert np.array_equal(lut[np.arange(3), im], expected)
+
+
+def test_equalize_crop_resize_empty():
+    assert image_ops.equalize_crop_resize([]).shape == (0, 48, 48, 3)
@@ -0,0 +1,119 @@
+import pstats
+import threading
+
+import numpy as np
+import pytest
+
+from armory.utils import instrumentation
+
+
+def test_histogram():
+    rng = np.random.default_rng(0)
+    durations = rng.lognormal(mean=-4, sigma=2, size=10000)
+    histogram = instrumentation.Histogram()
+    for seconds in durations:
+        histogram.record(seconds)
+    assert len(histogram.counts) == instrumentation.Histogram.NUM_BINS
+    assert histogram.count == len(durations)
+    assert histogram.total == pytest.approx(durations.sum())
+    assert histogram.max == durations.max()
+    for q in 0.5, 0.95, 0.99:
+        assert histogram.quantile(q) == pytest.approx(
+            np.quantile(durations, q), rel=0.05
+        )
+
+    histogram = instrumentation.Histogram()
+    for seconds in 0, 1e-9, 1e9:
+        histogram.record(seconds)
+    assert histogram.quantile(0) <= instrumentation.Histogram.MIN_SECONDS
+    assert histogram.quantile(1) == 1e9
+    with pytest.raises(ValueError):
+        instrumentation.Histogram().quantile(0.5)
+
+
+def export():
+    with instrumentation.span("export"):
+        pass
+
+
+def test_spans():
+    timer = instrumentation.Instrumentation("Basic")
+    with instrumentation.activate(timer):
+        for _ in range(3):
+            with instrumentation.span("attack"):
+                with instrumentation.span("generate"):
+                    pass
+                with instrumentation.span("predict"):
+                    pass
+                # Spans on other threads are not nested in those of this one
+                thread = threading.Thread(target=export)
+                thread.start()
+                thread.join()
+        with pytest.raises(ValueError):
+            with instrumentation.span("metrics"):
+                raise ValueError
+    assert instrumentation.active() is None
+    with instrumentation.span("disabled"):
+        pass
+
+    results = timer.results()
+    assert list(results) == [
+        "attack",
+        "attack/generate",
+        "attack/predict",
+        "export",
+        "metrics",
+    ]
+    assert results["attack"]["count"] == 3
+    assert results["attack"]["total"] >= (
+        results["attack/generate"]["total"] + results["attack/predict"]["total"]
+    )
+
+    disabled = instrumentation.Instrumentation()
+    with disabled.span("predict"):
+        pass
+    assert disabled.results() == {}
+    with pytest.raises(ValueError):
+        instrumentation.Instrumentation("Detailed")
+
+
+def test_state_and_merge():
+    timer = instrumentation.Instrumentation("Basic")
+    for seconds in 0.1, 0.2, 0.4:
+        timer.record("predict", seconds)
+    loaded = instrumentation.Instrumentation()
+    loaded.load_state(timer.state())
+    assert loaded.results() == timer.results()
+
+    loaded.merge(timer)
+    loaded.record("generate", 2.0)
+    results = loaded.results()
+    assert results["predict"]["count"] == 6
+    assert results["predict"]["total"] == pytest.approx(1.4)
+    assert results["generate"]["max"] == 2.0
+
+
+def test_profile(tmp_path):
+    timer = instrumentation.Instrumentation("Deterministic")
+    for _ in range(2):
+        with timer.profile():
+            sorted(range(1000), key=lambda i: -i)
+    timer.save_profile(str(tmp_path / "0.pstats"))
+    timer.save_profile(str(tmp_path / "1.pstats"))
+    instrumentation.merge_profiles(
+        [str(tmp_path / "0.pstats"), str(tmp_path / "1.pstats")],
+        str(tmp_path / "merged.pstats"),
+    )
+    stats = pstats.Stats(str(tmp_path / "merged.pstats"))
+    calls = [
+        value[1]
+        for (_, _, function), value in stats.stats.items()
+        if function == "<lambda>"
+    ]
+    assert calls == [4000]
+
+    basic = instrumentation.Instrumentation("Basic")
+    with basic.profile():
+        pass
+    basic.save_profile(str(tmp_path / "basic.pstats"))
+    assert not (tmp_path / "basic.pstats").exists()
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from armory.art_experimental.attacks.kenansville_dft import KenansvilleDFT
+
+
+def loop_attack(x, snr_db):
+    """
+    Previous full DFT implementation of KenansvilleDFT._attack
+    """
+    x_len = len(x)
+    x_fft = np.fft.fft(x)
+    x_psd = np.abs(x_fft) ** 2
+    x_psd_ind = np.argsort(x_psd)
+    dc_ind = np.where(x_psd_ind == 0)[0][0]
+    signal_db = 10 * np.log10(np.sum(x_psd))
+
+    id = 2
+    noise_db = 10 * np.log10(np.sum(x_psd[x_psd_ind[:id]]))
+    while signal_db - noise_db > snr_db:
+        id *= 2
+        noise_db = 10 * np.log10(np.sum(x_psd[x_psd_ind[: min(id, x_len)]]))
+    if id == 2:
+        return x
+
+    id = int(id / 2)
+    noise_db = 10 * np.log10(np.sum(x_psd[x_psd_ind[:id]]))
+    while signal_db - noise_db > snr_db:
+        id += 2
+        noise_db = 10 * np.log10(np.sum(x_psd[x_psd_ind[: min(id, x_len)]]))
+    id -= 2
+
+    if (dc_ind in x_psd_ind[:id]) ^ (x_len % 2 == 0 and x_len / 2 in x_psd_ind[:id]):
+        id -= 1
+    x_fft[x_psd_ind[:id]] = 0
+    return np.real(np.fft.ifft(x_fft)).astype(np.float32)
+
+
+def random_signal(rng, length):
+    t = np.arange(length) / 16000
+    signal = sum(
+        np.sin(2 * np.pi * rng.uniform(100, 4000) * t + rng.uniform(0, 2 * np.pi))
+        for _ in range(5)
+    )
+    return (signal + rng.normal(scale=0.1, size=length)).astype(np.float32)
+
+
+@pytest.mark.parametrize("snr_db", [5, 20, 40, 100])
+def test_attack(snr_db):
+    rng = np.random.default_rng(0)
+    attack = KenansvilleDFT(None, snr_db=snr_db)
+    for length in [1, 2, 3, 64, 151, 500, 1000, 1601]:
+        x = random_signal(rng, length)
+        x_adv = attack._attack(x)
+        assert np.allclose(x_adv, loop_attack(x, snr_db), rtol=1e-4, atol=1e-6)
+        if np.array_equal(x_adv, x):
+            continue
+        snr = np.sum(x.astype(float) ** 2) / np.sum((x_adv - x.astype(float)) ** 2)
+        assert 10 * np.log10(snr) >= snr_db - 1e-3
+
+
+@pytest.mark.parametrize("snr_db", [1.5, 3.3, 9.1])
+def test_attack_tied_powers(snr_db):
+    # Integer-valued signals have frequencies of exactly equal power, which are
+    # discarded in the order of the full DFT
+    rng = np.random.default_rng(0)
+    attack = KenansvilleDFT(None, snr_db=snr_db)
+    for _ in range(500):
+        x = rng.integers(-3, 4, size=rng.integers(1, 40)).astype(np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = loop_attack(x, snr_db)
+        assert np.allclose(attack._attack(x), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_partial_attack():
+    rng = np.random.default_rng(1)
+    x = np.empty(3, dtype=object)
+    # seed 0 attacks some, but not all, full and shorter last segments
+    for i, length in enumerate([5200, 500, 1234]):
+        x[i] = random_signal(rng, length)
+    attack = KenansvilleDFT(None, snr_db=20, partial_attack=True, attack_len=500)
+
+    np.random.seed(0)
+    x_adv = attack.generate(x)
+    np.random.seed(0)
+    for x_i, x_adv_i in zip(x, x_adv):
+        attacked = np.random.rand(int(np.ceil(len(x_i) / 500))) < 0.5
+        for j, attacked_j in enumerate(attacked):
+            segment = x_i[500 * j : 500 * (j + 1)]
+            expected = loop_attack(segment, 20) if attacked_j else segment
+            assert np.allclose(
+                x_adv_i[500 * j : 500 * (j + 1)], expected, rtol=1e-4, atol=1e-6
+            )
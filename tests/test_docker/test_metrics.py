@@ -7,6 +7,7 @@ import json
 import pytest
 import numpy as np
 
+from armory.utils import instrumentation
 from armory.utils import metrics
 
 
@@ -143,6 +144,114 @@ def test_metrics_logger():
     assert results["perturbation_l1"] == [2]
 
 
+def test_metrics_logger_merge():
+    metrics_config = {
+        "record_metric_per_sample": True,
+        "means": True,
+        "perturbation": "l1",
+        "task": ["categorical_accuracy", "object_detection_AP_per_class"],
+    }
+    rng = np.random.default_rng(0)
+    batches = []
+    for _ in range(6):
+        labels = {
+            "labels": rng.integers(1, 4, size=3),
+            "boxes": 0.5 * rng.uniform(size=(3, 4)) + [0, 0, 0.5, 0.5],
+        }
+        preds = {
+            "labels": rng.integers(1, 4, size=4),
+            "boxes": 0.5 * rng.uniform(size=(4, 4)) + [0, 0, 0.5, 0.5],
+            "scores": rng.uniform(size=4),
+        }
+        x = rng.normal(size=(2, 5))
+        batches.append((labels, preds, x, x + rng.normal(size=(2, 5))))
+
+    def log(batches):
+        metrics_logger = metrics.MetricsLogger.from_config(dict(metrics_config))
+        for labels, preds, x, x_adv in batches:
+            for task in metrics_logger.tasks + metrics_logger.adversarial_tasks:
+                if task.name == "categorical_accuracy":
+                    task.append(labels["labels"][:1], preds["labels"][:1])
+                else:
+                    task.append_inputs([labels], [preds])
+            metrics_logger.update_perturbation(x, x_adv)
+        return metrics_logger
+
+    expected = log(batches).results()
+    merged = metrics.MetricsLogger.from_state(log(batches[:1]).state())
+    for shard in batches[1:4], [], batches[4:]:
+        merged.merge(metrics.MetricsLogger.from_state(log(shard).state()))
+    assert merged.results() == expected
+
+    with pytest.raises(ValueError):
+        merged.merge(metrics.MetricsLogger.from_config({"task": ["l2"]}))
+
+
+def test_metrics_logger_state():
+    metrics_config = {
+        "record_metric_per_sample": True,
+        "means": False,
+        "perturbation": "linf",
+        "task": ["word_error_rate", "object_detection_class_precision"],
+    }
+    with instrumentation.activate(instrumentation.Instrumentation("Basic")):
+        metrics_logger = metrics.MetricsLogger.from_config(metrics_config)
+    for task in metrics_logger.tasks + metrics_logger.adversarial_tasks:
+        if task.name == "word_error_rate":
+            task.append(["the cat sat", "a b"], ["the cat", "a b"])
+        else:
+            task._values.extend([0, 0.5])
+    metrics_logger.update_perturbation(np.zeros((2, 3)), np.ones((2, 3)))
+    metrics_logger.instrumentation.record("benign/predict", 0.2)
+    metrics_logger.instrumentation.record("benign/predict", 0.3)
+
+    state = metrics_logger.state()
+    assert isinstance(state, bytes)
+    loaded = metrics.MetricsLogger.from_state(state)
+    results = loaded.results()
+    assert results == metrics_logger.results()
+    # Values keep their types, so JSON results are unchanged
+    assert json.dumps(results, sort_keys=True) == json.dumps(
+        metrics_logger.results(), sort_keys=True
+    )
+    assert results["benign_word_error_rate"] == [(1.0, 3), (0.0, 2)]
+    assert results["benign_total_word_error_rate"] == 0.2
+
+    # Merging is associative
+    a, b, c = (metrics.MetricsLogger.from_state(state) for _ in range(3))
+    b.merge(c)
+    a.merge(b)
+    d, e, f = (metrics.MetricsLogger.from_state(state) for _ in range(3))
+    d.merge(e)
+    d.merge(f)
+    assert a.results() == d.results()
+    assert a.results()["benign_total_word_error_rate"] == 0.2
+    timing = a.results()["timing"]["benign/predict"]
+    assert timing["count"] == 6
+    assert timing["mean"] == pytest.approx(0.25)
+    assert (timing["p50"], timing["max"]) == (pytest.approx(0.2, rel=0.05), 0.3)
+
+    # Loggers created while no Instrumentation is active do not share one
+    loaded = metrics.MetricsLogger.from_config(metrics_config)
+    other = metrics.MetricsLogger.from_config(metrics_config)
+    assert loaded.instrumentation is not other.instrumentation
+    loaded.load_state(state)
+    assert "timing" in loaded.results()
+    assert other.instrumentation.histograms == {}
+
+    metrics_logger.tasks[0]._values.append("not a number")
+    with pytest.raises(ValueError):
+        metrics_logger.state()
+    metrics_logger.tasks[0]._values[-1] = np.array([1, 2])
+    with pytest.raises(ValueError, match="must be numbers"):
+        metrics_logger.state()
+
+    ragged = metrics.MetricList("word_error_rate")
+    ragged._values.extend([(1, 4), (2, 5, 0)])
+    with pytest.raises(ValueError, match="same length"):
+        ragged.state()
+
+
 def test_mAP():
     labels = {"labels": np.array([2]), "boxes": np.array([[0.1, 0.1, 0.7, 0.7]])}
 
@@ -155,3 +264,137 @@ def test_mAP():
     ap_per_class = metrics.object_detection_AP_per_class([[labels]], [[preds]])
     assert ap_per_class[9] == 0
     assert ap_per_class[2] >= 0.99
+
+
+def test_mAP_greedy_matching():
+    box_a = [0.0, 0.0, 0.5, 0.5]
+    box_b = [0.5, 0.5, 1.0, 1.0]
+    labels = [
+        {"labels": np.array([1, 1]), "boxes": np.array([box_a, box_b])},
+        {"labels": np.array([-10]), "boxes": np.array([box_a])},
+    ]
+    preds = [
+        {
+            # duplicate detection of box_a is a false positive
+            "labels": np.array([1, 1, 1]),
+            "boxes": np.array([box_a, [0.0, 0.0, 0.5, 0.45], box_b]),
+            "scores": np.array([0.9, 0.8, 0.7]),
+        },
+        {
+            "labels": np.array([2, -10]),
+            "boxes": np.array([box_a, box_a]),
+            "scores": np.array([0.9, 0.9]),
+        },
+    ]
+
+    ap_per_class = metrics.object_detection_AP_per_class([labels], [preds])
+    assert ap_per_class == {1: 0.85, 2: 0.0}
+
+
+def test_intersection_over_union_pairs():
+    boxes_1 = np.array([[0, 0, 2, 2], [0, 0, 1, 1], [0, 0, 1, 1]], dtype=np.float32)
+    boxes_2 = np.array([[1, 1, 3, 3], [0, 0, 1, 1], [1, 1, 2, 2]], dtype=np.float32)
+    ious = metrics._intersection_over_union_pairs(boxes_1, boxes_2)
+    for box_1, box_2, iou in zip(boxes_1, boxes_2, ious):
+        assert iou == metrics._intersection_over_union(box_1, box_2)
+    assert ious.tolist() == pytest.approx([1 / 7, 1.0, 0.0])
+
+
+def test_AP_accumulator():
+    labels = {"labels": np.array([2]), "boxes": np.array([[0.1, 0.1, 0.7, 0.7]])}
+    hit = {
+        "labels": np.array([2]),
+        "boxes": np.array([[0.1, 0.1, 0.7, 0.7]]),
+        "scores": np.array([0.8]),
+    }
+    miss = {
+        "labels": np.array([2]),
+        "boxes": np.array([[0.7, 0.7, 0.9, 0.9]]),
+        "scores": np.array([0.9]),
+    }
+
+    metric_list = metrics.MetricList("object_detection_AP_per_class")
+    metric_list.append_inputs([labels], [hit])
+    assert metric_list.AP_per_class() == {2: 1.0}
+    # AP is updated as each batch arrives
+    metric_list.append_inputs([labels], [miss])
+    ap_per_class = metric_list.AP_per_class()
+    assert ap_per_class == metrics.object_detection_AP_per_class(
+        [[labels], [labels]], [[hit], [miss]]
+    )
+    assert ap_per_class[2] == 0.27
+    # Empty batches are ignored
+    metric_list.append_inputs([], [])
+    assert metric_list.AP_per_class() == ap_per_class
+    metric_list.clear()
+    assert metric_list.AP_per_class() == {}
+    apricot = metrics.MetricList("apricot_patch_targeted_AP_per_class")
+    apricot.append_inputs([], [])
+    assert apricot.apricot_patch_targeted_AP_per_class() == {}
+
+    with pytest.raises(ValueError):
+        metric_list.apricot_patch_targeted_AP_per_class()
+    with pytest.raises(ValueError):
+        metrics.MetricList("categorical_accuracy").append_inputs([labels], [hit])
+
+
+def test_word_error_rate():
+    y = ["the cat sat on the mat", b"hello world", "", "a b c"]
+    y_pred = ["the cat sat on mat", "hello there big world", "extra words", "a b c"]
+    assert metrics.word_error_rate(y, y_pred) == [
+        (1.0, 6),
+        (2.0, 2),
+        (2.0, 0),
+        (0.0, 3),
+    ]
+    assert metrics._word_error_rate("kitten sitting", "sitting kitten on") == (2.0, 2)
+    with pytest.raises(TypeError):
+        metrics.word_error_rate([1], ["a"])
+    with pytest.raises(ValueError):
+        metrics.word_error_rate(y, y_pred[:1])
+
+    metric_list = metrics.MetricList("word_error_rate")
+    metric_list.append(y, y_pred)
+    assert metric_list.total_wer() == 5 / 11
+
+
+def test_variable_length_perturbation_metrics():
+    x = np.empty(3, dtype=object)
+    x_adv = np.empty(3, dtype=object)
+    for i, length in enumerate([4, 7, 1]):
+        x[i] = np.arange(length, dtype=np.float32) / 4 - 1
+        x_adv[i] = x[i] + np.float32(0.5)
+    x_adv[2] = x[2].copy()
+
+    for ord in [0, 1, 2, 3, np.inf]:
+        expected = [
+            metrics.norm([x_i], [x_adv_i], ord)[0] for x_i, x_adv_i in zip(x, x_adv)
+        ]
+        assert metrics.norm(x, x_adv, ord) == pytest.approx(expected)
+    assert metrics.l0(x, x_adv) == [1.0, 1.0, 0.0]
+    assert metrics.linf(x, x_adv) == [0.5, 0.5, 0.0]
+    assert metrics.snr(x, x_adv)[2] == np.inf
+
+    # integer inputs are promoted before subtraction to prevent overflow
+    x = np.array([[32767, -32768]], dtype=np.int16)
+    x_adv = np.array([[-32768, 32767]], dtype=np.int16)
+    assert metrics.l1(x, x_adv) == [131070.0]
+
+
+def test_image_circle_patch_diameter():
+    x = np.zeros((3, 20, 10, 3))
+    x_adv = x.copy()
+    x_adv[0, 5:10, 2:7] = 1
+    # two perturbed regions, where the lower one determines the patch
+    x_adv[2, 1:3, :2, 0] = 1
+    x_adv[2, 12:16, 4:8] = 1
+    assert metrics.image_circle_patch_diameter(x, x_adv) == [0.5, 0, 0.4]
+    assert metrics._image_circle_patch_diameter(x[0], x_adv[0]) == 0.5
+    with pytest.raises(ValueError):
+        metrics.image_circle_patch_diameter(x, x_adv[:, :10])
+
+    # video frames are computed together
+    video, video_adv = x[np.newaxis], x_adv[np.newaxis]
+    assert metrics.SUPPORTED_METRICS["max_image_circle_patch_diameter"](
+        video, video_adv
+    ) == [0.5]
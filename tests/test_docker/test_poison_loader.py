@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from armory.art_experimental.attacks import poison_loader
+
+
+@pytest.mark.parametrize("poison_type", ["pattern", "pixel"])
+def test_poison_images(poison_type):
+    attack = poison_loader.poison_loader_GTSRB(poison_type=poison_type)
+    assert attack.slicewise
+    images = np.random.default_rng(0).random((5, 12, 10, 3), dtype=np.float32)
+
+    for axes in [None, (2, 0, 1)]:
+        expected = []
+        for image in images:
+            if axes is not None:
+                image = np.transpose(image, axes)
+            poisoned, _ = attack.poison(image, [1])
+            if axes is not None:
+                poisoned = np.transpose(poisoned, np.argsort(axes))
+            expected.append(poisoned)
+        expected = np.array(expected)
+
+        poisoned = poison_loader.poison_images(attack, images, 1, axes=axes)
+        assert poisoned.dtype == images.dtype
+        assert np.array_equal(poisoned, expected)
+
+        # Images are poisoned one at a time when slices are not independent
+        attack.slicewise = False
+        poisoned = poison_loader.poison_images(attack, images, 1, axes=axes)
+        assert np.array_equal(poisoned, expected)
+        attack.slicewise = True
+
+    assert poison_loader.poison_images(attack, images[:0], 1).shape == (0, 12, 10, 3)
@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from armory.scenarios import poisoning_sweep
+
+
+def test_sweep_trials():
+    config = {
+        "adhoc": {
+            "split_id": 0,
+            "fraction_poisoned": 0.1,
+            "sweep": {"split_ids": [0, 1, 2]},
+        }
+    }
+    assert poisoning_sweep.sweep_trials(config) == [
+        (0.1, 0),
+        (0.1, 1),
+        (0.1, 2),
+    ]
+    config["adhoc"]["sweep"]["fraction_poisoned"] = [0.01, 0.05]
+    assert len(poisoning_sweep.sweep_trials(config)) == 6
+
+
+def test_clbd_trial_configs():
+    filepath = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "..",
+        "scenario_configs",
+        "gtsrb_scenario_clbd.json",
+    )
+    with open(filepath) as f:
+        config = json.load(f)
+    fraction_path = ("attack", "kwargs", "pp_poison")
+    config["adhoc"]["sweep"] = {"split_ids": [0, 1, 2]}
+    with pytest.raises(ValueError):
+        poisoning_sweep.sweep_trials(config)
+    trials = poisoning_sweep.trial_configs(config, fraction_path)
+    assert [(fraction, split_id) for fraction, split_id, _ in trials] == [
+        (0.1, 0),
+        (0.1, 1),
+        (0.1, 2),
+    ]
+
+    # Swept fractions set the pp_poison of the attack
+    config["adhoc"]["sweep"]["fraction_poisoned"] = [0.05, 0.2]
+    trials = poisoning_sweep.trial_configs(config, fraction_path)
+    assert len(trials) == 6
+    for fraction, split_id, trial_config in trials:
+        assert trial_config["attack"]["kwargs"]["pp_poison"] == fraction
+        assert trial_config["adhoc"]["split_id"] == split_id
+        assert "sweep" not in trial_config["adhoc"]
+        assert "fraction_poisoned" not in trial_config["adhoc"]
+    assert config["attack"]["kwargs"]["pp_poison"] == 0.1
+
+
+def test_aggregate():
+    trials = [
+        {"split_id": 0, "fraction_poisoned": 0.1, "results": {"acc": 0.5, "x": None}},
+        {"split_id": 1, "fraction_poisoned": 0.1, "results": {"acc": 0.7, "x": None}},
+        {"split_id": 0, "fraction_poisoned": 0.05, "results": {"acc": 0.9}},
+    ]
+    results = poisoning_sweep.aggregate(trials)
+    assert results["trials"] == trials
+    assert list(results["acc_mean"]) == ["0.05", "0.1"]
+    assert results["acc_mean"]["0.1"] == pytest.approx(0.6)
+    assert results["acc_std"]["0.1"] == pytest.approx(0.1)
+    assert results["acc_std"]["0.05"] == 0.0
+    assert "x_mean" not in results
+
+
+def test_shared_split(tmp_path):
+    rng = np.random.default_rng(0)
+    x = rng.random((50, 4, 4, 3), dtype=np.float32)
+    y = rng.integers(0, 10, size=50)
+    batches = poisoning_sweep.SharedDataset(x, y, batch_size=16)
+    assert [len(x_batch) for x_batch, _ in batches] == [16, 16, 16, 2]
+
+    spec = poisoning_sweep._save_split(batches, str(tmp_path), "train")
+    shared = poisoning_sweep._open_split(spec, batch_size=20)
+    assert shared.samples_per_epoch == 50
+    assert np.array_equal(np.concatenate([x_batch for x_batch, _ in shared]), x)
+    assert np.array_equal(np.concatenate([y_batch for _, y_batch in shared]), y)
+
+    # Writes are private to each process that maps the split
+    shared.x[:] = 0
+    assert np.array_equal(poisoning_sweep._open_split(spec, 20).x, x)
@@ -0,0 +1,191 @@
+import numpy as np
+import pytest
+
+from art.estimators.classification import ClassifierMixin, SklearnClassifier
+from art.estimators.estimator import BaseEstimator, LossGradientsMixin
+from sklearn.linear_model import LogisticRegression
+
+from armory.art_experimental.attacks import snr_pgd
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(200, 20)).astype(np.float32)
+    y = (x[:, :10].sum(axis=1) > 0).astype(int)
+    return SklearnClassifier(LogisticRegression().fit(x, y))
+
+
+def attack_kwargs(**kwargs):
+    return {"norm": "snr_db", "eps": 10, "eps_step": 0.1, "max_iter": 5, **kwargs}
+
+
+def test_batch_equals_single(classifier):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(10, 20)).astype(np.float32)
+    x[3] *= 100
+    y = classifier.predict(x).argmax(axis=1)
+
+    single = snr_pgd.SNR_PGD_Numpy(classifier, **attack_kwargs())
+    expected = np.concatenate(
+        [single.generate(x[i : i + 1], y[i : i + 1]) for i in range(len(x))]
+    )
+    batched = snr_pgd.SNR_PGD_Numpy(classifier, batch_size=4, **attack_kwargs())
+    x_adv = batched.generate(x, y)
+    assert np.allclose(x_adv, expected, rtol=1e-5, atol=1e-6)
+    assert (classifier.predict(x_adv).argmax(axis=1) != y).any()
+
+    # Each sample is bounded by its own SNR
+    snr = np.sum(x ** 2, axis=1) / np.sum((x_adv - x) ** 2, axis=1)
+    assert (10 * np.log10(snr) >= 10 - 1e-3).all()
+
+
+class MeanClassifier(ClassifierMixin, LossGradientsMixin, BaseEstimator):
+    """
+    Classifies each signal by its mean, so that its output depends on its length,
+        or by its sum, so that it does not change with zero padding
+    """
+
+    def __init__(self, weight=10.0, reduce="mean"):
+        super().__init__(model=None, clip_values=None)
+        self.weight = weight
+        self.reduce = reduce
+        self._nb_classes = 2
+
+    def _scale(self, x):
+        return self.weight / (x.shape[1] if self.reduce == "mean" else 1)
+
+    @property
+    def input_shape(self):
+        return (None,)
+
+    def _probabilities(self, x):
+        logits = self._scale(x) * np.sum(x, axis=1)
+        return 1 / (1 + np.exp(np.stack([-2 * logits, 2 * logits], axis=1)))
+
+    def predict(self, x, batch_size=128, **kwargs):
+        return self._probabilities(x).astype(np.float32)
+
+    def loss_gradient(self, x, y, **kwargs):
+        # Cross-entropy of softmax of logits (mean, -mean)
+        error = self._probabilities(x) - y
+        grad = self._scale(x) * (error[:, 0] - error[:, 1])
+        return np.repeat(grad[:, np.newaxis], x.shape[1], axis=1)
+
+    def fit(self, x, y, **kwargs):
+        raise NotImplementedError
+
+
+@pytest.mark.parametrize(
+    "reduce,group_by_length,expected_lengths",
+    [("sum", False, [[12, 12, 20], [20]]), ("mean", True, [[12, 12], [20, 20]])],
+)
+def test_variable_length_signals(reduce, group_by_length, expected_lengths):
+    classifier = MeanClassifier(weight=10.0 if reduce == "mean" else 1.0, reduce=reduce)
+    rng = np.random.default_rng(2)
+    lengths = [20, 12, 0, 17, 20, 12]
+    x = np.empty(len(lengths), dtype=object)
+    for i, length in enumerate(lengths):
+        x[i] = rng.normal(0.05, 1, size=length).astype(np.float32)
+    x[3][:] = 0
+    y = np.zeros(len(x), dtype=int)
+    kwargs = attack_kwargs(group_by_length=group_by_length)
+
+    attack = snr_pgd.SNR_PGD_Numpy(
+        classifier, batch_size=3, **attack_kwargs(num_random_init=2)
+    )
+    x_adv = attack.generate(x, y)
+    assert x_adv.dtype == object
+    assert [len(x_i) for x_i in x_adv] == lengths
+    assert np.array_equal(x_adv[3], x[3])
+    for x_i, x_adv_i in zip(x[[0, 1, 4, 5]], x_adv[[0, 1, 4, 5]]):
+        snr = np.sum(x_i ** 2) / np.sum((x_adv_i - x_i) ** 2)
+        assert 10 * np.log10(snr) >= 10 - 1e-3
+
+    # Padded batches mix lengths, and grouped batches do not. Either way, each
+    # signal matches the result of attacking it alone
+    single = snr_pgd.SNR_PGD_Numpy(classifier, **kwargs)
+    attack = snr_pgd.SNR_PGD_Numpy(classifier, batch_size=3, **kwargs)
+    batch_lengths = []
+    generate_batch_eps = attack._generate_batch_eps
+
+    def record_batch(x, targets, mask, eps, lengths):
+        batch_lengths.append(lengths.tolist())
+        return generate_batch_eps(x, targets, mask, eps, lengths)
+
+    attack._generate_batch_eps = record_batch
+    x_adv = attack.generate(x, y)
+    assert batch_lengths == expected_lengths
+    for i in 0, 1, 4, 5:
+        expected = single.generate(x[i : i + 1], y[i : i + 1])
+        assert np.allclose(x_adv[i], expected[0], rtol=1e-5, atol=1e-6)
+    assert (classifier.predict(np.stack(x_adv[[0, 4]])).argmax(axis=1) != 0).any()
+
+    x_padded, padded_lengths = snr_pgd.pad_signals(x[:2])
+    assert x_padded.shape == (2, 20)
+    assert padded_lengths.tolist() == [20, 12]
+    assert not x_padded[1, 12:].any()
+
+
+def test_unchanged(classifier):
+    x = np.ones((3, 20), dtype=np.float32)
+    attack = snr_pgd.SNR_PGD_Numpy(classifier, norm="snr", eps=np.inf, batch_size=3)
+    assert attack.generate(x, np.zeros(3, dtype=int)) is x
+    attack = snr_pgd.SNR_PGD_Numpy(classifier, batch_size=3)
+    x = np.zeros((3, 20), dtype=np.float32)
+    assert attack.generate(x, np.zeros(3, dtype=int)) is x
+
+
+def test_generate_candidates(classifier):
+    rng = np.random.default_rng(3)
+    x = rng.normal(size=(1, 20)).astype(np.float32)
+    y = classifier.predict(x).argmax(axis=1)
+    eps = [0, 5, 10, 20]
+
+    attack = snr_pgd.SNR_PGD_Numpy(classifier, **attack_kwargs())
+    x_adv, predictions = attack.generate_candidates(
+        x, y, [snr_pgd.snr_sqrt_reciprocal(eps_i, "snr_db") for eps_i in eps]
+    )
+    assert x_adv.shape == (4, 20)
+    assert np.allclose(predictions, classifier.predict(x_adv))
+    for eps_i, x_adv_i in zip(eps, x_adv):
+        single = snr_pgd.SNR_PGD_Numpy(classifier, **attack_kwargs(eps=eps_i))
+        assert np.allclose(x_adv_i, single.generate(x, y)[0], rtol=1e-5, atol=1e-6)
+
+
+def snr_db(x, x_adv):
+    return 10 * np.log10(np.sum(x ** 2) / np.sum((x_adv - x) ** 2))
+
+
+@pytest.mark.parametrize("num_candidates", [2, 4, 30])
+def test_range_search(classifier, num_candidates):
+    rng = np.random.default_rng(4)
+    x = rng.normal(size=(1, 20)).astype(np.float32)
+    y = classifier.predict(x).argmax(axis=1)
+    kwargs = dict(norm="snr_db", eps_step=0.1, max_iter=10)
+
+    results = []
+    for k in (1, num_candidates):
+        attack = snr_pgd.SNR_PGDRange(
+            classifier, eps_range=range(-10, 40, 2), num_candidates=k, **kwargs
+        )
+        attack.attack = snr_pgd.SNR_PGD_Numpy(classifier, **kwargs)
+        results.append(attack.generate(x, y))
+    assert np.array_equal(results[0], results[1])
+    assert classifier.predict(results[1]).argmax() != y
+
+    results = []
+    for k in (1, num_candidates):
+        attack = snr_pgd.SNR_PGDRange2(
+            classifier,
+            eps_min=-10,
+            eps_max=40,
+            tolerance=0.5,
+            num_candidates=k,
+            **kwargs,
+        )
+        attack.attack = snr_pgd.SNR_PGD_Numpy(classifier, **kwargs)
+        results.append(attack.generate(x, y))
+    for x_adv in results:
+        assert classifier.predict(x_adv).argmax() != y
+    assert abs(snr_db(x, results[0]) - snr_db(x, results[1])) <= 1
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from armory.art_experimental.poison_detection import SpectralSignatureDefense
+
+
+class FeatureClassifier:
+    """
+    Classifier whose last layer activations are fixed features
+    """
+
+    layer_names = ["features"]
+
+    def __init__(self, features, nb_classes):
+        self.features = features
+        self._nb_classes = nb_classes
+
+    def nb_classes(self):
+        return self._nb_classes
+
+    def get_activations(self, x, layer, batch_size):
+        return self.features[x]
+
+
+def loop_detect_poison(features, labels, num_classes, eps_multiplier, ub_pct_poison):
+    """
+    Previous per-sample implementation of detect_poison
+    """
+    split = [[] for _ in range(num_classes)]
+    index_split = [[] for _ in range(num_classes)]
+    for idx, label in enumerate(labels):
+        split[int(label)].append(features[idx])
+        index_split[int(label)].append(idx)
+    is_clean = np.zeros_like(labels, dtype=int)
+    for feature, indices in zip(split, index_split):
+        score = SpectralSignatureDefense.spectral_signature_scores(np.array(feature))
+        cutoff = np.quantile(score, max(1 - eps_multiplier * ub_pct_poison, 0.0))
+        for keep, idx in zip(score < cutoff, indices):
+            if keep:
+                is_clean[idx] = 1
+    return is_clean
+
+
+@pytest.mark.parametrize("max_scatter_bytes", [2 ** 30, 1])
+@pytest.mark.parametrize("chunk_size", [None, 64])
+@pytest.mark.parametrize("one_hot", [False, True])
+def test_detect_poison(one_hot, chunk_size, max_scatter_bytes):
+    rng = np.random.default_rng(0)
+    num_classes = 12
+    labels = rng.integers(0, num_classes, size=600)
+    # Features far from the origin, with a dominant direction per class
+    features = rng.normal(size=(600, 20)) + 100
+    features += rng.normal(size=(600, 1)) * rng.normal(size=(num_classes, 20))[labels]
+    expected = loop_detect_poison(features, labels, num_classes, 1.5, 0.1)
+
+    y_train = np.eye(num_classes)[labels] if one_hot else labels
+    defense = SpectralSignatureDefense(
+        FeatureClassifier(features, num_classes),
+        np.arange(600),
+        y_train,
+        batch_size=64,
+        eps_multiplier=1.5,
+        ub_pct_poison=0.1,
+        chunk_size=chunk_size,
+        max_scatter_bytes=max_scatter_bytes,
+    )
+    _, is_clean = defense.detect_poison()
+    assert np.array_equal(is_clean, expected)
+
+    # A class without samples is skipped
+    defense.classifier._nb_classes = num_classes + 1
+    _, is_clean = defense.detect_poison()
+    assert np.array_equal(is_clean, expected)
+
+
+def test_split_by_class():
+    labels = np.array([2, 0, 2, 1, 0, 2])
+    data = np.arange(6) * 10
+    split = SpectralSignatureDefense.split_by_class(data, labels, 4)
+    assert [list(s) for s in split] == [[10, 40], [30], [0, 20, 50], []]
+    with pytest.raises(ValueError):
+        SpectralSignatureDefense.split_by_class(data, labels, 2)
+
+
+def test_randomized_scores():
+    rng = np.random.default_rng(1)
+    # Low rank features with a dominant direction
+    R = rng.normal(size=(2000, 5)) @ rng.normal(size=(5, 600))
+    R += 10 * rng.normal(size=(2000, 1)) @ rng.normal(size=(1, 600))
+    full = SpectralSignatureDefense.spectral_signature_scores(R, svd_solver="full")
+    randomized = SpectralSignatureDefense.spectral_signature_scores(
+        R, svd_solver="randomized", random_state=0
+    )
+    assert np.allclose(randomized, full, rtol=1e-4, atol=1e-6 * full.max())
+    auto = SpectralSignatureDefense.spectral_signature_scores(
+        R, svd_solver="auto", random_state=0
+    )
+    assert np.array_equal(auto, randomized)
+
+
+def test_top_eigenvector():
+    rng = np.random.default_rng(2)
+    R = rng.normal(size=(1000, 30)) * np.linspace(1, 3, 30)
+    matrix = R.T @ R
+    defense = SpectralSignatureDefense(
+        FeatureClassifier(R, 2), np.arange(1000), np.zeros(1000, dtype=int)
+    )
+    expected = np.linalg.svd(R, full_matrices=False)[2][0]
+    for svd_solver in ["full", "randomized"]:
+        defense.svd_solver = svd_solver
+        v = defense._top_eigenvector(matrix)
+        assert np.allclose(np.abs(v @ expected), 1.0)
+
+    # The random start depends only on random_state, not on the global state
+    defense.set_params(svd_solver="randomized", random_state=3)
+    np.random.seed(0)
+    v = defense._top_eigenvector(matrix)
+    np.random.seed(1)
+    assert np.array_equal(defense._top_eigenvector(matrix), v)
+    v = defense._top_eigenvector(matrix.astype(np.float32))
+    assert v.dtype == np.float32
+    assert np.allclose(np.abs(v @ expected), 1.0, atol=1e-4)
+
+
+def test_top_eigenvector_float32_converges(caplog):
+    rng = np.random.default_rng(4)
+    R = rng.normal(size=(800, 600)) + 3 * rng.normal(size=(800, 1)) @ rng.normal(
+        size=(1, 600)
+    )
+    R -= R.mean(axis=0)
+    matrix = (R.T @ R).astype(np.float32)
+    defense = SpectralSignatureDefense(
+        FeatureClassifier(R, 2),
+        np.arange(800),
+        np.zeros(800, dtype=int),
+        svd_solver="auto",
+    )
+    v = defense._top_eigenvector(matrix)
+    assert "did not converge" not in caplog.text
+    expected = np.linalg.eigh(R.T @ R)[1][:, -1]
+    assert np.allclose(np.abs(v @ expected), 1.0, atol=1e-4)
+
+
+def test_float32_features():
+    rng = np.random.default_rng(3)
+    labels = rng.integers(0, 3, size=300)
+    features = rng.normal(size=(300, 10)) + 10
+    features += 5 * rng.normal(size=(300, 1)) * rng.normal(size=(3, 10))[labels]
+    features = features.astype(np.float32)
+    expected = loop_detect_poison(features, labels, 3, 1.5, 0.1)
+    defense = SpectralSignatureDefense(
+        FeatureClassifier(features, 3),
+        np.arange(300),
+        labels,
+        batch_size=64,
+        eps_multiplier=1.5,
+        ub_pct_poison=0.1,
+        chunk_size=100,
+    )
+    _, is_clean = defense.detect_poison()
+    assert np.array_equal(is_clean, expected)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from armory.data import training_store
+
+
+def test_training_store(tmp_path):
+    rng = np.random.default_rng(0)
+    x = rng.random((100, 4, 4, 3), dtype=np.float32)
+    y = rng.integers(0, 10, size=100)
+
+    # Appending past the initial capacity grows the store
+    store = training_store.TrainingStore(40, directory=str(tmp_path))
+    for start in range(0, 100, 16):
+        store.append(x[start : start + 16], y[start : start + 16])
+    assert isinstance(store.x, np.memmap)
+    assert np.array_equal(store.x, x)
+    assert np.array_equal(store.y, y)
+    # The backing file is unnamed
+    assert not list(tmp_path.iterdir())
+
+    store.x[:10] = 0
+    x[:10] = 0
+    keep = rng.random(100) < 0.6
+    x_kept, y_kept = store.filter(keep)
+    assert np.array_equal(x_kept, x[keep])
+    assert np.array_equal(y_kept, y[keep])
+    assert len(store.x) == keep.sum()
+
+    with pytest.raises(ValueError):
+        store.append(x[:2, :2], y[:2])
+    with pytest.raises(ValueError):
+        store.filter(keep)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_compact(chunk_size):
+    x = np.arange(50) * 10
+    keep = np.zeros(50, dtype=bool)
+    keep[[0, 1, 2, 7, 8, 20, 21, 22, 23, 49]] = True
+    expected = x[keep]
+    assert np.array_equal(training_store.compact(x, keep, chunk_size), expected)
+    assert np.array_equal(x[: len(expected)], expected)
+
+    assert len(training_store.compact(x, np.zeros(50, dtype=bool))) == 0
@@ -2,11 +2,13 @@
 Test cases for framework specific ARMORY datasets.
 """
 
+import pytest
 import torch
 import numpy as np
 
-from armory.data import datasets
+from armory.data import datasets, pytorch_loader
 from armory import paths
+from armory.utils.config_loading import load_dataset
 
 DATASET_DIR = paths.DockerPaths().dataset_dir
 
@@ -133,3 +135,58 @@ def test_tf_pytorch_equality():
 
         assert np.amax(np.abs(img_tf - img_pytorch)) == 0
         assert np.amax(np.abs(label_tf - label_pytorch)) == 0
+
+
+def test_pytorch_dataloader_workers():
+    batch_size = 10
+    dataset = datasets.mnist(
+        split="test",
+        batch_size=batch_size,
+        dataset_dir=DATASET_DIR,
+        framework="pytorch",
+        shuffle_files=False,
+        preprocessing_fn=None,
+        fit_preprocessing_fn=None,
+    )
+    labels = torch.cat([y for x, y in dataset])
+
+    loader = pytorch_loader.make_dataloader(
+        dataset.dataset, num_workers=2, pin_memory=True
+    )
+    worker_labels = []
+    for images, y in loader:
+        assert images.dtype == torch.uint8
+        assert images.shape[1:] == (28, 28, 1)
+        worker_labels.append(y)
+    worker_labels = torch.cat(worker_labels)
+
+    # Workers interleave batches, so only compare the multiset of labels
+    assert len(worker_labels) == len(labels) == 10000
+    assert torch.equal(torch.sort(worker_labels)[0], torch.sort(labels)[0])
+
+    # The same loader is built from the dataset config
+    loader = load_dataset(
+        {
+            "batch_size": batch_size,
+            "framework": "pytorch",
+            "module": "armory.data.datasets",
+            "name": "mnist",
+            "dataloader_workers": 2,
+            "pin_memory": True,
+        },
+        split="test",
+        dataset_dir=DATASET_DIR,
+        shuffle_files=False,
+        preprocessing_fn=None,
+        fit_preprocessing_fn=None,
+    )
+    assert loader.num_workers == 2 and loader.pin_memory
+    config_labels = torch.cat([y for x, y in loader])
+    assert torch.equal(torch.sort(config_labels)[0], torch.sort(labels)[0])
+
+    # Workers are spawned, so a tf.data.Dataset cannot be passed to them
+    tf_dataset = pytorch_loader.TFToTorchGenerator(
+        tf_dataset=dataset.dataset.make_dataset(None)
+    )
+    with pytest.raises(ValueError):
+        pytorch_loader.make_dataloader(tf_dataset, num_workers=2)
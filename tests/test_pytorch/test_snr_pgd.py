@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import torch
+
+from art.estimators.classification import PyTorchClassifier
+
+from armory.art_experimental.attacks import snr_pgd
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Linear(20, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4)
+    )
+    return PyTorchClassifier(
+        model,
+        loss=torch.nn.CrossEntropyLoss(),
+        input_shape=(20,),
+        nb_classes=4,
+        clip_values=(-10.0, 10.0),
+    )
+
+
+@pytest.mark.parametrize("Attack", [snr_pgd.SNR_PGD, snr_pgd.SNR_PGD_Linf])
+def test_batch_equals_single(classifier, Attack):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(10, 20)).astype(np.float32)
+    x[3] *= 5
+    y = classifier.predict(x).argmax(axis=1)
+    kwargs = dict(norm="snr_db", eps=10, eps_step=0.1, max_iter=5)
+
+    single = Attack(classifier, **kwargs)
+    expected = np.concatenate(
+        [single.generate(x[i : i + 1], y[i : i + 1]) for i in range(len(x))]
+    )
+    x_adv = Attack(classifier, batch_size=4, **kwargs).generate(x, y)
+    assert np.allclose(x_adv, expected, rtol=1e-5, atol=1e-6)
+
+
+class MeanModel(torch.nn.Module):
+    """
+    Classifies each signal by its mean, so that its output depends on its length,
+        or by its sum, so that it does not change with zero padding
+    """
+
+    def __init__(self, reduce="mean"):
+        super().__init__()
+        self.linear = torch.nn.Linear(1, 4)
+        self.reduce = reduce
+
+    def forward(self, x):
+        if self.reduce == "mean":
+            return self.linear(x.mean(dim=1, keepdim=True))
+        return self.linear(x.sum(dim=1, keepdim=True))
+
+
+@pytest.mark.parametrize("reduce,group_by_length", [("sum", False), ("mean", True)])
+def test_variable_length_signals(reduce, group_by_length):
+    torch.manual_seed(0)
+    classifier = PyTorchClassifier(
+        MeanModel(reduce),
+        loss=torch.nn.CrossEntropyLoss(),
+        input_shape=(None,),
+        nb_classes=4,
+        clip_values=(-10.0, 10.0),
+    )
+    rng = np.random.default_rng(2)
+    lengths = [20, 12, 17, 20, 12]
+    x = np.empty(len(lengths), dtype=object)
+    for i, length in enumerate(lengths):
+        x[i] = rng.normal(size=length).astype(np.float32)
+    y = np.zeros(len(x), dtype=int)
+
+    attack = snr_pgd.SNR_PGD(
+        classifier, norm="snr", eps=4, max_iter=5, num_random_init=2, batch_size=4
+    )
+    x_adv = attack.generate(x, y)
+    assert [len(x_i) for x_i in x_adv] == lengths
+    for x_i, x_adv_i in zip(x, x_adv):
+        snr = np.sum(x_i ** 2) / np.sum((x_adv_i - x_i) ** 2)
+        assert snr >= 4 * (1 - 1e-3)
+
+    # Padding does not change the sum, and grouped signals are not padded, so each
+    # matches the result of attacking it alone
+    kwargs = dict(norm="snr", eps=4, max_iter=5, group_by_length=group_by_length)
+    single = snr_pgd.SNR_PGD(classifier, **kwargs)
+    x_adv = snr_pgd.SNR_PGD(classifier, batch_size=4, **kwargs).generate(x, y)
+    for i in range(len(x)):
+        expected = single.generate(x[i : i + 1], y[i : i + 1])
+        assert np.allclose(x_adv[i], expected[0], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,168 @@
+"""
+Script to benchmark attacks in armory.art_experimental.attacks on synthetic data.
+
+Usage: python -m tools.benchmark_attacks <benchmark> [--repeats N] [--seed SEED]
+    :argument benchmark: which attack to benchmark, one of the keys in BENCHMARKS
+    :argument --repeats: number of timed runs per configuration (minimum is reported)
+    :argument --seed: seed for the random number generator used to create data
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from armory.art_experimental.attacks.kenansville_dft import KenansvilleDFT
+
+
+def timeit(function, *args, repeats=3):
+    """
+    Return the minimum wall-clock time (in seconds) of repeated calls to function
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class ReferenceKenansvilleDFT(KenansvilleDFT):
+    """
+    Full DFT with coarse and fine search previously used by KenansvilleDFT
+
+    KenansvilleDFT sums powers in a different order, so the two can differ when the
+        SNR of discarding some number of frequencies rounds to exactly snr_db
+    """
+
+    def _attack(self, x):
+        x_len = len(x)
+        x_fft = np.fft.fft(x)
+        x_psd = np.abs(x_fft) ** 2
+        x_psd_ind = np.argsort(x_psd)
+        dc_ind = np.where(x_psd_ind == 0)[0][0]
+        signal_db = 10 * np.log10(np.sum(x_psd))
+
+        id = 2
+        noise = np.sum(x_psd[x_psd_ind[:id]])
+        noise_db = 10 * np.log10(noise)
+        while signal_db - noise_db > self.snr_db:
+            id *= 2
+            noise = np.sum(x_psd[x_psd_ind[: min(id, x_len)]])
+            noise_db = 10 * np.log10(noise)
+
+        if id == 2:
+            return x
+
+        id = int(id / 2)
+        noise = np.sum(x_psd[x_psd_ind[:id]])
+        noise_db = 10 * np.log10(noise)
+        while signal_db - noise_db > self.snr_db:
+            id += 2
+            noise = np.sum(x_psd[x_psd_ind[: min(id, x_len)]])
+            noise_db = 10 * np.log10(noise)
+
+        id -= 2
+
+        if (dc_ind in x_psd_ind[:id]) ^ (
+            x_len % 2 == 0 and x_len / 2 in x_psd_ind[:id]
+        ):
+            id -= 1
+
+        x_fft[x_psd_ind[:id]] = 0
+        x_ifft = np.fft.ifft(x_fft)
+        return np.real(x_ifft).astype(np.float32)
+
+    def generate(self, x):
+        x_out = np.empty((len(x),), dtype=object)
+        for i, x_example in enumerate(x):
+            if self.partial_attack:
+                x_adv = np.zeros_like(x_example)
+                seg_len = self.attack_len
+                for j in range(int(np.ceil(len(x_example) / seg_len))):
+                    xs = x_example[seg_len * j : min((j + 1) * seg_len, len(x_example))]
+                    if np.random.rand(1) < self.attack_prob:
+                        xs = self._attack(xs)
+                    x_adv[seg_len * j : min((j + 1) * seg_len, len(x_example))] = xs
+            else:
+                x_adv = self._attack(x_example)
+            x_out[i] = x_adv
+        return x_out
+
+
+def random_speech(rng, batch_size, seconds, sample_rate=16000):
+    """
+    Return an object array of signals with a few harmonics, amplitude modulation
+        and noise, roughly like LibriSpeech utterances of the given length
+    """
+    x = np.empty(batch_size, dtype=object)
+    for i in range(batch_size):
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        pitch = rng.uniform(100, 250)
+        signal = sum(
+            np.sin(2 * np.pi * pitch * k * t + rng.uniform(0, 2 * np.pi)) / k
+            for k in range(1, 6)
+        )
+        signal *= 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(2, 5) * t) ** 2
+        signal += rng.normal(scale=0.05, size=len(t))
+        x[i] = (0.1 * signal).astype(np.float32)
+    return x
+
+
+def compare(x_adv, reference):
+    return all(
+        np.allclose(x_i, ref_i, rtol=1e-4, atol=1e-6)
+        for x_i, ref_i in zip(x_adv, reference)
+    )
+
+
+def benchmark_kenansville(rng, repeats):
+    print(
+        f"{'partial':>8} {'snr_db':>7} {'seconds':>8} {'reference (s)':>14} "
+        f"{'current (s)':>12} {'speedup':>8}"
+    )
+    # LibriSpeech test_clean utterances are 1-35 seconds long at 16 kHz. The
+    # reference fine search takes time quadratic in the signal length, so long
+    # signals are only timed with partial attacks
+    for partial_attack, snr_db, seconds in [
+        (False, 20, 2),
+        (False, 40, 2),
+        (False, 20, 8),
+        (True, 20, 8),
+        (True, 20, 30),
+    ]:
+        x = random_speech(rng, 2, seconds)
+        kwargs = dict(snr_db=snr_db, partial_attack=partial_attack)
+        attack = KenansvilleDFT(None, **kwargs)
+        reference = ReferenceKenansvilleDFT(None, **kwargs)
+
+        np.random.seed(0)
+        x_adv = attack.generate(x)
+        np.random.seed(0)
+        if not compare(x_adv, reference.generate(x)):
+            raise ValueError("KenansvilleDFT does not match the reference")
+
+        reference_seconds = timeit(reference.generate, x, repeats=repeats)
+        current_seconds = timeit(attack.generate, x, repeats=repeats)
+        print(
+            f"{str(partial_attack):>8} {snr_db:>7} {seconds:>8} "
+            f"{reference_seconds:>14.4f} {current_seconds:>12.4f} "
+            f"{reference_seconds / current_seconds:>7.1f}x"
+        )
+
+
+BENCHMARKS = {
+    "kenansville_dft": benchmark_kenansville,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark armory attacks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="number of timed runs per configuration"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](np.random.default_rng(args.seed), args.repeats)
@@ -0,0 +1,171 @@
+"""
+Script to benchmark metrics in armory.utils.metrics on synthetic data.
+
+Usage: python -m tools.benchmark_metrics <benchmark> [--repeats N] [--seed SEED]
+    :argument benchmark: which metric to benchmark, one of the keys in BENCHMARKS
+    :argument --repeats: number of timed runs per configuration (minimum is reported)
+    :argument --seed: seed for the random number generator used to create data
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from armory.utils import metrics
+
+
+def timeit(function, *args, repeats=3):
+    """
+    Return the minimum wall-clock time (in seconds) of repeated calls to function
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def random_boxes(rng, num_boxes):
+    """
+    Return normalized [y1, x1, y2, x2] boxes of shape (num_boxes, 4)
+    """
+    corners = rng.random((num_boxes, 2)) * 0.8
+    sizes = rng.random((num_boxes, 2)) * 0.2 + 0.01
+    return np.hstack([corners, corners + sizes]).astype(np.float32)
+
+
+def random_detections(rng, num_images, boxes_per_image, num_classes=60):
+    """
+    Return lists of ys and y_preds (one image per batch) with jittered predictions
+    """
+    list_of_ys, list_of_y_preds = [], []
+    for _ in range(num_images):
+        gt_boxes = random_boxes(rng, boxes_per_image)
+        gt_labels = rng.integers(1, num_classes + 1, boxes_per_image)
+        jitter = rng.normal(scale=0.01, size=gt_boxes.shape).astype(np.float32)
+        pred_boxes = np.clip(gt_boxes + jitter, 0, 1)
+        pred_boxes[:, 2:] = np.maximum(pred_boxes[:, 2:], pred_boxes[:, :2])
+        pred_labels = gt_labels.copy()
+        flipped = rng.random(boxes_per_image) < 0.2
+        pred_labels[flipped] = rng.integers(1, num_classes + 1, flipped.sum())
+        list_of_ys.append([{"labels": gt_labels, "boxes": gt_boxes}])
+        list_of_y_preds.append(
+            [
+                {
+                    "labels": pred_labels,
+                    "boxes": pred_boxes,
+                    "scores": rng.random(boxes_per_image).astype(np.float32),
+                }
+            ]
+        )
+    return list_of_ys, list_of_y_preds
+
+
+def benchmark_ap(rng, repeats):
+    print(f"{'images':>8} {'boxes/img':>10} {'total boxes':>12} {'seconds':>10}")
+    for num_images, boxes_per_image in [
+        (100, 10),
+        (100, 100),
+        (1000, 10),
+        (1000, 100),
+        (1000, 300),
+    ]:
+        list_of_ys, list_of_y_preds = random_detections(
+            rng, num_images, boxes_per_image
+        )
+        seconds = timeit(
+            metrics.object_detection_AP_per_class,
+            list_of_ys,
+            list_of_y_preds,
+            repeats=repeats,
+        )
+        total_boxes = num_images * boxes_per_image
+        print(
+            f"{num_images:>8} {boxes_per_image:>10} {total_boxes:>12} {seconds:>10.4f}"
+        )
+
+
+def reference_word_error_rate(y, y_pred):
+    """
+    Cell-by-cell dynamic programme previously used by metrics.word_error_rate
+    """
+    results = []
+    for y_i, y_pred_i in zip(y, y_pred):
+        reference = y_i.split()
+        hypothesis = y_pred_i.split()
+        r_length = len(reference)
+        h_length = len(hypothesis)
+        matrix = np.zeros((r_length + 1, h_length + 1))
+        for i in range(r_length + 1):
+            for j in range(h_length + 1):
+                if i == 0:
+                    matrix[0][j] = j
+                elif j == 0:
+                    matrix[i][0] = i
+        for i in range(1, r_length + 1):
+            for j in range(1, h_length + 1):
+                if reference[i - 1] == hypothesis[j - 1]:
+                    matrix[i][j] = matrix[i - 1][j - 1]
+                else:
+                    substitute = matrix[i - 1][j - 1] + 1
+                    insertion = matrix[i][j - 1] + 1
+                    deletion = matrix[i - 1][j] + 1
+                    matrix[i][j] = min(substitute, insertion, deletion)
+        results.append((matrix[r_length][h_length], r_length))
+    return results
+
+
+def random_transcriptions(rng, batch_size, num_words, vocabulary_size=1000):
+    """
+    Return references and hypotheses, where hypotheses have ~10% word errors
+    """
+    vocabulary = np.array([f"word{i}" for i in range(vocabulary_size)])
+    y, y_pred = [], []
+    for _ in range(batch_size):
+        reference = rng.choice(vocabulary, num_words)
+        hypothesis = reference.copy()
+        errors = rng.random(num_words) < 0.1
+        hypothesis[errors] = rng.choice(vocabulary, errors.sum())
+        # Drop some words to exercise insertions and deletions
+        hypothesis = hypothesis[rng.random(num_words) > 0.02]
+        y.append(" ".join(reference))
+        y_pred.append(" ".join(hypothesis))
+    return y, y_pred
+
+
+def benchmark_wer(rng, repeats):
+    print(
+        f"{'batch':>6} {'words':>6} {'reference (s)':>14} {'current (s)':>12} {'speedup':>8}"
+    )
+    for batch_size, num_words in [(1, 20), (1, 200), (16, 20), (16, 200), (4, 1000)]:
+        y, y_pred = random_transcriptions(rng, batch_size, num_words)
+        if metrics.word_error_rate(y, y_pred) != reference_word_error_rate(y, y_pred):
+            raise ValueError("word_error_rate does not match the reference")
+        reference_seconds = timeit(
+            reference_word_error_rate, y, y_pred, repeats=repeats
+        )
+        seconds = timeit(metrics.word_error_rate, y, y_pred, repeats=repeats)
+        print(
+            f"{batch_size:>6} {num_words:>6} {reference_seconds:>14.4f} "
+            f"{seconds:>12.4f} {reference_seconds / seconds:>7.1f}x"
+        )
+
+
+BENCHMARKS = {
+    "object_detection_AP_per_class": benchmark_ap,
+    "word_error_rate": benchmark_wer,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark armory metrics.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="number of timed runs per configuration"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](np.random.default_rng(args.seed), args.repeats)
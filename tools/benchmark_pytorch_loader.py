@@ -0,0 +1,82 @@
+"""
+Script to benchmark the throughput of pytorch framework datasets.
+
+Compares the previous single-process conversion (tensor.numpy() then torch.from_numpy)
+    against armory.data.pytorch_loader with DataLoader workers.
+
+Usage: python -m tools.benchmark_pytorch_loader [--datasets NAME ...] [--num-batches N]
+    :argument --datasets: datasets to benchmark, keys of DATASETS (default: all)
+    :argument --num-batches: number of batches to time per configuration
+    :argument --workers: list of DataLoader num_workers values to time
+    :argument --pin-memory: whether to use pinned memory in the DataLoader
+"""
+
+import argparse
+import itertools
+import time
+
+import torch
+
+from armory.data import datasets, pytorch_loader
+
+DATASETS = {
+    "cifar10": {"split": "train", "batch_size": 64},
+    "ucf101": {"split": "train", "batch_size": 1},
+}
+
+
+def reference_iterator(tf_dataset):
+    """
+    Conversion previously used by pytorch_loader.TFToTorchGenerator
+    """
+    for x, y in tf_dataset.take(-1):
+        yield torch.from_numpy(x.numpy()), torch.from_numpy(y.numpy())
+
+
+def throughput(iterator, num_batches):
+    """
+    Return samples per second over num_batches batches, after one warmup batch
+    """
+    x, _ = next(iterator)
+    samples = 0
+    start = time.perf_counter()
+    for x, _ in itertools.islice(iterator, num_batches):
+        samples += len(x)
+    return samples / (time.perf_counter() - start)
+
+
+def benchmark(name, num_batches, workers, pin_memory):
+    kwargs = DATASETS[name]
+    loader = getattr(datasets, name)(
+        epochs=100,
+        framework="pytorch",
+        preprocessing_fn=None,
+        shuffle_files=False,
+        **kwargs,
+    )
+    make_dataset = loader.dataset.make_dataset
+    rate = throughput(reference_iterator(make_dataset(None)), num_batches)
+    print(f"{name:>8} {'reference':>12} {rate:>14.1f}")
+    for num_workers in workers:
+        loader = pytorch_loader.make_dataloader(
+            pytorch_loader.TFToTorchGenerator(make_dataset=make_dataset),
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+        )
+        rate = throughput(iter(loader), num_batches)
+        print(f"{name:>8} {f'workers={num_workers}':>12} {rate:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pytorch dataset loading.")
+    parser.add_argument(
+        "--datasets", nargs="+", choices=sorted(DATASETS), default=sorted(DATASETS)
+    )
+    parser.add_argument("--num-batches", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--pin-memory", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'dataset':>8} {'loader':>12} {'samples/sec':>14}")
+    for name in args.datasets:
+        benchmark(name, args.num_batches, args.workers, args.pin_memory)